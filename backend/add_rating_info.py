@@ -6,22 +6,27 @@ import os
 import json
 import shutil
 
+from course_details import add_details, details_path, rating_means, read_details_file, write_details_file
+
 """
 This file directly adds coursetable rating data to .json files in a directory of choice:
 
 Args
 - target_data_path: Path to the desired folder containing .json files for courses that must be updated with rating info
 - rating_data_path: Path to folder containing .json files equipped with rating info
+- details_data_path: Path to the folder of course details .json files (see course_details.py)
 - years_to_port: List containing integers representing what years of rating info to include in the given .json files for parsed courses
 
 Processing
 - Consider each .json file in 'data_path'
 - For each item (representing a single course) in the .json: 
     - Retrieve the relevant course evaluation files for the year(s) specified
-    - Store result as a new field(s) in the json course_objectect
+    - Store the mean overall rating and workload in the json course_objectect
+    - Store the raw ratings in the course's details
 
 Result
-- Updated .json files with new rating field for each course's json course_objectect, written in-place.
+- Updated .json files with average_rating and average_workload for each course's json course_objectect, written in-place.
+- A .json file of course details per season, named like the parsed course file, in details_data_path.
 """
 
 # Main function to loop over all JSON course_objectects for the given year
@@ -38,6 +43,8 @@ def main(args):
             season_file_path = os.path.join(args.target_data_path, filename)
             with open(season_file_path, 'r') as f:
                 season_course = json.load(f)
+            season_details_path = details_path(args.details_data_path, filename)
+            season_details = read_details_file(season_details_path)
             
             # Consider each course in the relevant year/season
             count = 0
@@ -54,23 +61,28 @@ def main(args):
 
                     # Inspect if there are any json entries for that course in the specified season
                     grep_cmd = f"ls {args.rating_data_path} | grep {season_code}-{crn}"
-                    try: # if so, write the rating data to the file
+                    try:
                         grep_output = subprocess.check_output(grep_cmd, shell=True).decode().strip().split("\n")
-                        season_filename = grep_output[0]
-                        rating_file_path = os.path.join(args.rating_data_path, season_filename)
-                        with open(rating_file_path, 'r') as rating_file:
-                            rating_json = json.load(rating_file)
-                            course_object["ratings"] = rating_json["ratings"]
-                        print(f"Finished {season_code}-{crn}")
-                        reviews_missing = False
-                        break
-                    except: # if no matches found, continue
+                    except subprocess.CalledProcessError: # if no matches found, continue
                         continue
+
+                    # if so, write the rating data to the file
+                    season_filename = grep_output[0]
+                    rating_file_path = os.path.join(args.rating_data_path, season_filename)
+                    with open(rating_file_path, 'r') as rating_file:
+                        rating_json = json.load(rating_file)
+                    # the raw ratings go to the details first; only the means stay on the course
+                    add_details(season_details, course_object, ratings=rating_json["ratings"])
+                    course_object.update(rating_means(rating_json["ratings"]))
+                    print(f"Finished {season_code}-{crn}")
+                    reviews_missing = False
+                    break
                 if reviews_missing:
-                    course_object["ratings"] = []
+                    course_object.update(rating_means([]))
 
             with open(season_file_path, 'w') as f:
                 json.dump(season_course, f, indent=4)
+            write_details_file(season_details_path, season_details)
 
 
 ############################################################
@@ -92,6 +104,11 @@ if __name__ == "__main__":
                         default="data/course_evals",
                         help="Folder where the .json files with rating info are located.") 
 
+    parser.add_argument("--details_data_path", 
+                        type=str, 
+                        default="data/course_details",
+                        help="Folder where the .json files of course details are written.") 
+
     parser.add_argument("--years_to_port", 
                         nargs="*",  # 0 or more values expected => creates a list
                         type=int,
@@ -0,0 +1,203 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from pymongo import UpdateOne
+
+# one {"_id": season_code, "generation": n} document per re-imported season
+GENERATIONS_COLLECTION = "answer_cache_generations"
+
+
+def filter_key(season_codes, subjects, areas, skills):
+    # the same filters in a different order are the same filters
+    return tuple(
+        tuple(sorted(values)) if values else ()
+        for values in (season_codes, subjects, areas, skills)
+    )
+
+
+class AnswerCache:
+    """Caches final /api/chat answers by the meaning of the search query.
+
+    An answer is reused when a new turn resolves to exactly the same filters and
+    its query embedding has cosine similarity of at least ``threshold`` with the
+    cached one. The cache holds at most ``capacity`` answers (least recently used
+    are evicted first), and every entry expires ``ttl`` seconds after it was
+    cached.
+
+    Each gunicorn worker has its own cache, so a course re-import can't evict an
+    answer from all of them. With ``generations`` (a :class:`SeasonGenerations`)
+    each entry instead keeps the generation of every season when its courses were
+    searched, and ``get()`` skips it once a season it may draw on was re-imported:
+    one in its filters or its courses, or any season if it had no season filter.
+
+    The answers of each set of filters are kept together, with their vectors
+    stacked into one matrix that is rebuilt only after that set changes.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, capacity=1000, generations=None):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.capacity = capacity
+        self.generations = generations
+        # least recently used first
+        self.entries = OrderedDict()
+        # oldest first, for expiry
+        self.created = OrderedDict()
+        # filters: {"ids": [entry id, ...], "matrix": their vectors, or None}
+        self.buckets = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _drop(self, entry_id):
+        # called with self.lock held
+        entry = self.entries.pop(entry_id)
+        del self.created[entry_id]
+        bucket = self.buckets[entry["filters"]]
+        bucket["ids"].remove(entry_id)
+        bucket["matrix"] = None
+        if not bucket["ids"]:
+            del self.buckets[entry["filters"]]
+
+    def _expire(self, now):
+        # called with self.lock held
+        while self.created:
+            entry_id, created = next(iter(self.created.items()))
+            if now - created <= self.ttl:
+                break
+            self._drop(entry_id)
+
+    def current_generations(self):
+        return self.generations.current() if self.generations else {}
+
+    def _stale(self, entry, generations):
+        changed = {
+            season
+            for season in set(generations) | set(entry["generations"])
+            if generations.get(season, 0) != entry["generations"].get(season, 0)
+        }
+        if not changed:
+            return False
+        season_codes = entry["filters"][0]
+        if not season_codes:
+            return True
+        seasons = set(season_codes)
+        seasons.update(
+            course.get("season_code") for course in entry["answer"]["courses"]
+        )
+        return bool(changed & seasons)
+
+    def get(self, query_vector, filters):
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        generations = self.current_generations()
+        with self.lock:
+            self._expire(time.time())
+            bucket = self.buckets.get(filters)
+            if bucket is not None:
+                if bucket["matrix"] is None:
+                    bucket["matrix"] = np.stack(
+                        [self.entries[entry_id]["vector"] for entry_id in bucket["ids"]]
+                    )
+                similarities = bucket["matrix"] @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id = bucket["ids"][best]
+                    if not self._stale(self.entries[entry_id], generations):
+                        self.entries.move_to_end(entry_id)
+                        self.hits += 1
+                        return self.entries[entry_id]["answer"]
+                    self._drop(entry_id)
+            self.misses += 1
+            return None
+
+    def put(self, query_vector, filters, answer, generations=None):
+        # generations: as read before the courses of the answer were searched,
+        # so a re-import during the turn still invalidates it
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        if generations is None:
+            generations = self.current_generations()
+        with self.lock:
+            entry_id = next(self.ids)
+            self.entries[entry_id] = {
+                "vector": vector,
+                "filters": filters,
+                "answer": answer,
+                "generations": generations,
+            }
+            self.created[entry_id] = time.time()
+            bucket = self.buckets.setdefault(filters, {"ids": [], "matrix": None})
+            bucket["ids"].append(entry_id)
+            bucket["matrix"] = None
+            while len(self.entries) > self.capacity:
+                self._drop(next(iter(self.entries)))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+            }
+
+
+class SeasonGenerations:
+    """How many times each season's courses were re-imported, as counted in
+    MongoDB by :func:`invalidate_seasons`, so that every worker sees it.
+
+    ``current()`` never waits on the database (the ASGI app calls it on the event
+    loop): it returns the counts last read, and once they are ``refresh_interval``
+    seconds old reads them again on a background thread. If that read fails, the
+    old counts are kept until the next one.
+    """
+
+    def __init__(self, collection, refresh_interval=5):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.generations = {}
+        self.fetched = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def current(self):
+        with self.lock:
+            due = (
+                self.fetched is None
+                or time.monotonic() - self.fetched >= self.refresh_interval
+            )
+            if due and not self.refreshing:
+                self.refreshing = True
+                threading.Thread(target=self.refresh, daemon=True).start()
+            return self.generations
+
+    def refresh(self):
+        try:
+            generations = {
+                document["_id"]: document["generation"]
+                for document in self.collection.find({})
+            }
+        except Exception as e:
+            print(f"Could not read answer cache generations: {e}")
+            generations = None
+        with self.lock:
+            if generations is not None:
+                self.generations = generations
+            self.fetched = time.monotonic()
+            self.refreshing = False
+
+
+def invalidate_seasons(collection, season_codes):
+    # called by whatever re-imports courses, after writing them
+    updates = [
+        UpdateOne({"_id": season_code}, {"$inc": {"generation": 1}}, upsert=True)
+        for season_code in sorted(set(season_codes))
+    ]
+    if updates:
+        collection.bulk_write(updates, ordered=False)
@@ -1,23 +1,81 @@
 from urllib.parse import urljoin
-from flask import Flask, request, jsonify, session, redirect, url_for
+from flask import Flask, Response, request, jsonify, session, redirect, url_for, g
 from flask_cors import CORS
 from flask_cas import CAS, login_required
 import os
 from dotenv import load_dotenv
-from lib import chat_completion_request, create_embedding, tools
+from lib import (
+    chat_completion_request,
+    chat_completion_stream,
+    create_embedding,
+    planner_tools,
+    tools,
+)
+from pipeline import StageExecutor
+from answer_cache import (
+    GENERATIONS_COLLECTION,
+    AnswerCache,
+    SeasonGenerations,
+    filter_key,
+)
+from courses import COURSE_CODE_PROJECTION, Course
+from course_details import DETAILS_COLLECTION, load_details
+from filter_rules import about_other_courses, extract_course_codes, extract_filters
+from history import HISTORY_BUDGETS, trim_history
+from summary import ChatSummarizer, stored_summary, with_summary
+from retrieval import AtlasRetriever, HybridRetriever, LocalRetriever
+from resilience import start_deadline
+from tracing import annotate, current_trace, span, start_trace
+import metrics
 import json
 from pymongo.mongo_client import MongoClient
+from http_clients import cas_session
 import requests
 import xml.etree.ElementTree as ET
 import datetime
+import time
+from functools import partial
 from uuid import uuid4
 
 COURSE_QUERY_LIMIT = 5
 SAFETY_CHECK_ENABLED = False
 DATABASE_RELEVANCY_CHECK_ENABLED = False
+# One QueryPlan tool call stands in for the safety check, relevancy check,
+# search query rewrite and CourseFilter calls (two LLM round trips per turn)
+QUERY_PLANNER_ENABLED = False
+CHAT_STAGE_WORKERS = 16
+# Filters filter_rules.py can read off the messages skip the CourseFilter call
+RULE_FILTERS_ENABLED = True
+# A message about the course codes it names gets those courses, looked up by
+# code, instead of the search query rewrite, embedding and vector search
+COURSE_CODE_LOOKUP_ENABLED = True
+ANSWER_CACHE_ENABLED = True
+# Seconds a chat turn may spend on OpenAI calls before it answers with the courses
+# it found and no completion (see resilience.py); None waits on OpenAI's timeouts
+CHAT_DEADLINE = 20
+# The final answer's own allowance, started once the courses are found: a long
+# answer may take longer than what is left of CHAT_DEADLINE
+FINAL_COMPLETION_DEADLINE = 60
+
+SAFETY_CHECK_PROMPT = (
+    'Am I asking for help with courses or academics? Answer "yes" or "no".'
+)
+DATABASE_RELEVANCY_CHECK_PROMPT = 'Will you be able to better answer my question with access to specific courses at Yale University? If you answer "yes", you will be provided with courses that are semantically similar to my question. Answer "yes" or "no".'
+SEARCH_QUERY_PROMPT = "What would be a good search query (in conventional english) to query against the Yale courses database that addresses the user needs?"
+QUERY_PLANNER_PROMPT = "Call QueryPlan for my latest message. Only provide filters for conditions I asked for. Don't make assumptions."
+SYSTEM_PROMPT = "Your name is Eli. You are a helpful assistant for Yale University students to ask questions about courses and academics."
+SAFETY_CHECK_REFUSAL = "I am sorry, but I can only assist with questions related to courses or academics at this time."
+PLAN_TOOL_CHOICE = {"type": "function", "function": {"name": "QueryPlan"}}
+DEGRADED_ANSWER = (
+    "I can't write a full answer right now, but these courses match your request:"
+)
+DEGRADED_NO_COURSES = (
+    "I'm sorry, I can't answer right now. Please try again in a minute."
+)
 
 load_dotenv()
 
+
 # Separate function to load configurations
 def load_config(app, test_config=None):
     app.secret_key = os.environ.get(
@@ -39,24 +97,563 @@ def load_config(app, test_config=None):
             DATABASE_RELEVANCY_CHECK_ENABLED = app.config[
                 "DATABASE_RELEVANCY_CHECK_ENABLED"
             ]
+        if "QUERY_PLANNER_ENABLED" in app.config:
+            global QUERY_PLANNER_ENABLED
+            QUERY_PLANNER_ENABLED = app.config["QUERY_PLANNER_ENABLED"]
+        if "RULE_FILTERS_ENABLED" in app.config:
+            global RULE_FILTERS_ENABLED
+            RULE_FILTERS_ENABLED = app.config["RULE_FILTERS_ENABLED"]
+        if "COURSE_CODE_LOOKUP_ENABLED" in app.config:
+            global COURSE_CODE_LOOKUP_ENABLED
+            COURSE_CODE_LOOKUP_ENABLED = app.config["COURSE_CODE_LOOKUP_ENABLED"]
+        if "ANSWER_CACHE_ENABLED" in app.config:
+            global ANSWER_CACHE_ENABLED
+            ANSWER_CACHE_ENABLED = app.config["ANSWER_CACHE_ENABLED"]
+        if "CHAT_DEADLINE" in app.config:
+            global CHAT_DEADLINE
+            CHAT_DEADLINE = app.config["CHAT_DEADLINE"]
+        if "FINAL_COMPLETION_DEADLINE" in app.config:
+            global FINAL_COMPLETION_DEADLINE
+            FINAL_COMPLETION_DEADLINE = app.config["FINAL_COMPLETION_DEADLINE"]
+        if "HISTORY_BUDGETS" in app.config:
+            global HISTORY_BUDGETS
+            HISTORY_BUDGETS = {**HISTORY_BUDGETS, **app.config["HISTORY_BUDGETS"]}
+        if "CHAT_STAGE_WORKERS" in app.config:
+            global CHAT_STAGE_WORKERS
+            CHAT_STAGE_WORKERS = app.config["CHAT_STAGE_WORKERS"]
         if "FLASK_SECRET_KEY" in app.config:
             app.secret_key = app.config["FLASK_SECRET_KEY"]
     else:
         # Load configuration from environment variables
         app.config["MONGO_URI"] = os.getenv("MONGO_URI")
+        app.config["RETRIEVER"] = os.getenv("RETRIEVER", "atlas")
+        app.config["EMBEDDING_STORE_PATH"] = os.getenv("EMBEDDING_STORE_PATH")
+        hybrid_search = os.getenv("HYBRID_SEARCH", "false").lower()
+        app.config["HYBRID_SEARCH"] = hybrid_search in ("1", "true", "yes")
+        # seconds a cached answer is served; the only way answers from before a
+        # course re-import leave every worker's cache
+        app.config["ANSWER_CACHE_TTL"] = int(os.getenv("ANSWER_CACHE_TTL", 3600))
 
 
 # Separate function to initialize database
 def init_database(app):
     if "MONGO_URI" in app.config:
-        client = MongoClient(app.config["MONGO_URI"])
+        client = MongoClient(
+            app.config["MONGO_URI"], event_listeners=[metrics.MongoCommandMetrics()]
+        )
         db = client["course_db"]
         app.config["courses"] = db["parsed_courses"]
         app.config["profiles"] = db["user_profile"]
+        app.config["course_details"] = db[DETAILS_COLLECTION]
+        app.config["answer_cache_generations"] = db[GENERATIONS_COLLECTION]
 
         # else, set to None or Mock in case of testing
 
 
+# Separate function to pick the course retriever: Atlas $vectorSearch by default,
+# or RETRIEVER="local" to search every course embedding in process; with
+# HYBRID_SEARCH, either is fused with BM25 over the course text
+def init_retriever(app):
+    if "courses" not in app.config:
+        return
+    if app.config.get("RETRIEVER", "atlas") == "local":
+        if app.config.get("EMBEDDING_STORE_PATH"):
+            # quantized vectors memory-mapped from disk, shared by all workers
+            app.config["retriever"] = LocalRetriever.from_store(
+                app.config["courses"], app.config["EMBEDDING_STORE_PATH"]
+            )
+        else:
+            app.config["retriever"] = LocalRetriever.from_collection(
+                app.config["courses"]
+            )
+    else:
+        app.config["retriever"] = AtlasRetriever(app.config["courses"])
+    if app.config.get("HYBRID_SEARCH"):
+        app.config["retriever"] = HybridRetriever.from_collection(
+            app.config["courses"], app.config["retriever"]
+        )
+
+
+# Rewrite the conversation into a search query and embed it for $vectorSearch
+def generate_search_query(vector_search_prompt_generation):
+    response = chat_completion_request(messages=vector_search_prompt_generation)
+    response = response.choices[0].message.content
+    annotate(search_query=response)
+
+    # the rewritten text is also what BM25 matches word for word
+    return response, create_embedding(response)
+
+
+# The steps of a chat turn that do no I/O, used by chat_turn below
+
+
+def start_chat_turn(data, summary=None):
+    """Cleans up the request's messages and builds the prompt of every stage.
+
+    With the chat's stored summary, the prompts carry the summary in place of the
+    messages it covers.
+    """
+    user_messages = data.get("message", None)
+
+    filter_season_codes = data.get(
+        "season_codes", None
+    )  # assume it is an array of season code
+    filter_subjects = data.get("subject", None)
+    filter_areas_and_skills = data.get("areas", None)
+    if filter_areas_and_skills:
+        filter_skills = [
+            area for area in filter_areas_and_skills if area in ["Hu", "So", "Sc"]
+        ]
+        filter_areas = [
+            area for area in filter_areas_and_skills if area in ["QR", "WR"]
+        ]
+    else:
+        filter_skills = None
+        filter_areas = None
+
+    # remove id before sending to OpenAI
+    for message in user_messages:
+        if "id" in message:
+            del message["id"]
+        if message["role"] == "ai":
+            message["role"] = "assistant"
+
+    # Each call gets the latest turns that fit in its token budget (see history.py).
+    # for safety check, not to be included in final response
+    user_messages_safety_check = trim_history(user_messages, HISTORY_BUDGETS["safety"])
+    user_messages_safety_check.append({"role": "user", "content": SAFETY_CHECK_PROMPT})
+
+    # adding system message if user message does not include a system message header
+    if user_messages[0]["role"] != "system":
+        user_messages.insert(0, {"role": "system", "content": SYSTEM_PROMPT})
+    context = with_summary(user_messages, summary)
+
+    # checking if database query is necessary
+    user_messages_database_relevancy_check = trim_history(
+        context, HISTORY_BUDGETS["relevancy"]
+    )
+    user_messages_database_relevancy_check.append(
+        {"role": "user", "content": DATABASE_RELEVANCY_CHECK_PROMPT}
+    )
+
+    # create embedding for user message to query against vector index
+    vector_search_prompt_generation = trim_history(
+        context, HISTORY_BUDGETS["search_query"]
+    )
+    vector_search_prompt_generation.append(
+        {"role": "system", "content": SEARCH_QUERY_PROMPT}
+    )
+
+    query_plan_prompt_generation = trim_history(context, HISTORY_BUDGETS["plan"])
+    query_plan_prompt_generation.append(
+        {"role": "system", "content": QUERY_PLANNER_PROMPT}
+    )
+
+    return {
+        "messages": user_messages,
+        "safety": user_messages_safety_check,
+        "relevancy": user_messages_database_relevancy_check,
+        "search_query": vector_search_prompt_generation,
+        "plan": query_plan_prompt_generation,
+        "filter": trim_history(context, HISTORY_BUDGETS["filter"]),
+        # the prompt of the final answer; recommend_courses appends the courses
+        "final": trim_history(context, HISTORY_BUDGETS["final"]),
+        "filters": {
+            "season_code": filter_season_codes,
+            "subject": filter_subjects,
+            "areas": filter_areas,
+            "skills": filter_skills,
+        },
+    }
+
+
+def course_code_request(turn):
+    """The course codes the latest message names and the seasons to look them up in.
+
+    None if it names no course. The seasons are the frontend's, else one written
+    in the message, else None for the latest offering.
+    """
+    if not COURSE_CODE_LOOKUP_ENABLED:
+        return None
+    latest = turn["messages"][-1]
+    course_codes = extract_course_codes(latest["content"])
+    if not course_codes:
+        return None
+    season_codes = turn["filters"]["season_code"]
+    if not season_codes:
+        season_code = (extract_filters([latest]) or {}).get("season_code")
+        season_codes = [season_code] if season_code else None
+    return course_codes, season_codes
+
+
+def course_code_turn(turn, course_codes, database_response):
+    # the courses asked about go straight into the recommendation prompt
+    annotate(outcome="course code", course_codes=course_codes)
+    recommended_courses = recommend_courses(turn["final"], database_response)
+    return {"messages": turn["final"], "courses": recommended_courses}
+
+
+def with_named_courses(named_courses, database_response):
+    # the courses a message names go ahead of the search results not among them
+    named = {course.id for course in named_courses}
+    found = [course for course in database_response if course.id not in named]
+    return (named_courses + found)[: max(COURSE_QUERY_LIMIT, len(named_courses))]
+
+
+def rule_filters(turn):
+    """The turn's filters as read by filter_rules, or None to ask CourseFilter."""
+    filters = extract_filters(turn["filter"]) if RULE_FILTERS_ENABLED else None
+    source = "llm" if filters is None else "rules"
+    metrics.FILTER_EXTRACTIONS.labels(source).inc()
+    annotate(filter_source=source)
+    return filters
+
+
+def passed_check(response):
+    # the safety and relevancy checks are answered "yes" or "no"
+    return "no" not in response.choices[0].message.content.lower()
+
+
+def tool_call_arguments(response):
+    if response.choices[0].message.tool_calls:
+        return json.loads(response.choices[0].message.tool_calls[0].function.arguments)
+    return None
+
+
+def resolve_course_filters(frontend_filters, filtered_data):
+    """Filters for the course retriever; a course matches if it matches all of them."""
+    filter_season_codes = frontend_filters["season_code"]
+    filter_subjects = frontend_filters["subject"]
+    filter_areas = frontend_filters["areas"]
+    filter_skills = None
+
+    # Check if filters were provided from the front end. If not,
+    # it checks if filters were provided from the chat completion request.
+    # This is due to the priority of frontend filters being higher than those from the request.
+    if not filter_subjects and filtered_data:
+        filter_subjects = filtered_data.get("subject", None)
+        if filter_subjects:
+            filter_subjects = [filter_subjects]
+
+    if not filter_season_codes and filtered_data:
+        filter_season_codes = filtered_data.get("season_code", None)
+        if filter_season_codes:
+            filter_season_codes = [filter_season_codes]
+
+    if not filter_areas and filtered_data:
+        filter_areas = filtered_data.get("areas", None)
+        if filter_areas:
+            filter_areas = [filter_areas]
+    # Remove this elif if a skills dropdown filter is added to the chat interface
+    elif filter_areas == "QR" or filter_areas == "WR":
+        filter_skills = filtered_data.get("areas", None)
+
+    if not filter_skills and filtered_data:
+        filter_skills = filtered_data.get("skills", None)
+        if filter_skills:
+            filter_skills = [filter_skills]
+
+    return {
+        "season_code": filter_season_codes,
+        "subject": filter_subjects,
+        "areas": filter_areas,
+        "skills": filter_skills,
+    }
+
+
+def answer_cache_key(user_messages, query_vector, course_filters):
+    # Near-duplicate first questions with the same filters get the answer
+    # already given, skipping the database and the final completion. Later
+    # turns depend on the conversation, so they are never cached.
+    user_turns = [message for message in user_messages if message["role"] == "user"]
+    if (
+        not ANSWER_CACHE_ENABLED
+        or len(user_turns) != 1
+        or not isinstance(query_vector, list)
+    ):
+        return None
+    return (
+        query_vector,
+        filter_key(
+            course_filters["season_code"],
+            course_filters["subject"],
+            course_filters["areas"],
+            course_filters["skills"],
+        ),
+    )
+
+
+def recommend_courses(user_messages, database_response):
+    """Appends the courses found to the prompt and returns them for the response."""
+    # Template for course data sent in the recommendation prompt
+
+    recommended_courses = [course.to_dict() for course in database_response]
+
+    if recommended_courses:
+        recommendation_prompt = (
+            "Here are some courses that might be relevant to the user request:\n\n"
+        )
+        for course in recommended_courses:
+            recommendation_prompt += f'{course["course_code"]}: {course["title"]}\n{course["description"]}\n\n'
+        recommendation_prompt += "Incorporate specific course information in your response to me if it is relevant to the user request. If you include any course titles, make sure to wrap it in **double asterisks**. Do not order them in a list. Do not refer to any courses not in this list"
+
+    # In the case that no courses are returned, prompt to provide a specific response to the user.
+    # Fixes the "As an AI, I can't provide..." response
+    else:
+        recommendation_prompt = "Apologize to the user for not being able to fullfill their request, your response should begin with 'I'm sorry. I tried to search for courses that match your criteria but couldn't find any' verbatim"
+        recommendation_prompt += "Also suggest that the user should try widening their search or removing filters."
+
+    user_messages.append({"role": "system", "content": recommendation_prompt})
+    return recommended_courses
+
+
+def degrade(stage, error):
+    # a stage failed or ran out of time; the turn goes on without it
+    print(f"Chat stage {stage} failed, continuing without it: {error!r}")
+    metrics.CHAT_DEGRADED.labels(stage).inc()
+    trace = current_trace.get()
+    if trace is not None:
+        trace.fields.setdefault("degraded", []).append(stage)
+
+
+def stage_result(run, name):
+    # the result of one of the turn's concurrent stages, None if it failed
+    try:
+        return (yield ("result", run, name))
+    except Exception as e:
+        degrade(name, e)
+        return None
+
+
+def degraded_answer(recommended_courses):
+    """The answer to a turn whose final completion failed: the courses, templated."""
+    if not recommended_courses:
+        return DEGRADED_NO_COURSES
+    answer = DEGRADED_ANSWER + "\n\n"
+    for course in recommended_courses:
+        # the first sentence of the description is enough to tell courses apart
+        summary = course["description"].split(". ")[0].rstrip(".")
+        answer += f'**{course["title"]}** ({course["course_code"]}): {summary}.\n\n'
+    return answer.strip()
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def chat_summary(profiles, data):
+    """The stored summary of the chat a turn belongs to, if the request names it."""
+    uid = data.get("uid", None)
+    chat_id = data.get("chat_id", None)
+    if profiles is None or not uid or not chat_id:
+        return None
+    try:
+        with span("summary"):
+            return stored_summary(profiles, uid, chat_id)
+    except Exception as e:
+        # the turn goes on with the full transcript
+        degrade("summary", e)
+        return None
+
+
+# The control flow of a chat turn, shared by create_app's routes and the async
+# app in asgi.py. chat_turn is a generator that yields every step that waits on
+# OpenAI, MongoDB or another thread, as ("kind", *args). Each app runs the step
+# its own way and sends the result back in, or throws the step's error in:
+#
+# - ("summary", data): the chat's stored summary (chat_summary)
+# - ("lookup", course_codes, season_codes, limit): retriever.lookup
+# - ("completion", kwargs): chat_completion_request(**kwargs)
+# - ("search_query", messages): generate_search_query
+# - ("embedding", text): create_embedding
+# - ("search", query_vector, filters, limit, query_text): retriever.search
+# - ("start", {name: step}): starts the steps at once, as the stages of a run
+# - ("result", run, name): waits for a stage of the run
+# - ("cancel", run): drops the stages of the run that haven't started
+
+
+def chat_turn(data, answer_cache):
+    """Everything in a chat turn up to the final recommendation completion.
+
+    Returns {"response", "courses"} when the turn is already answered, otherwise
+    {"messages", "courses"} with the prompt for the final completion.
+    """
+    summary = yield ("summary", data)
+    turn = start_chat_turn(data, summary)
+    user_messages = turn["messages"]
+
+    named_courses = []
+    lookup = course_code_request(turn)
+    if lookup:
+        try:
+            with span("lookup") as record:
+                named_courses = yield ("lookup", *lookup, COURSE_QUERY_LIMIT)
+                record["courses"] = len(named_courses)
+        except Exception as e:
+            degrade("lookup", e)
+            named_courses = []
+        metrics.count_course_code_lookup(bool(named_courses))
+    # A message about the courses it names is answered from them: it still goes
+    # through the checks, but skips the search query rewrite, the embedding and
+    # the search. Codes that match no course are searched for like any other
+    # message, and courses named only to ask for others ("what should I take
+    # after CPSC 201?") go ahead of the search results.
+    search = not named_courses or about_other_courses(user_messages[-1]["content"])
+    checks = SAFETY_CHECK_ENABLED or DATABASE_RELEVANCY_CHECK_ENABLED
+
+    if QUERY_PLANNER_ENABLED:
+        plan = {}
+        if search or checks:
+            # all of the pre-retrieval questions in one forced QueryPlan tool call
+            with span("plan"):
+                try:
+                    response = yield (
+                        "completion",
+                        dict(
+                            messages=turn["plan"],
+                            tools=planner_tools,
+                            tool_choice=PLAN_TOOL_CHOICE,
+                        ),
+                    )
+                    plan = tool_call_arguments(response) or {}
+                    annotate(plan=plan)
+                except Exception as e:
+                    degrade("plan", e)
+        run = None
+    else:
+        # None of these completions depend on each other, so they all start now
+        # and the slowest one sets the latency. The checks are joined first so a
+        # refused or database-free turn returns without waiting on the rest.
+        stages = {}
+        if SAFETY_CHECK_ENABLED:
+            stages["safety"] = ("completion", dict(messages=turn["safety"]))
+        if DATABASE_RELEVANCY_CHECK_ENABLED:
+            stages["relevancy"] = ("completion", dict(messages=turn["relevancy"]))
+        if search:
+            stages["search_query"] = ("search_query", turn["search_query"])
+            filters = rule_filters(turn)
+            if filters is None:
+                # Get a second response which uses function calling (defined in lib.py) to filter the user query
+                stages["filter"] = (
+                    "completion",
+                    dict(messages=turn["filter"], tools=tools),
+                )
+        run = yield ("start", stages)
+
+    if SAFETY_CHECK_ENABLED:
+        if run is None:
+            passed_safety_check = plan.get("on_topic", True)
+        else:
+            # a check that failed lets the turn through rather than fail it
+            safety = yield from stage_result(run, "safety")
+            passed_safety_check = safety is None or passed_check(safety)
+
+        if not passed_safety_check:
+            if run is not None:
+                yield ("cancel", run)
+            annotate(outcome="failed safety check")
+            return {"response": SAFETY_CHECK_REFUSAL, "courses": []}
+
+    if DATABASE_RELEVANCY_CHECK_ENABLED:
+        if run is None:
+            needs_database = plan.get("needs_courses", True)
+        else:
+            relevancy = yield from stage_result(run, "relevancy")
+            needs_database = relevancy is None or passed_check(relevancy)
+
+        if not needs_database:
+            if run is not None:
+                yield ("cancel", run)
+            annotate(outcome="no database query")
+            return {"messages": turn["final"], "courses": []}
+
+    if not search:
+        return course_code_turn(turn, lookup[0], named_courses)
+
+    if run is None:
+        # fall back to the user's own words if the plan has no query
+        search_query = plan.get("search_query") or user_messages[-1]["content"]
+        query_vector = None
+        filtered_data = plan.get("filters") or None
+    else:
+        rewritten = yield from stage_result(run, "search_query")
+        if rewritten is None:
+            # fall back to the user's own words if the rewrite failed
+            search_query, query_vector = user_messages[-1]["content"], None
+        else:
+            search_query, query_vector = rewritten
+        if "filter" in stages:
+            filter_response = yield from stage_result(run, "filter")
+            filtered_data = filter_response and tool_call_arguments(filter_response)
+        else:
+            filtered_data = filters
+
+    if query_vector is None:
+        try:
+            query_vector = yield ("embedding", search_query)
+        except Exception as e:
+            degrade("embedding", e)
+            return {
+                "response": DEGRADED_NO_COURSES,
+                "courses": [],
+                "degraded": True,
+            }
+
+    course_filters = resolve_course_filters(turn["filters"], filtered_data)
+    annotate(filters=course_filters)
+
+    # the named courses aren't part of the key, so those answers aren't cached
+    cache_key = None
+    if not named_courses:
+        cache_key = answer_cache_key(user_messages, query_vector, course_filters)
+    cache_generations = None
+    if cache_key:
+        # read before the search, for the answer to be cached with
+        cache_generations = answer_cache.current_generations()
+        cached_answer = answer_cache.get(*cache_key)
+        metrics.count_cache_lookup("answer", cached_answer is not None)
+        if cached_answer:
+            annotate(outcome="answer cache")
+            return cached_answer
+
+    # Get a response from the database
+    with span("aggregate") as record:
+        database_response = yield (
+            "search",
+            query_vector,
+            course_filters,
+            COURSE_QUERY_LIMIT,
+            search_query,
+        )
+        record["courses"] = len(database_response)
+    if named_courses:
+        annotate(course_codes=lookup[0])
+        database_response = with_named_courses(named_courses, database_response)
+
+    recommended_courses = recommend_courses(turn["final"], database_response)
+
+    return {
+        "messages": turn["final"],
+        "courses": recommended_courses,
+        "cache_key": cache_key,
+        "cache_generations": cache_generations,
+    }
+
+
+def drive(steps, run_step):
+    """Runs a chat_turn generator to its end, doing each step with run_step."""
+    result = error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = run_step(step), None
+        except Exception as e:
+            result, error = None, e
+
+
 def create_app(test_config=None):
     app = Flask(__name__)
     CORS(app)
@@ -65,6 +662,80 @@ def create_app(test_config=None):
 
     load_config(app, test_config)
     init_database(app)
+    init_retriever(app)
+    stage_executor = StageExecutor(max_workers=CHAT_STAGE_WORKERS)
+    # keeps the TLS connection to secure.its.yale.edu open between logins
+    cas_http = cas_session()
+    # refreshes chat summaries after append_message, off the request path
+    chat_summarizer = ChatSummarizer(
+        max_workers=app.config.get("CHAT_SUMMARY_WORKERS", 2)
+    )
+    app.config["chat_summarizer"] = chat_summarizer
+    # re-imports are counted in MongoDB, so every worker drops the answers
+    # they make stale
+    generations = None
+    if app.config.get("answer_cache_generations") is not None:
+        generations = SeasonGenerations(app.config["answer_cache_generations"])
+    answer_cache = AnswerCache(
+        threshold=app.config.get("ANSWER_CACHE_THRESHOLD", 0.95),
+        ttl=app.config.get("ANSWER_CACHE_TTL", 3600),
+        capacity=app.config.get("ANSWER_CACHE_CAPACITY", 1000),
+        generations=generations,
+    )
+    app.config["answer_cache"] = answer_cache
+
+    # Every request is traced: its spans go out as a Server-Timing header and,
+    # once the response is done, as one JSON log line
+    @app.before_request
+    def trace_request():
+        start_trace()
+
+    @app.after_request
+    def report_trace(response):
+        trace = current_trace.get()
+        if trace is None:
+            return response
+        fields = dict(
+            method=request.method, path=request.path, status=response.status_code
+        )
+        if response.is_streamed:
+            # the spans of a stream are recorded after the headers are sent
+            response.call_on_close(lambda: trace.log(**fields))
+        else:
+            response.headers["Server-Timing"] = trace.server_timing()
+            trace.log(**fields)
+        return response
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_start = time.perf_counter()
+        metrics.HTTP_IN_FLIGHT.inc()
+
+    @app.after_request
+    def count_request(response):
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.HTTP_REQUESTS.labels(route, request.method, response.status_code).inc()
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exception=None):
+        if "request_start" not in g:
+            return
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.HTTP_LATENCY.labels(route, request.method).observe(
+            time.perf_counter() - g.request_start
+        )
+        metrics.HTTP_IN_FLIGHT.dec()
+
+    @app.teardown_request
+    def clear_deadline(exception=None):
+        # a chat turn's deadline must not carry over to the thread's next request
+        start_deadline(None)
+
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        body, content_type = metrics.exposition()
+        return Response(body, content_type=content_type)
 
     # Define your routes here
     @app.route("/login", methods=["GET"])
@@ -94,7 +765,13 @@ def create_app(test_config=None):
 
         cas_validate_url = "https://secure.its.yale.edu/cas/serviceValidate"
         params = {"ticket": ticket, "service": service_url}
-        response = requests.get(cas_validate_url, params=params)
+        with span("cas_validate"):
+            try:
+                response = cas_http.get(cas_validate_url, params=params)
+            except requests.exceptions.RequestException as e:
+                # timed out or unreachable; see CAS_*_TIMEOUT in http_clients.py
+                print(f"CAS validation failed: {e}")
+                return jsonify({"isAuthenticated": False}), 503
 
         if response.status_code == 200:
             # Parse the XML response
@@ -150,15 +827,16 @@ def create_app(test_config=None):
             course_code = data["search"]
             course_collection = app.config["courses"]
             user_collection = app.config["profiles"]
-            course = course_collection.find_one({"course_code": course_code})
+            course = course_collection.find_one(
+                {"course_code": course_code}, COURSE_CODE_PROJECTION
+            )
             if course:
+                course = Course.from_document(course)
                 # insert into database
                 # result = user_collection.update_one(
                 #     {"uid": uid}, {"$addToSet": {"courses": course_code}}
                 # )
-                return jsonify(
-                    {"status": "success", "course": course["course_code"]}
-                ), 200
+                return jsonify({"status": "success", "course": course.course_code}), 200
             else:
                 return jsonify({"status": "invalid course code"}), 404
         except Exception as e:
@@ -176,20 +854,41 @@ def create_app(test_config=None):
             course_code = data["search"]
             course_collection = app.config["courses"]
             user_collection = app.config["profiles"]
-            course = course_collection.find_one({"course_code": course_code})
+            course = course_collection.find_one(
+                {"course_code": course_code}, COURSE_CODE_PROJECTION
+            )
             if course:
+                course = Course.from_document(course)
                 # insert into database
                 result = user_collection.update_one(
                     {"uid": uid}, {"$pull": {"courses": course_code}}
                 )
-                return jsonify(
-                    {"status": "success", "course": course["course_code"]}
-                ), 200
+                return jsonify({"status": "success", "course": course.course_code}), 200
             else:
                 return jsonify({"status": "invalid course code"}), 404
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)}), 500
 
+    @app.route("/api/course/details", methods=["POST"])
+    def course_details():
+        # the ratings and per-comment sentiment of one course, kept out of
+        # parsed_courses and read only when asked for
+        data = request.get_json()
+        season_code = data.get("season_code")
+        course_code = data.get("course_code")
+        if not season_code or not course_code:
+            return jsonify({"error": "No season_code or course_code provided"}), 400
+
+        try:
+            details = load_details(
+                app.config["course_details"], season_code, course_code
+            )
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)}), 500
+        if details is None:
+            return jsonify({"status": "no details found"}), 404
+        return jsonify({"status": "success", "details": details})
+
     # must only call after checking if the user exists
     @app.route("/api/user/create", methods=["POST"])
     def create_user_profile():
@@ -266,7 +965,7 @@ def create_app(test_config=None):
         result = collection.update_one(
             {"uid": uid}, {"$push": {"chat_history": new_chat}}
         )
-        return jsonify({"status": "success"}), 200
+        return jsonify({"status": "success", "chat_id": chat_id}), 200
 
     @app.route("/api/chat/append_message", methods=["POST"])
     def append_message_to_chat():
@@ -282,19 +981,18 @@ def create_app(test_config=None):
             return jsonify({"error": "No chat_id provided"})
 
         collection = app.config["profiles"]
-        # find the user with the chat id
-        user_profile = collection.find_one({"uid": uid})
-        if not user_profile:
-            return jsonify({"error": "No user profile found"}), 404
-        # update the selected chat by appending the message
-        for chat in user_profile["chat_history"]:
-            if chat["chat_id"] == chat_id:
-                chat["messages"].append(message)
-                break
-
+        # push the message onto the selected chat on the server, in one atomic
+        # update: nothing is read back, and appends from two tabs at once both land
         result = collection.update_one(
-            {"uid": uid}, {"$set": {"chat_history": user_profile["chat_history"]}}
+            {"uid": uid},
+            {"$push": {"chat_history.$[chat].messages": message}},
+            array_filters=[{"chat.chat_id": chat_id}],
         )
+        if result.matched_count == 0:
+            return jsonify({"error": "No user profile found"}), 404
+        # an unknown chat_id matches no chat and appends nothing
+        if result.modified_count:
+            chat_summarizer.schedule(collection, uid, chat_id)
         return jsonify({"status": "success"}), 200
 
     @app.route("/api/chat/delete_chat", methods=["POST"])
@@ -318,7 +1016,7 @@ def create_app(test_config=None):
     def get_chat_history_slug():
         data = request.get_json()
         user_messages = data.get("message", None)
-        user_messages_ = user_messages.copy()
+        user_messages_ = trim_history(user_messages, HISTORY_BUDGETS["slug"])
         user_messages_.append(
             {
                 "role": "user",
@@ -333,244 +1031,80 @@ def create_app(test_config=None):
         except:
             return jsonify({"slug": "Untitled"})
 
-    @app.route("/api/chat", methods=["POST"])
-    def chat():
-        data = request.get_json()
-        user_messages = data.get("message", None)
-
-        filter_season_codes = data.get(
-            "season_codes", None
-        )  # assume it is an array of season code
-        filter_subjects = data.get("subject", None)
-        filter_areas_and_skills = data.get("areas", None)
-        if filter_areas_and_skills:
-            filter_skills = [
-                area for area in filter_areas_and_skills if area in ["Hu", "So", "Sc"]
-            ]
-            filter_areas = [
-                area for area in filter_areas_and_skills if area in ["QR", "WR"]
-            ]
-        else:
-            filter_skills = None
-            filter_areas = None
-
-        if not user_messages:
-            return jsonify({"error": "No message provided"})
-
-        # remove id before sending to OpenAI
-        for message in user_messages:
-            if "id" in message:
-                del message["id"]
-            if message["role"] == "ai":
-                message["role"] = "assistant"
-
-        # print(user_messages)
+    # Runs the steps chat_turn yields: blocking calls, and the concurrent stages
+    # on the shared stage_executor. The calls are looked up as each step runs,
+    # so tests can patch them.
+    def search(query_vector, filters, limit, query_text):
+        return app.config["retriever"].search(
+            query_vector, filters, limit, query_text=query_text
+        )
 
-        if SAFETY_CHECK_ENABLED:
-            # for safety check, not to be included in final response
-            user_messages_safety_check = user_messages.copy()
-            user_messages_safety_check.append(
-                {
-                    "role": "user",
-                    "content": 'Am I asking for help with courses or academics? Answer "yes" or "no".',
-                }
+    turn_steps = {
+        "summary": lambda data: chat_summary(app.config.get("profiles"), data),
+        "lookup": lambda *args: app.config["retriever"].lookup(*args),
+        "completion": lambda kwargs: chat_completion_request(**kwargs),
+        "search_query": lambda messages: generate_search_query(messages),
+        "embedding": lambda text: create_embedding(text),
+        "search": search,
+    }
+
+    def run_step(step):
+        kind, *args = step
+        if kind == "start":
+            (stages,) = args
+            return stage_executor.run(
+                {name: partial(run_step, stage) for name, stage in stages.items()}
             )
+        if kind == "result":
+            run, name = args
+            return run.result(name)
+        if kind == "cancel":
+            (run,) = args
+            return run.cancel()
+        return turn_steps[kind](*args)
 
-            response_safety_check = chat_completion_request(
-                messages=user_messages_safety_check
-            )
-            response_safety_check = response_safety_check.choices[0].message.content
+    def prepare_chat_turn(data):
+        return drive(chat_turn(data, answer_cache), run_step)
 
-            if "no" in response_safety_check.lower():
-                response = "I am sorry, but I can only assist with questions related to courses or academics at this time."
-                json_response = {"response": response, "courses": []}
-                print("failed safety check")
-                return jsonify(json_response)
-            else:
-                print("passed safety check")
+    @app.route("/api/chat", methods=["POST"])
+    def chat():
+        data = request.get_json()
+        if not data.get("message", None):
+            return jsonify({"error": "No message provided"})
 
-        # adding system message if user message does not include a system message header
-        if user_messages[0]["role"] != "system":
-            user_messages.insert(
-                0,
-                {
-                    "role": "system",
-                    "content": "Your name is Eli. You are a helpful assistant for Yale University students to ask questions about courses and academics.",
-                },
-            )
+        start_deadline(CHAT_DEADLINE)
+        turn = prepare_chat_turn(data)
+        if "response" in turn:
+            return jsonify(turn)
 
-        if DATABASE_RELEVANCY_CHECK_ENABLED:
-            # checking if database query is necessary
-            user_messages_database_relevancy_check = user_messages.copy()
-            user_messages_database_relevancy_check.append(
+        start_deadline(FINAL_COMPLETION_DEADLINE)
+        try:
+            with span("final"):
+                response = chat_completion_request(messages=turn["messages"])
+        except Exception as e:
+            # answer with the courses that were found rather than an error
+            degrade("final", e)
+            return jsonify(
                 {
-                    "role": "user",
-                    "content": 'Will you be able to better answer my question with access to specific courses at Yale University? If you answer "yes", you will be provided with courses that are semantically similar to my question. Answer "yes" or "no".',
+                    "response": degraded_answer(turn["courses"]),
+                    "courses": turn["courses"],
+                    "degraded": True,
                 }
             )
 
-            user_messages_database_relevancy_check = chat_completion_request(
-                messages=user_messages_database_relevancy_check
-            )
-            response_user_messages_database_relevancy_check = (
-                user_messages_database_relevancy_check.choices[0].message.content
-            )
-
-            if "no" in response_user_messages_database_relevancy_check.lower():
-                response = chat_completion_request(messages=user_messages)
-                response = response.choices[0].message.content
-                json_response = {"response": response, "courses": []}
-                print("no need to query database for course information")
-                return jsonify(json_response)
-            else:
-                print("need to query database for course information")
-
-        # create embedding for user message to query against vector index
-        vector_search_prompt_generation = user_messages.copy()
-        vector_search_prompt_generation.append(
-            {
-                "role": "system",
-                "content": "What would be a good search query (in conventional english) to query against the Yale courses database that addresses the user needs?",
-            }
-        )
-
-        print(vector_search_prompt_generation)
-        response = chat_completion_request(messages=vector_search_prompt_generation)
-        response = response.choices[0].message.content
-        print("")
-        print("Completion Request: Vector Search Prompt")
-        print(response)
-        print("")
-
-        query_vector = create_embedding(response)
-
-        collection = app.config["courses"]
-
-        # To be sent to database
-        aggregate_pipeline = {
-            "$vectorSearch": {
-                "index": "parsed_courses_title_description_index",
-                "path": "embedding",
-                "queryVector": query_vector,
-                "numCandidates": 30,
-                "limit": COURSE_QUERY_LIMIT,
-            }
-        }
-
-        # Get a second response which uses function calling (defined in lib.py) to filter the user query
-        filtered_response = chat_completion_request(messages=user_messages, tools=tools)
-        if filtered_response.choices[0].message.tool_calls:
-            filtered_data = json.loads(
-                filtered_response.choices[0].message.tool_calls[0].function.arguments
-            )
-        else:
-            filtered_data = None
-
-        # print("")
-        # print("Completion Request: Filtered Response")
-        # print(filtered_data)
-        # print("")
-
-        filter_skills = None
-
-        # Check if filters were provided from the front end. If not,
-        # it checks if filters were provided from the chat completion request.
-        # This is due to the priority of frontend filters being higher than those from the request.
-        if not filter_subjects and filtered_data:
-            filter_subjects = filtered_data.get("subject", None)
-            if filter_subjects:
-                filter_subjects = [filter_subjects]
-
-        if not filter_season_codes and filtered_data:
-            filter_season_codes = filtered_data.get("season_code", None)
-            if filter_season_codes:
-                filter_season_codes = [filter_season_codes]
-
-        if not filter_areas and filtered_data:
-            filter_areas = filtered_data.get("areas", None)
-            if filter_areas:
-                filter_areas = [filter_areas]
-        # Remove this elif if a skills dropdown filter is added to the chat interface
-        elif filter_areas == "QR" or filter_areas == "WR":
-            filter_skills = filtered_data.get("areas", None)
-
-        if not filter_skills and filtered_data:
-            filter_skills = filtered_data.get("skills", None)
-            if filter_skills:
-                filter_skills = [filter_skills]
-
-        filters = []
-
-        # Append the above filters to a list which can be inserted into the aggregate pipeline
-        # Filter season codes
-        if filter_season_codes:
-            filters.append({"season_code": {"$in": filter_season_codes}})
-
-        # Filter subject
-        if filter_subjects:
-            filters.append({"subject": {"$in": filter_subjects}})
-
-        # Filter areas
-        if filter_areas:
-            filters.append({"areas": {"$in": filter_areas}})
-        # Filter skills
-        if filter_skills:
-            filters.append({"skills": {"$in": filter_skills}})
-
-        # If there are any filters, add them to the vectorSearch pipeline
-        if filters:
-            aggregate_pipeline["$vectorSearch"]["filter"] = {"$and": filters}
-
-        print()
-        print("Filters:")
-        print(aggregate_pipeline["$vectorSearch"]["filter"])
-        print()
-        # print(aggregate_pipeline)
-
-        # Get a response from the database
-        database_response = collection.aggregate([aggregate_pipeline])
-        database_response = list(database_response)
-
-        # Template for course data sent in the recommendation prompt
-
-        recommended_courses = [
-            {
-                "season_code": course["season_code"],
-                "course_code": course["course_code"],
-                "title": course["title"],
-                "description": course["description"],
-                "areas": course["areas"],
-                "sentiment_label": course["sentiment_info"]["final_label"],
-                "sentiment_score": course["sentiment_info"]["final_proportion"],
-            }
-            for course in database_response
-        ]
-
-        if recommended_courses:
-            recommendation_prompt = (
-                "Here are some courses that might be relevant to the user request:\n\n"
-            )
-            for course in recommended_courses:
-                recommendation_prompt += f'{course["course_code"]}: {course["title"]}\n{course["description"]}\n\n'
-            recommendation_prompt += "Incorporate specific course information in your response to me if it is relevant to the user request. If you include any course titles, make sure to wrap it in **double asterisks**. Do not order them in a list. Do not refer to any courses not in this list"
-
-        # In the case that no courses are returned, prompt to provide a specific response to the user.
-        # Fixes the "As an AI, I can't provide..." response
-        else:
-            recommendation_prompt = "Apologize to the user for not being able to fullfill their request, your response should begin with 'I'm sorry. I tried to search for courses that match your criteria but couldn't find any' verbatim"
-            recommendation_prompt += "Also suggest that the user should try widening their search or removing filters."
-
-        user_messages.append({"role": "system", "content": recommendation_prompt})
-
-        response = chat_completion_request(messages=user_messages)
-
         response = response.choices[0].message.content
 
         # print()
-        # print(user_messages)
+        # print(turn["messages"])
         # print(response)
 
-        json_response = {"response": response, "courses": recommended_courses}
+        json_response = {"response": response, "courses": turn["courses"]}
+        if turn.get("cache_key"):
+            answer_cache.put(
+                *turn["cache_key"],
+                json_response,
+                generations=turn["cache_generations"],
+            )
 
         # print("")
         # print("Completion Request: Recommendation")
@@ -579,6 +1113,68 @@ def create_app(test_config=None):
 
         return jsonify(json_response)
 
+    # Same turn as /api/chat, sent as server-sent events: "courses" as soon as the
+    # courses are retrieved, a "token" per piece of the answer, then "done" with
+    # the full answer (or "error" if the turn failed after the stream started)
+    @app.route("/api/chat/stream", methods=["POST"])
+    def chat_stream():
+        data = request.get_json()
+        if not data.get("message", None):
+            return jsonify({"error": "No message provided"})
+
+        trace = current_trace.get()
+
+        def events():
+            # the body may be iterated outside of the request's context
+            current_trace.set(trace)
+            start_deadline(CHAT_DEADLINE)
+            # flush the headers right away so clients see the stream open
+            yield ": stream opened\n\n"
+            try:
+                turn = prepare_chat_turn(data)
+                yield sse_event("courses", turn["courses"])
+
+                degraded = turn.get("degraded", False)
+                if "response" in turn:
+                    response = turn["response"]
+                    yield sse_event("token", {"content": response})
+                else:
+                    response = ""
+                    start_deadline(FINAL_COMPLETION_DEADLINE)
+                    try:
+                        for token in chat_completion_stream(messages=turn["messages"]):
+                            response += token
+                            yield sse_event("token", {"content": token})
+                    except Exception as e:
+                        if response:
+                            # tokens already sent can't be taken back
+                            raise
+                        degrade("final", e)
+                        degraded = True
+                        response = degraded_answer(turn["courses"])
+                        yield sse_event("token", {"content": response})
+
+                if turn.get("cache_key") and not degraded:
+                    answer_cache.put(
+                        *turn["cache_key"],
+                        {"response": response, "courses": turn["courses"]},
+                        generations=turn["cache_generations"],
+                    )
+                done = {"response": response}
+                if degraded:
+                    done["degraded"] = True
+                yield sse_event("done", done)
+            except Exception as e:
+                yield sse_event("error", {"status": "error", "message": str(e)})
+            finally:
+                start_deadline(None)
+
+        return Response(
+            events(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     return app
 
 
@@ -0,0 +1,287 @@
+"""
+The chat routes of create_app() served from an event loop, for uvicorn.
+
+Under gunicorn every chat turn holds a worker thread for the seconds its OpenAI
+calls take, so a worker serves as many turns at once as it has threads. Here
+/api/chat and /api/chat/stream are coroutines: OpenAI is called through
+AsyncOpenAI and Atlas through motor, so a single process keeps hundreds of turns
+in flight. They take and return exactly what the Flask routes do. Every other
+route (CAS, profiles, chat history, /metrics) is the Flask app's own, mounted
+behind an ASGI-to-WSGI adapter that runs it on a thread pool.
+
+Usage (from the backend directory):
+    uvicorn asgi:create_asgi_app --factory --port 8000
+"""
+
+import asyncio
+import time
+from contextvars import copy_context
+
+from a2wsgi import WSGIMiddleware
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as app_module
+import metrics
+from app import (
+    chat_summary,
+    chat_turn,
+    create_app,
+    degrade,
+    degraded_answer,
+    sse_event,
+)
+from lib import (
+    chat_completion_request_async,
+    chat_completion_stream_async,
+    create_embedding_async,
+)
+from resilience import start_deadline
+from retrieval import AtlasRetriever, HybridRetriever
+from tracing import annotate, span, start_trace
+
+
+# Separate function to give the Atlas retriever a motor collection; the routes
+# left to Flask keep using pymongo
+def init_async_database(flask_app):
+    retriever = flask_app.config.get("retriever")
+    if isinstance(retriever, HybridRetriever):
+        retriever = retriever.retriever
+    if "MONGO_URI" in flask_app.config and isinstance(retriever, AtlasRetriever):
+        client = AsyncIOMotorClient(
+            flask_app.config["MONGO_URI"],
+            event_listeners=[metrics.MongoCommandMetrics()],
+        )
+        retriever.async_collection = client["course_db"]["parsed_courses"]
+
+
+async def generate_search_query(vector_search_prompt_generation):
+    response = await chat_completion_request_async(
+        messages=vector_search_prompt_generation
+    )
+    response = response.choices[0].message.content
+    annotate(search_query=response)
+
+    return response, await create_embedding_async(response)
+
+
+async def timed(name, stage):
+    with span(name):
+        return await stage
+
+
+def observed(route, endpoint):
+    """Traces, counts and adds CORS headers the way create_app's hooks do."""
+
+    async def handler(request):
+        trace = start_trace()
+        start = time.perf_counter()
+        metrics.HTTP_IN_FLIGHT.inc()
+        status = 500
+        try:
+            response = await endpoint(request)
+            status = response.status_code
+        finally:
+            metrics.HTTP_REQUESTS.labels(route, request.method, status).inc()
+            metrics.HTTP_LATENCY.labels(route, request.method).observe(
+                time.perf_counter() - start
+            )
+            metrics.HTTP_IN_FLIGHT.dec()
+
+        fields = dict(method=request.method, path=request.url.path, status=status)
+        if isinstance(response, StreamingResponse):
+            # the spans of a stream are recorded after the headers are sent
+            response.background = BackgroundTask(trace.log, **fields)
+        else:
+            response.headers["Server-Timing"] = trace.server_timing()
+            trace.log(**fields)
+
+        # flask_cors allows every origin; preflight requests go to Flask itself
+        if "origin" in request.headers:
+            response.headers["Access-Control-Allow-Origin"] = request.headers["origin"]
+            response.headers["Vary"] = "Origin"
+        return response
+
+    return handler
+
+
+def retrieve_exception(task):
+    if not task.cancelled():
+        task.exception()
+
+
+def create_asgi_app(test_config=None):
+    flask_app = create_app(test_config)
+    init_async_database(flask_app)
+    answer_cache = flask_app.config["answer_cache"]
+
+    async def in_thread(function, *args):
+        # pymongo calls (the profiles collection, LocalRetriever) block
+        return await asyncio.get_running_loop().run_in_executor(
+            None, copy_context().run, function, *args
+        )
+
+    async def search(query_vector, filters, limit, query_text):
+        return await flask_app.config["retriever"].search_async(
+            query_vector, filters, limit, query_text=query_text
+        )
+
+    # The steps chat_turn yields, awaited instead of blocking; the stages of a
+    # run are tasks on the event loop
+    turn_steps = {
+        "summary": lambda data: in_thread(
+            chat_summary, flask_app.config.get("profiles"), data
+        ),
+        "lookup": lambda *args: flask_app.config["retriever"].lookup_async(*args),
+        "completion": lambda kwargs: chat_completion_request_async(**kwargs),
+        "search_query": lambda messages: generate_search_query(messages),
+        "embedding": lambda text: create_embedding_async(text),
+        "search": search,
+    }
+
+    async def run_step(step):
+        kind, *args = step
+        if kind == "start":
+            (stages,) = args
+            run = {
+                name: asyncio.ensure_future(timed(name, run_step(stage)))
+                for name, stage in stages.items()
+            }
+            for task in run.values():
+                # a stage the turn never waits for may still fail; its error is
+                # read here so asyncio doesn't log it as never retrieved
+                task.add_done_callback(retrieve_exception)
+            return run
+        if kind == "result":
+            run, name = args
+            return await run[name]
+        if kind == "cancel":
+            (run,) = args
+            for task in run.values():
+                task.cancel()
+            await asyncio.gather(*run.values(), return_exceptions=True)
+            return None
+        return await turn_steps[kind](*args)
+
+    async def prepare_chat_turn(data):
+        # drive() of app.py, awaiting each step
+        steps = chat_turn(data, answer_cache)
+        result = error = None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await run_step(step), None
+            except Exception as e:
+                result, error = None, e
+
+    async def chat(request):
+        data = await request.json()
+        if not data.get("message", None):
+            return JSONResponse({"error": "No message provided"})
+
+        start_deadline(app_module.CHAT_DEADLINE)
+        turn = await prepare_chat_turn(data)
+        if "response" in turn:
+            return JSONResponse(turn)
+
+        start_deadline(app_module.FINAL_COMPLETION_DEADLINE)
+        try:
+            with span("final"):
+                response = await chat_completion_request_async(
+                    messages=turn["messages"]
+                )
+        except Exception as e:
+            degrade("final", e)
+            return JSONResponse(
+                {
+                    "response": degraded_answer(turn["courses"]),
+                    "courses": turn["courses"],
+                    "degraded": True,
+                }
+            )
+
+        response = response.choices[0].message.content
+
+        json_response = {"response": response, "courses": turn["courses"]}
+        if turn.get("cache_key"):
+            answer_cache.put(
+                *turn["cache_key"],
+                json_response,
+                generations=turn["cache_generations"],
+            )
+
+        return JSONResponse(json_response)
+
+    async def chat_stream(request):
+        data = await request.json()
+        if not data.get("message", None):
+            return JSONResponse({"error": "No message provided"})
+
+        async def events():
+            start_deadline(app_module.CHAT_DEADLINE)
+            yield ": stream opened\n\n"
+            try:
+                turn = await prepare_chat_turn(data)
+                yield sse_event("courses", turn["courses"])
+
+                degraded = turn.get("degraded", False)
+                if "response" in turn:
+                    response = turn["response"]
+                    yield sse_event("token", {"content": response})
+                else:
+                    response = ""
+                    start_deadline(app_module.FINAL_COMPLETION_DEADLINE)
+                    try:
+                        async for token in chat_completion_stream_async(
+                            messages=turn["messages"]
+                        ):
+                            response += token
+                            yield sse_event("token", {"content": token})
+                    except Exception as e:
+                        if response:
+                            raise
+                        degrade("final", e)
+                        degraded = True
+                        response = degraded_answer(turn["courses"])
+                        yield sse_event("token", {"content": response})
+
+                if turn.get("cache_key") and not degraded:
+                    answer_cache.put(
+                        *turn["cache_key"],
+                        {"response": response, "courses": turn["courses"]},
+                        generations=turn["cache_generations"],
+                    )
+                done = {"response": response}
+                if degraded:
+                    done["degraded"] = True
+                yield sse_event("done", done)
+            except Exception as e:
+                yield sse_event("error", {"status": "error", "message": str(e)})
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    # Any other method on these paths (the CORS preflight included) falls
+    # through to the Flask app, as do all other paths
+    asgi_app = Starlette(
+        routes=[
+            Route("/api/chat", observed("/api/chat", chat), methods=["POST"]),
+            Route(
+                "/api/chat/stream",
+                observed("/api/chat/stream", chat_stream),
+                methods=["POST"],
+            ),
+            Mount("/", app=WSGIMiddleware(flask_app)),
+        ]
+    )
+    asgi_app.state.flask_app = flask_app
+    return asgi_app
@@ -0,0 +1,329 @@
+"""
+End-to-end /api/chat benchmark with a per-stage latency breakdown.
+
+Drives the real create_app() stack with a corpus of conversations, at a configurable
+concurrency, against stand-in backends:
+- LLM and embeddings: fake_openai.py served on a local port, with lognormal latency
+- courses: a synthetic catalog searched by the local retriever, with an optional
+  delay in front of every search to stand in for the Atlas round trip
+
+Every call into a stage is timed: safety, relevancy, rewrite, embedding, filter (the
+CourseFilter tool call), plan (QueryPlan, with --planner), aggregate (the retriever
+search), final (the recommendation completion) and serialization (jsonify). The
+p50/p95/p99 of each stage and of the whole request are printed and written to a
+JSON file; pass a previous result file as --compare to see what changed.
+
+The corpus is JSON lines, one /api/chat request body per line, optionally with an
+"id". Each request is replayed in order, cycling through the corpus.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_chat --concurrency 8 --requests 200 --chat_latency_ms 800 --chat_latency_sigma 0.5
+    python -m benchmarks.bench_chat --safety --relevancy --compare data/benchmarks/chat.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+# lib.py builds its OpenAI client at import time
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+from openai import OpenAI
+from werkzeug.serving import make_server
+
+import app as app_module
+import lib
+import tracing
+from build_course_embeddings import fake_embed, text_to_embed
+from embedding_cache import EmbeddingCache
+from fake_openai import Latency, create_fake_openai_app
+from http_clients import OPENAI_TIMEOUT, openai_http_client
+from retrieval import LocalRetriever
+
+STAGES = [
+    "safety",
+    "relevancy",
+    "rewrite",
+    "embedding",
+    "filter",
+    "plan",
+    "aggregate",
+    "final",
+    "serialization",
+]
+CORPUS_PATH = Path(__file__).resolve().parent / "conversations.jsonl"
+SUBJECTS = ["CPSC", "ECON", "ENGL", "HIST", "MATH", "PSYC", "PLSC", "S&DS"]
+SEASON_CODES = ["202401", "202403"]
+AREAS = {"CPSC": "Sc", "MATH": "Sc", "S&DS": "Sc", "ENGL": "Hu", "HIST": "Hu"}
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, function, stage):
+        # stage is a name, or a function of the call's arguments returning one
+        def timed(*args, **kwargs):
+            name = stage(*args, **kwargs) if callable(stage) else stage
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+        return timed
+
+
+def completion_stage(messages, tools=None, **kwargs):
+    if tools is lib.planner_tools:
+        return "plan"
+    if tools:
+        return "filter"
+    prompt = messages[-1]["content"]
+    if prompt == app_module.SAFETY_CHECK_PROMPT:
+        return "safety"
+    if prompt == app_module.DATABASE_RELEVANCY_CHECK_PROMPT:
+        return "relevancy"
+    if prompt == app_module.SEARCH_QUERY_PROMPT:
+        return "rewrite"
+    return "final"
+
+
+class LatencyRetriever:
+    # stands in for the network hop of Atlas $vectorSearch
+    def __init__(self, retriever, latency):
+        self.retriever = retriever
+        self.latency = latency
+
+    def search(self, query_vector, filters, limit, query_text=None):
+        self.latency.sleep()
+        return self.retriever.search(query_vector, filters, limit, query_text)
+
+    async def search_async(self, query_vector, filters, limit, query_text=None):
+        await asyncio.sleep(self.latency.sample())
+        return self.retriever.search(query_vector, filters, limit, query_text)
+
+
+def synthetic_courses(n):
+    rng = np.random.default_rng(0)
+    courses = []
+    for i in range(n):
+        subject = SUBJECTS[i % len(SUBJECTS)]
+        course = {
+            "season_code": SEASON_CODES[i % len(SEASON_CODES)],
+            "course_code": f"{subject} {100 + i // len(SUBJECTS)}",
+            "subject": subject,
+            "title": f"Topics in {subject} {i}",
+            "description": f"A seminar on selected topics in {subject}. " * 8,
+            "areas": [AREAS[subject]] if subject in AREAS else ["So"],
+            "skills": ["QR"] if AREAS.get(subject) == "Sc" else ["WR"],
+            "sentiment_info": {
+                "final_label": "POSITIVE" if rng.random() < 0.7 else "NEGATIVE",
+                "final_proportion": float(rng.random()),
+            },
+        }
+        courses.append(course)
+    embeddings = fake_embed([text_to_embed(course) for course in courses])
+    for course, embedding in zip(courses, embeddings):
+        course["embedding"] = embedding
+    return courses
+
+
+def load_corpus(path):
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def summarize(samples):
+    ms = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+    }
+
+
+def run(args):
+    fake_app = create_fake_openai_app(
+        chat_latency=Latency(args.chat_latency_ms, args.chat_latency_sigma, args.seed),
+        embedding_latency=Latency(
+            args.embedding_latency_ms, args.embedding_latency_sigma, args.seed
+        ),
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    # one access log line per stand-in API call would drown the report
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    if not args.verbose:
+        tracing.logger.setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, fake_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    lib.client = OpenAI(
+        api_key="fake",
+        base_url=f"http://127.0.0.1:{server.server_port}/v1",
+        timeout=OPENAI_TIMEOUT,
+        max_retries=0,
+        http_client=openai_http_client(),
+    )
+    if not args.embedding_cache:
+        # every request pays for its embedding, as a cold production cache would
+        lib.embedding_cache = EmbeddingCache(None, memory_size=0)
+
+    app = app_module.create_app(
+        {
+            "SAFETY_CHECK_ENABLED": args.safety,
+            "DATABASE_RELEVANCY_CHECK_ENABLED": args.relevancy,
+            "QUERY_PLANNER_ENABLED": args.planner,
+            "ANSWER_CACHE_ENABLED": args.answer_cache,
+            "COURSE_QUERY_LIMIT": 5,
+        }
+    )
+    timer = StageTimer()
+    app.config["retriever"] = LatencyRetriever(
+        LocalRetriever(synthetic_courses(args.courses)),
+        Latency(args.vector_latency_ms, args.vector_latency_sigma, args.seed),
+    )
+    app.config["retriever"].search = timer.wrap(
+        app.config["retriever"].search, "aggregate"
+    )
+    app_module.chat_completion_request = timer.wrap(
+        app_module.chat_completion_request, completion_stage
+    )
+    app_module.create_embedding = timer.wrap(app_module.create_embedding, "embedding")
+    app_module.jsonify = timer.wrap(app_module.jsonify, "serialization")
+
+    corpus = load_corpus(args.corpus)
+    local = threading.local()
+    errors = []
+    degraded = []
+
+    def replay(i):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        body = json.loads(json.dumps(corpus[i % len(corpus)]))
+        body.pop("id", None)
+        start = time.perf_counter()
+        response = local.client.post("/api/chat", json=body)
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200 or "error" in response.get_json():
+            errors.append(i)
+        elif response.get_json().get("degraded"):
+            # answered without a completion (see resilience.py)
+            degraded.append(i)
+        timer.record("total", elapsed)
+
+    quiet = contextlib.redirect_stdout(io.StringIO())
+    with contextlib.nullcontext() if args.verbose else quiet:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(replay, range(args.requests)))
+        wall_seconds = time.perf_counter() - start
+    server.shutdown()
+
+    return {
+        "config": vars(args),
+        "requests": args.requests,
+        "errors": len(errors),
+        "degraded": len(degraded),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(args.requests / wall_seconds, 2),
+        "stages": {
+            stage: summarize(timer.samples[stage])
+            for stage in STAGES + ["total"]
+            if timer.samples[stage]
+        },
+    }
+
+
+def report(result, previous=None):
+    print(
+        f"{result['requests']} requests, {result['errors']} errors, "
+        f"{result.get('degraded', 0)} degraded, "
+        f"{result['throughput_rps']} requests/s"
+    )
+    header = f"{'stage':>14} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    if previous:
+        header += f" {'p95 before':>11} {'change':>8}"
+    print(header)
+    for stage, stats in result["stages"].items():
+        line = (
+            f"{stage:>14} {stats['count']:>6} {stats['p50_ms']:>9.1f} "
+            f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}"
+        )
+        before = previous["stages"].get(stage) if previous else None
+        if before:
+            change = (stats["p95_ms"] - before["p95_ms"]) / max(before["p95_ms"], 1e-9)
+            line += f" {before['p95_ms']:>11.1f} {change:>+8.0%}"
+        print(line)
+
+
+def main(args):
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as file:
+            previous = json.load(file)
+    result = run(args)
+    report(result, previous)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(result, file, indent=4)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--corpus",
+        type=str,
+        default=str(CORPUS_PATH),
+        help="JSON lines of /api/chat request bodies.",
+    )
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--output", type=str, default="data/benchmarks/chat.json", help="Result file."
+    )
+    parser.add_argument(
+        "--compare", type=str, default=None, help="A previous result file."
+    )
+    parser.add_argument("--safety", action="store_true", help="SAFETY_CHECK_ENABLED")
+    parser.add_argument(
+        "--relevancy", action="store_true", help="DATABASE_RELEVANCY_CHECK_ENABLED"
+    )
+    parser.add_argument("--planner", action="store_true", help="QUERY_PLANNER_ENABLED")
+    parser.add_argument("--answer_cache", action="store_true")
+    parser.add_argument("--embedding_cache", action="store_true")
+    parser.add_argument("--courses", type=int, default=2000)
+    parser.add_argument("--chat_latency_ms", type=float, default=0)
+    parser.add_argument("--chat_latency_sigma", type=float, default=0)
+    parser.add_argument("--embedding_latency_ms", type=float, default=0)
+    parser.add_argument("--embedding_latency_sigma", type=float, default=0)
+    parser.add_argument("--vector_latency_ms", type=float, default=0)
+    parser.add_argument("--vector_latency_sigma", type=float, default=0)
+    parser.add_argument("--error_rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--verbose", action="store_true", help="Keep the app's own output."
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,202 @@
+"""
+Accuracy and latency of the rule-based filter extractor against the CourseFilter call.
+
+Every query in the corpus is labeled with the filters the chat turn should apply
+(subject, season_code, areas, skills; rating and workload are never applied). For
+the rules this reports how many queries they are sure about (coverage), how many
+of those they get exactly right, and the time per query. With --llm every query is
+also sent to CourseFilter the way a chat turn sends it, so the tool call's accuracy,
+latency and prompt tokens can be set against the rules, and against the two
+together: the rules when they are sure, the tool call otherwise.
+
+The corpus is JSON lines of {"message": ..., "filters": {...}}.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_filters
+    python -m benchmarks.bench_filters --llm        # calls OpenAI (or OPENAI_BASE_URL)
+"""
+
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from filter_rules import extract_filters
+from history import count_tokens
+
+CORPUS_PATH = Path(__file__).resolve().parent / "filter_queries.jsonl"
+FIELDS = ["subject", "season_code", "areas", "skills"]
+
+
+def load_corpus(path):
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def applied(filters):
+    # only the filters resolve_course_filters uses
+    return {key: filters[key] for key in FIELDS if filters.get(key)}
+
+
+def latency(samples, unit=1e6):
+    values = np.asarray(samples) * unit
+    return {
+        "mean": round(float(values.mean()), 2),
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p99": round(float(np.percentile(values, 99)), 2),
+    }
+
+
+def run_rules(corpus, repeat):
+    results, seconds = [], []
+    for query in corpus:
+        messages = [{"role": "user", "content": query["message"]}]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            filters = extract_filters(messages)
+        seconds.append((time.perf_counter() - start) / repeat)
+        results.append(filters)
+    return results, seconds
+
+
+def run_llm(corpus):
+    from app import SYSTEM_PROMPT
+    from lib import chat_completion_request, tools
+
+    results, seconds, prompt_tokens = [], [], []
+    for query in corpus:
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": query["message"]},
+        ]
+        start = time.perf_counter()
+        response = chat_completion_request(messages=messages, tools=tools)
+        seconds.append(time.perf_counter() - start)
+        tool_calls = response.choices[0].message.tool_calls
+        results.append(
+            json.loads(tool_calls[0].function.arguments) if tool_calls else {}
+        )
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            prompt_tokens.append(usage.prompt_tokens)
+    return results, seconds, prompt_tokens
+
+
+def accuracy(corpus, results):
+    pairs = [
+        (query, result) for query, result in zip(corpus, results) if result is not None
+    ]
+    correct = sum(
+        applied(result) == applied(query["filters"]) for query, result in pairs
+    )
+    return {
+        "answered": len(pairs),
+        "correct": correct,
+        "accuracy": round(correct / len(pairs), 3) if pairs else None,
+    }
+
+
+def run(args):
+    from lib import tools
+
+    corpus = load_corpus(args.corpus)
+    rule_results, rule_seconds = run_rules(corpus, args.repeat)
+    result = {
+        "queries": len(corpus),
+        # the schema every CourseFilter call sends, by history.py's count
+        "schema_tokens": count_tokens(json.dumps(tools)),
+        "rules": dict(
+            accuracy(corpus, rule_results),
+            coverage=round(sum(r is not None for r in rule_results) / len(corpus), 3),
+            latency_us=latency(rule_seconds),
+        ),
+        "misses": [
+            {"message": query["message"], "expected": query["filters"], "rules": r}
+            for query, r in zip(corpus, rule_results)
+            if r is not None and applied(r) != applied(query["filters"])
+        ],
+    }
+
+    if args.llm:
+        llm_results, llm_seconds, prompt_tokens = run_llm(corpus)
+        result["llm"] = dict(
+            accuracy(corpus, llm_results), latency_ms=latency(llm_seconds, 1e3)
+        )
+        if prompt_tokens:
+            result["llm"]["mean_prompt_tokens"] = round(
+                float(np.mean(prompt_tokens)), 1
+            )
+        combined = [
+            llm if rules is None else rules
+            for rules, llm in zip(rule_results, llm_results)
+        ]
+        combined_seconds = [
+            rule + (llm if rules is None else 0)
+            for rules, rule, llm in zip(rule_results, rule_seconds, llm_seconds)
+        ]
+        result["combined"] = dict(
+            accuracy(corpus, combined),
+            latency_ms=latency(combined_seconds, 1e3),
+            llm_calls=sum(r is None for r in rule_results),
+        )
+    return result
+
+
+def report(result):
+    rules = result["rules"]
+    print(
+        f"{result['queries']} queries, {result['schema_tokens']} schema tokens per CourseFilter call"
+    )
+    print(
+        f"rules: {rules['coverage']:.0%} covered, {rules['correct']}/{rules['answered']} "
+        f"correct, p50 {rules['latency_us']['p50']:.1f} us, p99 {rules['latency_us']['p99']:.1f} us"
+    )
+    for name in ["llm", "combined"]:
+        if name in result:
+            stats = result[name]
+            print(
+                f"{name}: {stats['correct']}/{stats['answered']} correct, "
+                f"p50 {stats['latency_ms']['p50']:.1f} ms, p99 {stats['latency_ms']['p99']:.1f} ms"
+            )
+    for miss in result["misses"]:
+        print(
+            f"  miss: {miss['message']!r} expected {miss['expected']}, got {miss['rules']}"
+        )
+
+
+def main(args):
+    result = run(args)
+    report(result)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(result, file, indent=4)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--corpus",
+        type=str,
+        default=str(CORPUS_PATH),
+        help="JSON lines of labeled queries.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1000, help="Timed runs of the rules per query."
+    )
+    parser.add_argument(
+        "--llm", action="store_true", help="Also send every query to CourseFilter."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="data/benchmarks/filters.json",
+        help="Result file.",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
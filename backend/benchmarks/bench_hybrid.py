@@ -0,0 +1,179 @@
+"""
+Build time, memory and query latency of the BM25 half of HybridRetriever.
+
+Reports, for the courses given:
+- build: seconds to tokenize every course and build the BM25Index
+- memory: the postings arrays (BM25Index.nbytes) and the peak Python allocation
+  while building, which includes the vocabulary
+- latency: BM25 top-k over all courses and under a subject filter, and the
+  reciprocal rank fusion of the two candidate lists, per query
+- known-item hits: how often the course a query names by a professor's surname
+  or by its course number is in the BM25 top-k, the matches the embeddings blur
+
+Queries are drawn from the courses themselves: a few words of a title, a
+professor's surname, a course number.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_hybrid --json_path data/parsed_courses/202403.json
+    python -m benchmarks.bench_hybrid              # every course in parsed_courses at MONGO_URI
+    python -m benchmarks.bench_hybrid --fake 20000
+"""
+
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from embedding_store import course_id
+from lexical import BM25Index, course_text
+from retrieval import BitmapIndex, reciprocal_rank_fusion
+
+SUBJECTS = ["CPSC", "ECON", "ENGL", "HIST", "MATH", "PHYS", "PLSC", "S&DS"]
+
+
+def synthetic_courses(n):
+    # Zipf-distributed words, like course descriptions, and a few thousand names
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(20000)]
+    names = [f"name{i}" for i in range(3000)]
+
+    def text(length):
+        ranks = np.minimum(rng.zipf(1.3, length), len(words)) - 1
+        return " ".join(words[rank] for rank in ranks)
+
+    return [
+        {
+            "season_code": "202403",
+            "course_code": f"{SUBJECTS[i % len(SUBJECTS)]} {100 + i // len(SUBJECTS)}",
+            "subject": SUBJECTS[i % len(SUBJECTS)],
+            "title": text(5),
+            "professors": [
+                f"{names[rng.integers(len(names))]} {names[rng.integers(len(names))]}"
+            ],
+            "description": text(80),
+        }
+        for i in range(n)
+    ]
+
+
+def load_courses(args):
+    if args.fake:
+        return synthetic_courses(args.fake)
+    if args.json_path:
+        with open(args.json_path, "r") as file:
+            return json.load(file)
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    collection = MongoClient(os.getenv("MONGO_URI"))["course_db"]["parsed_courses"]
+    return list(collection.find({}, {"embedding": 0}))
+
+
+def latency(samples):
+    ms = np.asarray(samples) * 1000
+    return {
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+    }
+
+
+def timed(function, queries):
+    seconds, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(function(query))
+        seconds.append(time.perf_counter() - start)
+    return results, seconds
+
+
+def main(args):
+    courses = load_courses(args)
+    texts = [course_text(course) for course in courses]
+
+    start = time.perf_counter()
+    index = BM25Index(texts)
+    build_seconds = time.perf_counter() - start
+    # built again under tracemalloc, which slows the build down several times
+    tracemalloc.start()
+    BM25Index(texts)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rng = np.random.default_rng(1)
+    sample = rng.integers(0, len(courses), args.queries)
+    title_queries = [
+        " ".join((courses[i].get("title") or "").split()[:3]) for i in sample
+    ]
+    by_professor = [
+        (i, courses[i]["professors"][0].split()[-1])
+        for i in sample
+        if courses[i].get("professors")
+    ]
+    by_number = [(i, courses[i]["course_code"]) for i in sample]
+
+    _, all_seconds = timed(lambda query: index.search(query, args.k), title_queries)
+    mask = BitmapIndex(courses).mask({"subject": [courses[0].get("subject")]})
+    _, filtered_seconds = timed(
+        lambda query: index.search(query, args.k, mask), title_queries
+    )
+    ids = [course_id(course) for course in courses]
+    rankings = [
+        (
+            [ids[row] for row in rng.integers(0, len(courses), 20)],
+            [ids[row] for row in index.search(query, 20)],
+        )
+        for query in title_queries
+    ]
+    _, fusion_seconds = timed(reciprocal_rank_fusion, rankings)
+
+    def hit_rate(known_items):
+        hits = [
+            any(
+                courses[row]["course_code"] == courses[i]["course_code"]
+                for row in index.search(query, args.k)
+            )
+            for i, query in known_items
+        ]
+        return round(float(np.mean(hits)), 3) if hits else None
+
+    result = {
+        "courses": len(courses),
+        "terms": len(index.vocabulary),
+        "postings": len(index.rows),
+        "build_seconds": round(build_seconds, 3),
+        "postings_mib": round(index.nbytes / 2**20, 2),
+        "build_peak_mib": round(peak / 2**20, 2),
+        "bm25": latency(all_seconds),
+        "bm25_filtered": latency(filtered_seconds),
+        "fusion": latency(fusion_seconds),
+        f"professor_hit@{args.k}": hit_rate(by_professor),
+        f"course_number_hit@{args.k}": hit_rate(by_number),
+    }
+    print(json.dumps(result, indent=4))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=4)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--json_path", type=str, default=None, help="A .json file of parsed courses."
+    )
+    parser.add_argument(
+        "--fake", type=int, default=0, help="Use this many synthetic courses."
+    )
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--output", type=str, default=None, help="Result file.")
+
+    args = parser.parse_args()
+
+    main(args)
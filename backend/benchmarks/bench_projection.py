@@ -0,0 +1,174 @@
+"""
+Bytes and decode time saved by projecting course documents down to a Course.
+
+For every course, the whole parsed_courses document (embedding, ratings,
+per-comment sentiment) and the same document under COURSE_PROJECTION are encoded
+as BSON, which is what MongoDB sends and pymongo decodes. Reports the mean size
+of each, the bytes a chat request transfers for COURSE_QUERY_LIMIT results and
+for HybridRetriever's vector candidates, the time to decode them, and the
+in-process size of a course as a dict and as a Course.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_projection --json_path data/parsed_courses/202403_with_embeddings.json
+    python -m benchmarks.bench_projection              # a sample of parsed_courses at MONGO_URI
+    python -m benchmarks.bench_projection --fake 1000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import bson
+import numpy as np
+
+from courses import COURSE_PROJECTION, Course
+
+
+def synthetic_document(rng, i):
+    # shaped like a parsed_courses document after the embedding, rating and
+    # sentiment scripts have run
+    comments = int(rng.integers(5, 60))
+
+    def sentiment():
+        return {
+            "sentiment_labels": ["POSITIVE"] * comments,
+            "sentiment_scores": rng.random(comments).tolist(),
+        }
+
+    return {
+        "season_code": "202403",
+        "course_code": f"CPSC {100 + i}",
+        "crns": [str(10000 + i)],
+        "subject": "CPSC",
+        "title": "Topics in Computer Science",
+        "description": "A seminar on selected topics in computer science. " * 10,
+        "professors": ["Ada Lovelace"],
+        "areas": [],
+        "skills": ["QR"],
+        "ratings": [
+            {"question_id": f"YC40{q}", "data": rng.integers(0, 30, 5).tolist()}
+            for q in range(1, 10)
+        ],
+        "sentiment_info": {
+            "YC401": sentiment(),
+            "YC403": sentiment(),
+            "YC409": sentiment(),
+            "final_label": "POSITIVE",
+            "final_count": comments,
+            "final_proportion": float(rng.random()),
+        },
+        "embedding": rng.standard_normal(1536).tolist(),
+    }
+
+
+def load_documents(args):
+    if args.fake:
+        rng = np.random.default_rng(0)
+        return [synthetic_document(rng, i) for i in range(args.fake)]
+    if args.json_path:
+        with open(args.json_path, "r") as file:
+            return json.load(file)
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    collection = MongoClient(os.getenv("MONGO_URI"))["course_db"]["parsed_courses"]
+    return list(collection.aggregate([{"$sample": {"size": args.sample}}]))
+
+
+def project(document, fields):
+    # what MongoDB returns for an inclusion projection of top-level and dotted
+    # fields
+    projected = {}
+    for field, include in fields.items():
+        if not include:
+            continue
+        source, target = document, projected
+        *parents, name = field.split(".")
+        for parent in parents:
+            source = source.get(parent) or {}
+            target = target.setdefault(parent, {})
+        if name in source:
+            target[name] = source[name]
+    return projected
+
+
+def decode_seconds(encoded, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for data in encoded:
+            bson.decode(data)
+    return (time.perf_counter() - start) / repeat / len(encoded)
+
+
+def main(args):
+    documents = load_documents(args)
+    full = [bson.encode(document) for document in documents]
+    lean = [bson.encode(project(document, COURSE_PROJECTION)) for document in documents]
+    full_bytes = float(np.mean([len(data) for data in full]))
+    lean_bytes = float(np.mean([len(data) for data in lean]))
+    courses = [Course.from_document(document) for document in documents]
+    dict_bytes = np.mean(
+        [
+            sys.getsizeof(course.to_dict())
+            + sum(sys.getsizeof(value) for value in course.to_dict().values())
+            for course in courses
+        ]
+    )
+    course_bytes = np.mean(
+        [
+            sys.getsizeof(course)
+            + sum(sys.getsizeof(value) for value in course.to_dict().values())
+            for course in courses
+        ]
+    )
+
+    result = {
+        "courses": len(documents),
+        "document_bytes": round(full_bytes),
+        "projected_bytes": round(lean_bytes),
+        "saved": round(1 - lean_bytes / full_bytes, 3),
+        "decode_us": round(decode_seconds(full) * 1e6, 1),
+        "projected_decode_us": round(decode_seconds(lean) * 1e6, 1),
+        "dict_bytes": round(float(dict_bytes)),
+        "course_bytes": round(float(course_bytes)),
+    }
+    for name, count in [("request", args.limit), ("hybrid_request", args.candidates)]:
+        result[f"{name}_kib"] = round(full_bytes * count / 1024, 1)
+        result[f"projected_{name}_kib"] = round(lean_bytes * count / 1024, 1)
+
+    print(json.dumps(result, indent=4))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=4)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--json_path", type=str, default=None, help="A .json file of parsed courses."
+    )
+    parser.add_argument(
+        "--fake", type=int, default=0, help="Use this many synthetic documents."
+    )
+    parser.add_argument(
+        "--sample", type=int, default=1000, help="Documents sampled from MongoDB."
+    )
+    parser.add_argument(
+        "--limit", type=int, default=5, help="Courses per request (COURSE_QUERY_LIMIT)."
+    )
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=20,
+        help="Vector candidates per request with HYBRID_SEARCH.",
+    )
+    parser.add_argument("--output", type=str, default=None, help="Result file.")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,105 @@
+"""
+Benchmarks the recall lost by storing course embeddings as float16 or int8 instead of float32.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_quantization --json_path data/parsed_courses/202403_with_embeddings.json
+    python -m benchmarks.bench_quantization            # every embedded course in parsed_courses at MONGO_URI
+    python -m benchmarks.bench_quantization --fake 20000
+
+Each query is the embedding of a randomly chosen course, perturbed with a little noise so
+it is not an exact match of any row. Recall@k is the fraction of the float32 top-k that the
+quantized store also returns in its top-k.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from embedding_store import EmbeddingStore, course_id
+
+
+def load_embeddings(args):
+    if args.fake:
+        rng = np.random.default_rng(0)
+        # clustered like real course embeddings, rather than uniformly random
+        centers = rng.standard_normal((64, 1536))
+        embeddings = centers[rng.integers(0, 64, args.fake)]
+        embeddings += 0.5 * rng.standard_normal(embeddings.shape)
+        return [str(i) for i in range(args.fake)], embeddings
+    if args.json_path:
+        with open(args.json_path, "r") as file:
+            courses = [course for course in json.load(file) if course.get("embedding")]
+    else:
+        from dotenv import load_dotenv
+        from pymongo import MongoClient
+
+        load_dotenv()
+        collection = MongoClient(os.getenv("MONGO_URI"))["course_db"]["parsed_courses"]
+        courses = list(
+            collection.find(
+                {"embedding": {"$exists": True}},
+                {"season_code": 1, "course_code": 1, "embedding": 1},
+            )
+        )
+    return [course_id(course) for course in courses], [
+        course["embedding"] for course in courses
+    ]
+
+
+def top_k(store, queries, k):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        scores = store.scores(query)
+        top = np.argpartition(-scores, k - 1)[:k]
+        results.append(set(top.tolist()))
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+def main(args):
+    ids, embeddings = load_embeddings(args)
+    rng = np.random.default_rng(1)
+    exact = EmbeddingStore.build(ids, embeddings, dtype="float32")
+    queries = exact.vectors[rng.integers(0, len(ids), args.queries)].copy()
+    queries += 0.01 * rng.standard_normal(queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    expected, _ = top_k(exact, queries, args.k)
+
+    print(f"{len(ids)} courses, {args.queries} queries, recall@{args.k}")
+    print(f"{'dtype':>8} {'MiB':>8} {'load ms':>8} {'query ms':>9} {'recall':>7}")
+    for dtype in ["float32", "float16", "int8"]:
+        with tempfile.TemporaryDirectory() as directory:
+            EmbeddingStore.build(ids, embeddings, dtype=dtype).save(directory)
+            start = time.perf_counter()
+            store = EmbeddingStore.load(directory)
+            load_ms = (time.perf_counter() - start) * 1000
+            found, query_seconds = top_k(store, queries, args.k)
+            size = store.vectors.nbytes + (
+                store.scales.nbytes if store.scales is not None else 0
+            )
+            del store
+        recall = np.mean([len(a & b) / args.k for a, b in zip(expected, found)])
+        print(
+            f"{dtype:>8} {size / 2**20:>8.1f} {load_ms:>8.2f} "
+            f"{query_seconds * 1000:>9.2f} {recall:>7.4f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--json_path", type=str, default=None, help="A _with_embeddings.json file."
+    )
+    parser.add_argument(
+        "--fake", type=int, default=0, help="Use this many synthetic embeddings."
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,356 @@
+"""
+Throughput of the Flask app under gunicorn against the ASGI app under uvicorn.
+
+Both servers run the same chat turns from the same corpus as bench_chat, against
+fake_openai.py (started as its own process, with lognormal latency) and a synthetic
+catalog searched in process behind a simulated Atlas round trip. Each server is
+started, driven with a closed loop of --concurrency clients for --requests
+requests, and stopped. Reported per server: requests/s, p50/p95/p99 latency,
+errors, and the peak resident memory of all of its processes (VmHWM, summed), so
+the two can be compared at equal memory: by default both run --workers processes,
+gunicorn with --threads threads each.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_serving --concurrency 200 --requests 2000 --chat_latency_ms 800 --chat_latency_sigma 0.5
+    python -m benchmarks.bench_serving --workers 2 --threads 16 --servers flask asgi
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+from benchmarks.bench_chat import (
+    CORPUS_PATH,
+    LatencyRetriever,
+    load_corpus,
+    summarize,
+    synthetic_courses,
+)
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# The servers build their app from these settings, passed in the environment
+CONFIG_VARIABLE = "BENCH_SERVING_CONFIG"
+
+
+def configure(app):
+    # app is the Flask app, for either server
+    from fake_openai import Latency
+    from retrieval import LocalRetriever
+
+    config = json.loads(os.environ[CONFIG_VARIABLE])
+    app.config["retriever"] = LatencyRetriever(
+        LocalRetriever(synthetic_courses(config["courses"])),
+        Latency(config["vector_latency_ms"], config["vector_latency_sigma"]),
+    )
+
+
+def test_config():
+    config = json.loads(os.environ[CONFIG_VARIABLE])
+    return {
+        "SAFETY_CHECK_ENABLED": config["safety"],
+        "DATABASE_RELEVANCY_CHECK_ENABLED": config["relevancy"],
+        "QUERY_PLANNER_ENABLED": config["planner"],
+        "ANSWER_CACHE_ENABLED": False,
+        "CHAT_STAGE_WORKERS": config["stage_workers"],
+        "COURSE_QUERY_LIMIT": 5,
+    }
+
+
+def flask_app():
+    # gunicorn "benchmarks.bench_serving:flask_app()"
+    from app import create_app
+
+    app = create_app(test_config())
+    configure(app)
+    return app
+
+
+def asgi_app():
+    # uvicorn --factory benchmarks.bench_serving:asgi_app
+    from asgi import create_asgi_app
+
+    app = create_asgi_app(test_config())
+    configure(app.state.flask_app)
+    return app
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up in {timeout}s")
+
+
+def process_tree(pid):
+    # the pid and all of its descendants, from /proc (Linux only)
+    children = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # the command name may contain spaces, so split after its closing paren
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+def peak_memory_mb(pid):
+    total_kb = 0
+    for member in process_tree(pid):
+        try:
+            status = Path(f"/proc/{member}/status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmHWM:"):
+                total_kb += int(line.split()[1])
+    return round(total_kb / 1024, 1)
+
+
+def server_command(server, args, port):
+    if server == "flask":
+        return [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "benchmarks.bench_serving:flask_app()",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--workers",
+            str(args.workers),
+            "--worker-class",
+            "gthread",
+            "--threads",
+            str(args.threads),
+            "--timeout",
+            "120",
+        ]
+    return [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "benchmarks.bench_serving:asgi_app",
+        "--factory",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+        "--workers",
+        str(args.workers),
+        "--no-access-log",
+    ]
+
+
+async def drive(url, corpus, args):
+    latencies = []
+    errors = 0
+    next_request = iter(range(args.requests))
+    limits = httpx.Limits(max_connections=args.concurrency)
+
+    async def worker(client):
+        nonlocal errors
+        for i in next_request:
+            body = dict(corpus[i % len(corpus)])
+            body.pop("id", None)
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json=body)
+                failed = response.status_code != 200 or "error" in response.json()
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        wall_seconds = time.perf_counter() - start
+    return latencies, errors, wall_seconds
+
+
+def run_server(server, args, openai_url, corpus):
+    port = free_port()
+    config = {
+        key: getattr(args, key)
+        for key in [
+            "courses",
+            "vector_latency_ms",
+            "vector_latency_sigma",
+            "safety",
+            "relevancy",
+            "planner",
+            "stage_workers",
+        ]
+    }
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="fake",
+        OPENAI_BASE_URL=openai_url,
+        # every request pays for its embedding
+        EMBEDDING_CACHE_PATH="",
+        EMBEDDING_CACHE_MEMORY_SIZE="0",
+        **{CONFIG_VARIABLE: json.dumps(config)},
+    )
+    process = subprocess.Popen(
+        server_command(server, args, port),
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    try:
+        wait_for(f"http://127.0.0.1:{port}/metrics")
+        latencies, errors, wall_seconds = asyncio.run(
+            drive(f"http://127.0.0.1:{port}/api/chat", corpus, args)
+        )
+        memory_mb = peak_memory_mb(process.pid)
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(args.requests / wall_seconds, 2),
+        "peak_memory_mb": memory_mb,
+        "latency": summarize(latencies),
+    }
+
+
+def run(args):
+    openai_port = free_port()
+    fake_openai = subprocess.Popen(
+        [
+            sys.executable,
+            "fake_openai.py",
+            "--port",
+            str(openai_port),
+            "--chat_latency_ms",
+            str(args.chat_latency_ms),
+            "--chat_latency_sigma",
+            str(args.chat_latency_sigma),
+            "--embedding_latency_ms",
+            str(args.embedding_latency_ms),
+            "--embedding_latency_sigma",
+            str(args.embedding_latency_sigma),
+            "--seed",
+            str(args.seed),
+        ],
+        cwd=BACKEND_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    openai_url = f"http://127.0.0.1:{openai_port}/v1"
+    corpus = load_corpus(args.corpus)
+    try:
+        wait_for(f"http://127.0.0.1:{openai_port}/")
+        servers = {
+            server: run_server(server, args, openai_url, corpus)
+            for server in args.servers
+        }
+    finally:
+        fake_openai.terminate()
+        fake_openai.wait()
+    return {"config": vars(args), "servers": servers}
+
+
+def report(result):
+    print(
+        f"{'server':>7} {'requests/s':>11} {'p50 ms':>9} {'p95 ms':>9} "
+        f"{'p99 ms':>9} {'errors':>7} {'peak MB':>8}"
+    )
+    for server, stats in result["servers"].items():
+        latency = stats["latency"]
+        print(
+            f"{server:>7} {stats['throughput_rps']:>11.1f} {latency['p50_ms']:>9.1f} "
+            f"{latency['p95_ms']:>9.1f} {latency['p99_ms']:>9.1f} "
+            f"{stats['errors']:>7} {stats['peak_memory_mb']:>8.1f}"
+        )
+    servers = result["servers"]
+    if "flask" in servers and "asgi" in servers:
+        gain = servers["asgi"]["throughput_rps"] / servers["flask"]["throughput_rps"]
+        memory = servers["asgi"]["peak_memory_mb"] / servers["flask"]["peak_memory_mb"]
+        print(f"asgi/flask: {gain:.1f}x the throughput with {memory:.2f}x the memory")
+
+
+def main(args):
+    result = run(args)
+    report(result)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(result, file, indent=4)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--corpus",
+        type=str,
+        default=str(CORPUS_PATH),
+        help="JSON lines of /api/chat request bodies.",
+    )
+    parser.add_argument(
+        "--servers", nargs="+", choices=["flask", "asgi"], default=["flask", "asgi"]
+    )
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Processes of either server."
+    )
+    parser.add_argument(
+        "--threads", type=int, default=8, help="Threads of each gunicorn worker."
+    )
+    parser.add_argument("--stage_workers", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="data/benchmarks/serving.json",
+        help="Result file.",
+    )
+    parser.add_argument("--safety", action="store_true", help="SAFETY_CHECK_ENABLED")
+    parser.add_argument(
+        "--relevancy", action="store_true", help="DATABASE_RELEVANCY_CHECK_ENABLED"
+    )
+    parser.add_argument("--planner", action="store_true", help="QUERY_PLANNER_ENABLED")
+    parser.add_argument("--courses", type=int, default=2000)
+    parser.add_argument("--chat_latency_ms", type=float, default=500)
+    parser.add_argument("--chat_latency_sigma", type=float, default=0)
+    parser.add_argument("--embedding_latency_ms", type=float, default=50)
+    parser.add_argument("--embedding_latency_sigma", type=float, default=0)
+    parser.add_argument("--vector_latency_ms", type=float, default=20)
+    parser.add_argument("--vector_latency_sigma", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,334 @@
+"""
+This file adds embeddings to a .json file of parsed courses, replacing add_embedding_to_json in process_data.ipynb:
+
+Args
+- input_path: Path to the .json file of parsed courses
+- output_path: Where to write the courses with an "embedding" field (default: <input>_with_embeddings.json)
+- checkpoint_path: JSON-lines file of finished embeddings (default: <input>.embeddings.jsonl)
+- batch_size: Number of courses embedded per API request
+- workers: Number of API requests in flight at once
+- mongo: Update the parsed_courses collection at MONGO_URI instead of writing a .json file
+- fake: Use deterministic hash-based embeddings instead of the OpenAI API (for testing)
+
+Processing
+- Build the text to embed for each course (course code, title, professors, description)
+- Hash each text together with the model name; only courses whose hash differs from the stored
+  embedding_hash (in parsed_courses, or in the previous output file) are embedded again
+- Skip texts already in the checkpoint file, so a crashed run resumes where it stopped
+- Embed the rest in batches, several batches in parallel, appending each finished batch to the checkpoint
+- Report throughput as batches finish
+
+Result
+- Every course carries "embedding", "embedding_hash" and "embedding_model" fields
+- With --mongo, only new or changed courses are written back to parsed_courses, and the
+  generation of their seasons in answer_cache_generations is bumped so every backend worker
+  stops serving cached answers drawn from them; otherwise the whole season is written to a
+  new .json file
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from tenacity import retry, stop_after_attempt, wait_random_exponential
+
+from answer_cache import GENERATIONS_COLLECTION, invalidate_seasons
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+
+openai_client = None
+
+
+def text_to_embed(course):
+    text = f"{course['course_code']} {course['title']}. "
+    if course.get("professors"):
+        text += ", ".join(course["professors"]) + ". "
+    text += course["description"]
+    return text
+
+
+def text_hash(text, model=EMBEDDING_MODEL):
+    return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+
+@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(6))
+def openai_embed(texts, model=EMBEDDING_MODEL):
+    global openai_client
+    if openai_client is None:
+        from openai import OpenAI
+
+        openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    response = openai_client.embeddings.create(input=texts, model=model)
+    return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+
+def fake_embed(texts, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS):
+    # deterministic unit vectors seeded by the text, so equal texts embed equally
+    embeddings = []
+    for text in texts:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(dimensions)
+        embeddings.append((vector / np.linalg.norm(vector)).tolist())
+    return embeddings
+
+
+def load_checkpoint(checkpoint_path):
+    done = {}
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a run killed mid-write leaves a partial last line
+                    continue
+                done[entry["hash"]] = entry["embedding"]
+    return done
+
+
+def embed_texts(
+    texts,
+    embed=openai_embed,
+    model=EMBEDDING_MODEL,
+    batch_size=256,
+    workers=4,
+    checkpoint_path=None,
+):
+    """Returns {text_hash: embedding} for every text, resuming from the checkpoint."""
+    done = load_checkpoint(checkpoint_path)
+    pending = {}
+    for text in texts:
+        key = text_hash(text, model)
+        if key not in done:
+            pending[key] = text
+    print(f"{len(done)} embeddings in checkpoint, {len(pending)} to embed")
+
+    items = list(pending.items())
+    batches = [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+    checkpoint = None
+    if checkpoint_path:
+        checkpoint = open(checkpoint_path, "a")
+        if checkpoint.tell():
+            # a run killed mid-write may have left the last line unterminated
+            checkpoint.write("\n")
+    start = time.perf_counter()
+    embedded = 0
+    failed = 0
+
+    def run_batch(batch):
+        return batch, embed([text for _, text in batch], model=model)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_batch, batch) for batch in batches]
+            for future in as_completed(futures):
+                try:
+                    batch, embeddings = future.result()
+                except Exception as e:
+                    # keep checkpointing the other batches; a rerun retries this one
+                    print(f"Batch failed: {e}")
+                    failed += 1
+                    continue
+                for (key, _), embedding in zip(batch, embeddings):
+                    done[key] = embedding
+                    if checkpoint:
+                        checkpoint.write(
+                            json.dumps({"hash": key, "embedding": embedding}) + "\n"
+                        )
+                if checkpoint:
+                    checkpoint.flush()
+                embedded += len(batch)
+                elapsed = time.perf_counter() - start
+                print(
+                    f"Embedded {embedded}/{len(items)} texts "
+                    f"({embedded / elapsed:.1f} texts/s)"
+                )
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+    if failed:
+        raise RuntimeError(
+            f"{failed} of {len(batches)} batches failed, rerun to resume"
+        )
+    return done
+
+
+def course_key(course):
+    return (course["season_code"], course["course_code"])
+
+
+def stored_hashes(collection, courses):
+    # only the hashes are read back, never the vectors
+    season_codes = sorted({course["season_code"] for course in courses})
+    return {
+        course_key(stored): stored.get("embedding_hash")
+        for stored in collection.find(
+            {"season_code": {"$in": season_codes}},
+            {"season_code": 1, "course_code": 1, "embedding_hash": 1},
+        )
+    }
+
+
+def reusable_embeddings(*course_lists):
+    # {embedding_hash: embedding} for courses that were embedded before
+    return {
+        course["embedding_hash"]: course["embedding"]
+        for courses in course_lists
+        for course in courses
+        if course.get("embedding_hash") and course.get("embedding")
+    }
+
+
+def write_changed(collection, courses, chunk_size=500):
+    for i in range(0, len(courses), chunk_size):
+        collection.bulk_write(
+            [
+                UpdateOne(
+                    {
+                        "season_code": course["season_code"],
+                        "course_code": course["course_code"],
+                    },
+                    {
+                        "$set": {
+                            key: value for key, value in course.items() if key != "_id"
+                        }
+                    },
+                    upsert=True,
+                )
+                for course in courses[i : i + chunk_size]
+            ],
+            ordered=False,
+        )
+
+
+def main(args):
+    # MONGO_URI and OPENAI_API_KEY may come from backend/.env
+    load_dotenv()
+    with open(args.input_path, "r") as file:
+        courses = json.load(file)
+
+    start = time.perf_counter()
+    hashes = [text_hash(text_to_embed(course), args.model) for course in courses]
+
+    # A course only needs a new embedding if its text or the model changed.
+    # With --mongo the parsed_courses collection is the store; otherwise the
+    # previous output file (and any embeddings already in the input) are reused.
+    if args.mongo:
+        db = MongoClient(os.getenv("MONGO_URI"))["course_db"]
+        collection = db["parsed_courses"]
+        stored = stored_hashes(collection, courses)
+        known = {}
+        changed = [
+            (course, course_hash)
+            for course, course_hash in zip(courses, hashes)
+            if stored.get(course_key(course)) != course_hash
+        ]
+    else:
+        output_path = (
+            args.output_path
+            or os.path.splitext(args.input_path)[0] + "_with_embeddings.json"
+        )
+        previous = []
+        if os.path.exists(output_path):
+            with open(output_path, "r") as file:
+                previous = json.load(file)
+        known = reusable_embeddings(previous, courses)
+        changed = [
+            (course, course_hash)
+            for course, course_hash in zip(courses, hashes)
+            if course_hash not in known
+        ]
+    print(f"{len(changed)} of {len(courses)} courses are new or changed")
+
+    embeddings = embed_texts(
+        [text_to_embed(course) for course, _ in changed],
+        embed=fake_embed if args.fake else openai_embed,
+        model=args.model,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        checkpoint_path=args.checkpoint_path
+        or os.path.splitext(args.input_path)[0] + ".embeddings.jsonl",
+    )
+    known.update(embeddings)
+
+    if args.mongo:
+        changed_courses = []
+        for course, course_hash in changed:
+            course.update(
+                embedding=known[course_hash],
+                embedding_hash=course_hash,
+                embedding_model=args.model,
+            )
+            changed_courses.append(course)
+        write_changed(collection, changed_courses)
+        # cached answers drawn from these seasons are now stale in every worker
+        invalidate_seasons(
+            db[GENERATIONS_COLLECTION],
+            [course["season_code"] for course in changed_courses],
+        )
+        print(
+            f"Updated {len(changed_courses)} courses in parsed_courses "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+        return
+
+    for course, course_hash in zip(courses, hashes):
+        course.update(
+            embedding=known[course_hash],
+            embedding_hash=course_hash,
+            embedding_model=args.model,
+        )
+    with open(output_path, "w") as file:
+        json.dump(courses, file, indent=4)
+    print(
+        f"Wrote {len(courses)} courses to {output_path} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "input_path", type=str, help="The .json file of parsed courses to embed."
+    )
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        default=None,
+        help="Where to write the courses with embeddings.",
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        type=str,
+        default=None,
+        help="JSON-lines file of finished embeddings, used to resume a run.",
+    )
+    parser.add_argument("--model", type=str, default=EMBEDDING_MODEL)
+    parser.add_argument(
+        "--batch_size", type=int, default=256, help="Courses per API request."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="API requests in flight at once."
+    )
+    parser.add_argument(
+        "--mongo",
+        action="store_true",
+        help="Read and update the parsed_courses collection at MONGO_URI instead of a .json output file.",
+    )
+    parser.add_argument(
+        "--fake",
+        action="store_true",
+        help="Use deterministic hash-based embeddings instead of the OpenAI API.",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
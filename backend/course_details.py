@@ -0,0 +1,110 @@
+"""
+The bulky evaluation data of a course, kept apart from its parsed_courses document.
+
+A course's CourseTable ratings and the per-comment sentiment labels and scores of
+YC401, YC403 and YC409 are most of its document, yet a chat turn only reads the
+final sentiment label and proportion. So parsed_courses keeps a compact summary:
+
+- sentiment_info: final_label, final_count and final_proportion
+- average_rating, average_workload: the means of the YC402 (overall assessment)
+  and YC404 (workload) ratings, on CourseTable's 1-5 scale, or None
+
+and everything else goes to the course_details collection, one document per
+course keyed by its course id ("<season_code> <course_code>"), read only when a
+course's details are asked for (/api/course/details).
+
+The ingest scripts (add_rating_info.py, port_sentiment_info_to_parsed_courses.py)
+write the details to one .json file per season beside the parsed courses;
+migrate_course_details.py loads those into course_details and moves the details of
+existing parsed_courses documents over.
+"""
+
+import json
+import os
+
+from embedding_store import course_id
+
+DETAILS_COLLECTION = "course_details"
+SENTIMENT_SUMMARY_FIELDS = ["final_label", "final_count", "final_proportion"]
+# the rating questions averaged onto the course
+RATING_QUESTIONS = {"average_rating": "YC402", "average_workload": "YC404"}
+# fields only a parsed_courses document that still carries its details has
+DETAIL_FIELDS = ["ratings"] + [
+    f"sentiment_info.{field}"
+    for field in ["YC401", "YC403", "YC409", "final_counts", "final_distribution"]
+]
+
+
+def summarize_sentiment(sentiment_info):
+    sentiment_info = sentiment_info or {}
+    return {field: sentiment_info.get(field) for field in SENTIMENT_SUMMARY_FIELDS}
+
+
+def rating_mean(counts):
+    # counts[i] students answered i + 1
+    total = sum(counts)
+    if not total:
+        return None
+    return sum((i + 1) * count for i, count in enumerate(counts)) / total
+
+
+def rating_means(ratings):
+    """average_rating and average_workload from CourseTable ratings, or None each.
+
+    A rating is {"question_id": ..., "data": [count of 1s, ..., count of 5s]}.
+    """
+    means = dict.fromkeys(RATING_QUESTIONS)
+    for field, question_id in RATING_QUESTIONS.items():
+        for rating in ratings or []:
+            if question_id in rating.get("question_id", ""):
+                means[field] = rating_mean(rating.get("data") or [])
+                break
+    return means
+
+
+def split_course(course):
+    """The course with summaries in place of its details, and the details.
+
+    The details are None if the course has none (already split, or never rated).
+    """
+    details = {}
+    compact = dict(course)
+    if "ratings" in compact:
+        details["ratings"] = compact.pop("ratings")
+        compact.update(rating_means(details["ratings"]))
+    sentiment_info = compact.get("sentiment_info") or {}
+    if set(sentiment_info) - set(SENTIMENT_SUMMARY_FIELDS):
+        details["sentiment_info"] = sentiment_info
+        compact["sentiment_info"] = summarize_sentiment(sentiment_info)
+    return compact, details or None
+
+
+def details_path(details_dir, season_file):
+    return os.path.join(details_dir, os.path.basename(season_file))
+
+
+def read_details_file(path):
+    # {course id: details} of one season, as the ingest scripts write it
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def write_details_file(path, details):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(details, file, indent=4)
+
+
+def add_details(details, course, **fields):
+    # merges fields into the course's entry of a season's details
+    details.setdefault(course_id(course), {}).update(fields)
+
+
+def load_details(collection, season_code, course_code):
+    """The details of a course from course_details, or None."""
+    return collection.find_one(
+        {"_id": course_id({"season_code": season_code, "course_code": course_code})},
+        {"_id": 0},
+    )
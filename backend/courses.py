@@ -0,0 +1,96 @@
+"""
+The course fields a chat response uses, and the one shape every course is returned in.
+
+A parsed_courses document carries far more than a response uses: the 1536-float
+embedding, the CourseTable ratings, and the per-comment sentiment_labels and
+sentiment_scores of YC401, YC403 and YC409 under sentiment_info. projection()
+is the $project (or find() projection) that keeps only what Course holds, plus
+whatever else a caller reads, so MongoDB sends and pymongo decodes only those.
+
+Course is a slotted object rather than a dict: no per-course __dict__ in the
+catalogs the in-process retrievers hold, and one place that says what a course
+in a response looks like. Every retriever returns Courses; recommend_courses
+and the course code routes turn them into the JSON the frontend reads.
+
+`python -m benchmarks.bench_projection` measures the bytes saved.
+"""
+
+COURSE_FIELDS = [
+    "season_code",
+    "course_code",
+    "title",
+    "description",
+    "areas",
+    "sentiment_info.final_label",
+    "sentiment_info.final_proportion",
+]
+
+
+def projection(*extra_fields):
+    """A projection of the Course fields and extra_fields, without _id."""
+    fields = {"_id": 0}
+    fields.update((field, 1) for field in COURSE_FIELDS + list(extra_fields))
+    return fields
+
+
+COURSE_PROJECTION = projection()
+# what the course code routes send back: the code alone
+COURSE_CODE_PROJECTION = {"_id": 0, "course_code": 1}
+
+
+class Course:
+    __slots__ = (
+        "season_code",
+        "course_code",
+        "title",
+        "description",
+        "areas",
+        "sentiment_label",
+        "sentiment_score",
+    )
+
+    def __init__(
+        self,
+        season_code,
+        course_code,
+        title=None,
+        description=None,
+        areas=(),
+        sentiment_label=None,
+        sentiment_score=None,
+    ):
+        self.season_code = season_code
+        self.course_code = course_code
+        self.title = title
+        self.description = description
+        self.areas = list(areas)
+        self.sentiment_label = sentiment_label
+        self.sentiment_score = sentiment_score
+
+    @classmethod
+    def from_document(cls, document):
+        sentiment_info = document.get("sentiment_info") or {}
+        return cls(
+            document.get("season_code"),
+            document.get("course_code"),
+            document.get("title"),
+            document.get("description"),
+            document.get("areas") or (),
+            sentiment_info.get("final_label"),
+            sentiment_info.get("final_proportion"),
+        )
+
+    @property
+    def id(self):
+        # embedding_store.course_id of the document
+        return f"{self.season_code} {self.course_code}"
+
+    def to_dict(self):
+        """The course as the chat response sends it."""
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, Course) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Course({self.id!r})"
@@ -0,0 +1,46 @@
+"""
+Creates the MongoDB indexes the backend's queries rely on. Safe to rerun: existing
+indexes are left as they are.
+
+Indexes
+- parsed_courses (course_code, season_code desc): the course code lookup of a chat
+  turn that names a course ("is ECON 115 hard?")
+
+The $vectorSearch index is an Atlas Search index, managed in the Atlas UI.
+
+Usage (from the backend directory, with MONGO_URI set):
+    python create_indexes.py
+"""
+
+import argparse
+import os
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+from retrieval import COURSE_CODE_INDEX
+
+
+def create_indexes(db):
+    return {
+        "parsed_courses": db["parsed_courses"].create_index(COURSE_CODE_INDEX),
+    }
+
+
+def main(args):
+    load_dotenv()
+    db = MongoClient(args.mongo_uri or os.getenv("MONGO_URI"))[args.db]
+    for collection, index in create_indexes(db).items():
+        print(f"{collection}: {index}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mongo_uri", type=str, default=None, help="Defaults to MONGO_URI."
+    )
+    parser.add_argument("--db", type=str, default="course_db")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+
+def normalize_text(text):
+    # "Easy  QR classes" and "easy qr classes" are the same search
+    return " ".join(str(text).lower().split())
+
+
+def cache_key(text, model, endpoint=None):
+    # the endpoint is that of an OpenAI-compatible server other than OpenAI's, so
+    # its vectors (fake_openai.py's hashes) are never served for OpenAI's
+    key = f"{model}\0{normalize_text(text)}"
+    if endpoint:
+        key = f"{endpoint}\0{key}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """Two-tier cache for embeddings: an in-process LRU in front of SQLite.
+
+    The SQLite file can be shared by every gunicorn worker on the host. It runs
+    in WAL mode so readers never block on a writer, and each process opens its
+    own connection (a connection inherited across fork is reopened). Both tiers
+    are bounded by entry count and evict the least recently used entries.
+    Vectors are stored on disk as float32 blobs, keyed by endpoint, model and
+    normalized text.
+    """
+
+    TRIM_EVERY = 64
+
+    def __init__(self, path=None, memory_size=1024, disk_size=100_000, endpoint=None):
+        self.path = str(path) if path else None
+        self.endpoint = endpoint
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.puts = 0
+
+    def _connect(self):
+        # called with self.lock held
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        connection.commit()
+        self.connection = connection
+        self.pid = os.getpid()
+        return connection
+
+    def _remember(self, key, embedding):
+        # called with self.lock held
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, text, model):
+        key = cache_key(text, model, self.endpoint)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return self.memory[key]
+
+            row = None
+            if self.path:
+                try:
+                    connection = self._connect()
+                    row = connection.execute(
+                        "SELECT embedding FROM embeddings WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row:
+                        connection.execute(
+                            "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                            (time.time(), key),
+                        )
+                        connection.commit()
+                except sqlite3.Error as e:
+                    # the disk tier is an optimization, never a reason to fail
+                    print(f"Embedding cache read failed: {e}")
+                    row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            embedding = array("f", row[0]).tolist()
+            self._remember(key, embedding)
+            self.hits["disk"] += 1
+            return embedding
+
+    def put(self, text, model, embedding):
+        key = cache_key(text, model, self.endpoint)
+        with self.lock:
+            self._remember(key, list(embedding))
+            if not self.path:
+                return
+            try:
+                connection = self._connect()
+                connection.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) "
+                    "VALUES (?, ?, ?)",
+                    (key, array("f", embedding).tobytes(), time.time()),
+                )
+                self.puts += 1
+                # trimming scans the table, so it runs every TRIM_EVERY writes and
+                # the file may briefly hold up to TRIM_EVERY extra entries
+                if self.puts % self.TRIM_EVERY == 0:
+                    connection.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM "
+                        "embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                        (self.disk_size,),
+                    )
+                connection.commit()
+            except sqlite3.Error as e:
+                print(f"Embedding cache write failed: {e}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits["memory"] + self.hits["disk"] + self.misses
+            return {
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "hit_ratio": (lookups - self.misses) / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+            }
@@ -0,0 +1,126 @@
+"""
+Compact binary store for course embeddings, memory-mapped by the local retriever.
+
+A store is a directory with:
+- vectors.npy: one L2-normalized vector per row, as int8, float16 or float32
+- scales.npy: per-row float32 scale for int8 vectors (row ~= scale * int8 row)
+- ids.json: the course id ("<season_code> <course_code>") of every row
+
+Loading maps vectors.npy read-only instead of reading it, so it takes
+milliseconds and every worker process on the host shares the same pages.
+
+Usage (from the backend directory):
+    python embedding_store.py data/embedding_store --dtype int8
+builds the store from the course embeddings in parsed_courses at MONGO_URI.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+DTYPES = {"int8": np.int8, "float16": np.float16, "float32": np.float32}
+
+
+def course_id(course):
+    return f"{course.get('season_code')} {course.get('course_code')}"
+
+
+class EmbeddingStore:
+    def __init__(self, vectors, scales, ids):
+        self.vectors = vectors
+        self.scales = scales
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids, embeddings, dtype="int8"):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if not len(ids):
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        scales = None
+        if dtype == "int8":
+            # symmetric per-vector quantization: the largest component maps to 127
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            vectors = np.round(vectors / scales[:, None]).astype(np.int8)
+            scales = scales.astype(np.float32)
+        else:
+            vectors = vectors.astype(DTYPES[dtype])
+        return cls(np.ascontiguousarray(vectors), scales, list(ids))
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "vectors.npy"), self.vectors)
+        if self.scales is not None:
+            np.save(os.path.join(directory, "scales.npy"), self.scales)
+        with open(os.path.join(directory, "ids.json"), "w") as file:
+            json.dump(self.ids, file)
+
+    @classmethod
+    def load(cls, directory):
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        scales_path = os.path.join(directory, "scales.npy")
+        scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        with open(os.path.join(directory, "ids.json"), "r") as file:
+            ids = json.load(file)
+        return cls(vectors, scales, ids)
+
+    def scores(self, query, rows=None, chunk_size=1024):
+        """Dot products of the unit-length ``query`` with every row (or ``rows``)."""
+        query = np.asarray(query, dtype=np.float32)
+        if rows is None and self.vectors.dtype == np.float32:
+            scores = self.vectors @ query
+        else:
+            # gather and convert a chunk at a time so the matrix is never copied whole
+            count = len(self.vectors) if rows is None else len(rows)
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, chunk_size):
+                stop = start + chunk_size
+                if rows is None:
+                    chunk = self.vectors[start:stop]
+                else:
+                    chunk = self.vectors[rows[start:stop]]
+                scores[start:stop] = chunk.astype(np.float32, copy=False) @ query
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+
+def main(args):
+    load_dotenv()
+    collection = MongoClient(os.getenv("MONGO_URI"))["course_db"]["parsed_courses"]
+    courses = list(
+        collection.find(
+            {"embedding": {"$exists": True}},
+            {"season_code": 1, "course_code": 1, "embedding": 1},
+        )
+    )
+    store = EmbeddingStore.build(
+        [course_id(course) for course in courses],
+        [course["embedding"] for course in courses],
+        dtype=args.dtype,
+    )
+    store.save(args.directory)
+    print(
+        f"Wrote {len(store)} {args.dtype} vectors "
+        f"({store.vectors.nbytes / 2**20:.1f} MiB) to {args.directory}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", type=str, help="Where to write the store.")
+    parser.add_argument("--dtype", choices=list(DTYPES), default="int8")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,318 @@
+"""
+A stand-in for the OpenAI API, for load testing the backend offline.
+
+It serves the two endpoints lib.py uses, /v1/embeddings and /v1/chat/completions
+(including stream=True), with the same JSON shapes as the real API:
+- embeddings are deterministic hash-seeded unit vectors, so equal texts embed equally
+- tool calls return the arguments of the first matching rule of the script, or a plan
+  that passes every check for QueryPlan and no filters for CourseFilter
+- other completions return the content of the first matching rule of the script,
+  "yes" to the yes/no check prompts, and a canned answer otherwise
+- every response is delayed by a lognormal latency, and a configurable fraction fails
+  with a 429 or 500 error, so production tail latencies can be reproduced
+
+A script is a JSON list of rules, tried in order. A rule matches when every one of its
+"match" strings appears (case-insensitively) somewhere in the request's messages:
+    [
+        {"match": "fall 2024", "tool": "CourseFilter", "arguments": {"season_code": "202403"}},
+        {"match": ["poem", "Am I asking for help"], "content": "no"}
+    ]
+
+Usage (from the backend directory):
+    python fake_openai.py --port 8001 --chat_latency_ms 900 --chat_latency_sigma 0.6 --error_rate 0.01
+    OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=fake flask run
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from uuid import uuid4
+
+from flask import Flask, Response, jsonify, request
+
+from build_course_embeddings import fake_embed
+
+DEFAULT_ANSWER = "Here are some courses at Yale that match what you are looking for."
+
+
+class Latency:
+    """Lognormal delays around a median; sigma is the spread in log space (0 is fixed)."""
+
+    def __init__(self, median_ms=0.0, sigma=0.0, seed=None):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.rng = random.Random(seed)
+
+    def sample(self):
+        if self.median_ms <= 0:
+            return 0.0
+        if self.sigma <= 0:
+            return self.median_ms / 1000
+        return self.rng.lognormvariate(math.log(self.median_ms), self.sigma) / 1000
+
+    def sleep(self):
+        delay = self.sample()
+        if delay:
+            time.sleep(delay)
+
+
+def count_tokens(text):
+    # close enough to tiktoken for usage numbers in a load test
+    return max(1, len(str(text).split())) if text else 0
+
+
+def conversation_text(messages):
+    return "\n".join(m["content"] for m in messages if m.get("content")).lower()
+
+
+def default_arguments(name, messages):
+    if name == "QueryPlan":
+        last_user = [m for m in messages if m.get("role") == "user"]
+        return {
+            "on_topic": True,
+            "needs_courses": True,
+            "search_query": last_user[-1]["content"] if last_user else "",
+            "filters": {},
+        }
+    return {}
+
+
+def default_content(prompt):
+    if '"yes" or "no"' in prompt:
+        return "yes"
+    return DEFAULT_ANSWER
+
+
+def create_fake_openai_app(
+    script=None,
+    chat_latency=None,
+    embedding_latency=None,
+    token_latency=None,
+    error_rate=0.0,
+    error_statuses=(429, 500),
+    seed=None,
+):
+    app = Flask(__name__)
+    script = script or []
+    chat_latency = chat_latency or Latency()
+    embedding_latency = embedding_latency or Latency()
+    token_latency = token_latency or Latency()
+    rng = random.Random(seed)
+    app.config["stats"] = {"embeddings": 0, "chat_completions": 0, "errors": 0}
+    stats_lock = threading.Lock()
+
+    def count(name):
+        with stats_lock:
+            app.config["stats"][name] += 1
+
+    def injected_error():
+        if error_rate and rng.random() < error_rate:
+            count("errors")
+            status = rng.choice(list(error_statuses))
+            error = {
+                "message": "Injected error from the fake OpenAI server",
+                "type": "rate_limit_error" if status == 429 else "server_error",
+                "param": None,
+                "code": None,
+            }
+            return jsonify({"error": error}), status
+        return None
+
+    def find_rule(messages, tool=None):
+        text = conversation_text(messages)
+        for rule in script:
+            if rule.get("tool") != tool:
+                continue
+            match = rule.get("match", "")
+            if isinstance(match, str):
+                match = [match]
+            if all(part.lower() in text for part in match):
+                return rule
+        return None
+
+    @app.route("/v1/embeddings", methods=["POST"])
+    def embeddings():
+        count("embeddings")
+        embedding_latency.sleep()
+        error = injected_error()
+        if error:
+            return error
+        data = request.get_json()
+        texts = data["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        vectors = fake_embed(
+            texts, data["model"], dimensions=data.get("dimensions") or 1536
+        )
+        tokens = sum(count_tokens(text) for text in texts)
+        return jsonify(
+            {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": vector}
+                    for i, vector in enumerate(vectors)
+                ],
+                "model": data["model"],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    @app.route("/v1/chat/completions", methods=["POST"])
+    def chat_completions():
+        count("chat_completions")
+        data = request.get_json()
+        if not data.get("stream"):
+            # a streamed completion is delayed until its first token instead
+            chat_latency.sleep()
+        error = injected_error()
+        if error:
+            return error
+
+        messages = data["messages"]
+        tool_choice = data.get("tool_choice")
+        message = {"role": "assistant", "content": None}
+        finish_reason = "stop"
+        if data.get("tools"):
+            if isinstance(tool_choice, dict):
+                name = tool_choice["function"]["name"]
+            else:
+                name = data["tools"][0]["function"]["name"]
+            rule = find_rule(messages, tool=name)
+            arguments = rule["arguments"] if rule else default_arguments(name, messages)
+            message["tool_calls"] = [
+                {
+                    "id": f"call_{uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(arguments)},
+                }
+            ]
+            finish_reason = "tool_calls"
+        else:
+            rule = find_rule(messages)
+            message["content"] = (
+                rule["content"]
+                if rule
+                else default_content(messages[-1].get("content") or "")
+            )
+
+        completion_id = f"chatcmpl-{uuid4().hex[:29]}"
+        prompt_tokens = sum(count_tokens(m.get("content")) for m in messages)
+        completion_tokens = count_tokens(
+            message["content"] or message["tool_calls"][0]["function"]["arguments"]
+        )
+
+        if data.get("stream"):
+            return Response(
+                stream_completion(
+                    completion_id, data["model"], message["content"] or ""
+                ),
+                mimetype="text/event-stream",
+            )
+
+        return jsonify(
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": data["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": message,
+                        "logprobs": None,
+                        "finish_reason": finish_reason,
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+        )
+
+    def stream_completion(completion_id, model, content):
+        def chunk(delta, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+            return f"data: {json.dumps(payload)}\n\n"
+
+        chat_latency.sleep()
+        yield chunk({"role": "assistant", "content": ""})
+        for i, word in enumerate(content.split(" ")):
+            if i:
+                token_latency.sleep()
+            yield chunk({"content": word if i == 0 else " " + word})
+        yield chunk({}, finish_reason="stop")
+        yield "data: [DONE]\n\n"
+
+    return app
+
+
+def main(args):
+    script = []
+    if args.script:
+        with open(args.script, "r") as file:
+            script = json.load(file)
+    app = create_fake_openai_app(
+        script=script,
+        chat_latency=Latency(args.chat_latency_ms, args.chat_latency_sigma, args.seed),
+        embedding_latency=Latency(
+            args.embedding_latency_ms, args.embedding_latency_sigma, args.seed
+        ),
+        token_latency=Latency(args.token_latency_ms, 0, args.seed),
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    print(f"Fake OpenAI API at http://{args.host}:{args.port}/v1")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--script", type=str, default=None, help="JSON file of scripted responses."
+    )
+    parser.add_argument(
+        "--chat_latency_ms",
+        type=float,
+        default=0,
+        help="Median delay of a chat completion (time to first token when streamed).",
+    )
+    parser.add_argument(
+        "--chat_latency_sigma",
+        type=float,
+        default=0,
+        help="Lognormal spread of the chat delay; 0.5-0.8 gives a realistic tail.",
+    )
+    parser.add_argument("--embedding_latency_ms", type=float, default=0)
+    parser.add_argument("--embedding_latency_sigma", type=float, default=0)
+    parser.add_argument(
+        "--token_latency_ms",
+        type=float,
+        default=0,
+        help="Delay between streamed tokens.",
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0,
+        help="Fraction of requests that fail with a 429 or 500.",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+
+    args = parser.parse_args()
+
+    main(args)
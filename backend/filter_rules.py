@@ -0,0 +1,220 @@
+"""
+Course filters read straight off the user's messages, without the CourseFilter call.
+
+The CourseFilter tool call sends a schema with every subject code and season code
+in it, for what is usually a season, a subject, an area or a skill written out
+plainly: "Fall 2024", "CPSC", "QR", "writing credit". extract_filters reads those
+with regular expressions in microseconds. It returns None when the messages say
+something it can't settle (a season without a year, two subjects, "science" on its
+own, a filter next to a negation), and the chat turn asks CourseFilter instead.
+A subject's name is only read as the subject when a word like "courses" or
+"department" follows it: "history courses" is HIST, but "the history of
+medicine", "immigration law" and "music and math" are left to CourseFilter.
+
+Only the filters resolve_course_filters applies are read: subject, season_code,
+areas and skills. CourseFilter's rating and workload are never used.
+
+`python -m benchmarks.bench_filters` compares it with the tool call.
+
+extract_course_codes finds the course codes a message asks about ("is ECON 115
+hard?"), which the chat turn looks up directly instead of searching for them.
+about_other_courses tells those apart from messages that name a course only to
+ask for others ("what should I take after CPSC 201?", "courses like ECON 115"),
+which are still searched for.
+"""
+
+import re
+
+from lib import season_codes, subjects
+
+SEASONS = {"spring": "01", "summer": "02", "fall": "03", "autumn": "03"}
+
+# Subject names that read as an area, a season or a word rather than the subject
+AMBIGUOUS_SUBJECTS = {"HUMS", "SCIE", "SUMR", "MD"}
+# What students call the subjects, beside their codes and names
+SUBJECT_ALIASES = {
+    "cs": "CPSC",
+    "comp sci": "CPSC",
+    "compsci": "CPSC",
+    "econ": "ECON",
+    "math": "MATH",
+    "maths": "MATH",
+    "psych": "PSYC",
+    "poli sci": "PLSC",
+    "polisci": "PLSC",
+    "stats": "S&DS",
+    "statistics": "S&DS",
+    "data science": "S&DS",
+    "bio": "BIOL",
+    "chem": "CHEM",
+    "neuro": "NSCI",
+    "philo": "PHIL",
+    "art history": "HSAR",
+    "ee": "EENG",
+    "mech e": "MENG",
+}
+
+AREAS = {
+    "Hu": r"\bhumanities\b(?! majors?)|\bHu\b",
+    "So": r"\bsocial sciences?\b",
+    "Sc": r"\b(?:natural )?sciences? (?:credit|requirement|distributional)s?\b|\bSc\b",
+}
+SKILLS = {
+    "QR": r"\bQR\b|\bquantitative(?: reasoning)?\b",
+    "WR": r"\bWR\b|\bwriting[- ](?:credit|requirement|intensive)s?\b",
+}
+
+
+def alternation(phrases):
+    # longest first, so "computer science and economics" wins over "computer science"
+    return "|".join(
+        re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True)
+    )
+
+
+SUBJECT_NAMES = {
+    name.lower(): code
+    for code, name in subjects.items()
+    if code not in AMBIGUOUS_SUBJECTS
+}
+SUBJECT_NAMES.update(SUBJECT_ALIASES)
+
+SEASON = re.compile(
+    r"\b(spring|summer|fall|autumn)\s*(?:of\s+|')?(\d{4}|\d{2})\b"
+    r"|\b(\d{4})\s+(spring|summer|fall|autumn)\b",
+    re.IGNORECASE,
+)
+SUBJECT_NAME = re.compile(rf"\b(?:{alternation(SUBJECT_NAMES)})\b", re.IGNORECASE)
+# "history courses", "the English department": a name that means the subject
+DEPARTMENT_WORDS = (
+    r"courses?|class(?:es)?|seminars?|lectures?|electives?|sections?"
+    r"|department|dept|majors?|programs?|requirements?|credits?"
+)
+SUBJECT_NAME_OF_DEPARTMENT = re.compile(
+    rf"\b(?:{alternation(SUBJECT_NAMES)})(?=[\s-]+(?:{DEPARTMENT_WORDS})\b)",
+    re.IGNORECASE,
+)
+# "CPSC", "S&DS" as written, or any case when followed by a course number
+SUBJECT_CODE = re.compile(r"(?<![\w&])([A-Z][A-Z&]{1,3})(?![A-Za-z&])")
+COURSE_NUMBER = re.compile(r"(?<![\w&])([a-z&]{2,4}) ?\d{3}\b", re.IGNORECASE)
+# a course code as stored in course_code: "CPSC 323", "S&DS 230", "CHEM 134L"
+COURSE_CODE = re.compile(r"(?<![\w&])([A-Za-z&]{2,4}) ?(\d{3,4}[A-Za-z]?)\b")
+AREA = {area: re.compile(pattern, re.IGNORECASE) for area, pattern in AREAS.items()}
+SKILL = {skill: re.compile(pattern, re.IGNORECASE) for skill, pattern in SKILLS.items()}
+
+# Left over once everything above is taken out, these mean a filter the rules
+# can't read: a season or year on its own, or an area or skill in other words
+UNSETTLED = re.compile(
+    r"\b(?:spring|summer|fall|autumn|semester|term|20\d\d|sciences?|writing|humanit\w*)\b",
+    re.IGNORECASE,
+)
+# "not QR", "no classes in Fall 2024": a negation shortly before a filter
+NEGATION = re.compile(
+    r"\b(?:not|no|without|except|excluding|besides|other than)\b|n't", re.IGNORECASE
+)
+NEGATION_REACH = 20
+# Words that make the courses a message names a reference point for others:
+# "after CPSC 201", "courses like ECON 115", "easier than MATH 120". "I like"
+# and "would like" are about the courses named.
+OTHER_COURSES = re.compile(
+    r"\b(?:after|before|next|instead|besides|beyond|than|unlike|similar|related"
+    r"|comparable|alternatives?|else|others|prereq\w*|follow\w*|leads? (?:in)?to"
+    r"|other (?:courses?|classes|options)|more (?:courses?|classes))\b"
+    r"|(?<!would )(?<!'d )(?<!\bi )\blike\b",
+    re.IGNORECASE,
+)
+
+
+def take(pattern, text, found, accept=None):
+    # blanks out the matches of pattern in text (those accept() takes, if given),
+    # adding them to found
+    def blank(match):
+        if accept is not None and not accept(match):
+            return match.group(0)
+        found.append(match)
+        return " " * len(match.group(0))
+
+    return pattern.sub(blank, text)
+
+
+def is_subject(match):
+    return match.group(1).upper() in subjects
+
+
+def season_code(match):
+    if match.group(1):
+        season, year = match.group(1), match.group(2)
+    else:
+        year, season = match.group(3), match.group(4)
+    if len(year) == 2:
+        year = "20" + year
+    return year + SEASONS[season.lower()]
+
+
+def extract_filters(messages):
+    """CourseFilter's arguments for the user's messages, or None if unsure.
+
+    Returns a dict with any of subject, season_code, areas and skills, one value
+    each (possibly empty: no filters at all).
+    """
+    text = "\n".join(
+        message.get("content") or ""
+        for message in messages
+        if message.get("role") == "user"
+    )
+    values = {"season_code": set(), "subject": set(), "areas": set(), "skills": set()}
+    matches = []
+
+    found = []
+    rest = take(SEASON, text, found)
+    values["season_code"] = {season_code(match) for match in found}
+    matches += found
+
+    found = []
+    rest = take(SUBJECT_NAME_OF_DEPARTMENT, rest, found)
+    values["subject"].update(SUBJECT_NAMES[match.group(0).lower()] for match in found)
+    matches += found
+    found = []
+    rest = take(COURSE_NUMBER, rest, found, accept=is_subject)
+    rest = take(SUBJECT_CODE, rest, found, accept=is_subject)
+    values["subject"].update(match.group(1).upper() for match in found)
+    matches += found
+    # any other subject name may be a topic ("history of medicine") or the subject
+    if SUBJECT_NAME.search(rest):
+        return None
+
+    for key, patterns in (("areas", AREA), ("skills", SKILL)):
+        for value, pattern in patterns.items():
+            found = []
+            rest = take(pattern, rest, found)
+            if found:
+                values[key].add(value)
+            matches += found
+
+    if UNSETTLED.search(rest):
+        return None
+    if any(len(found) > 1 for found in values.values()):
+        return None
+    if not values["season_code"] <= set(season_codes):
+        return None
+    for match in matches:
+        before = text[max(match.start() - NEGATION_REACH, 0) : match.start()]
+        if NEGATION.search(before):
+            return None
+    return {key: found.pop() for key, found in values.items() if found}
+
+
+def extract_course_codes(text):
+    """The course codes in text, formatted like course_code, in order of mention."""
+    codes = []
+    for match in COURSE_CODE.finditer(text or ""):
+        subject = match.group(1).upper()
+        code = f"{subject} {match.group(2).upper()}"
+        if subject in subjects and code not in codes:
+            codes.append(code)
+    return codes
+
+
+def about_other_courses(text):
+    """True if text names courses only to ask about other ones."""
+    return OTHER_COURSES.search(text or "") is not None
@@ -0,0 +1,23 @@
+# gunicorn reads this file from the working directory
+import os
+import shutil
+import tempfile
+
+# Every worker writes its metrics to files here so /metrics can add them up.
+# Set before any worker imports prometheus_client, which reads it on import.
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "bluebook_metrics")
+)
+
+
+def on_starting(server):
+    # files left over from a previous run would be counted again
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # drop the live gauges of the dead worker; its counters are kept
+    multiprocess.mark_process_dead(worker.pid)
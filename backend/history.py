@@ -0,0 +1,111 @@
+"""
+How much of the conversation each LLM call of a chat turn is sent.
+
+The frontend sends the whole conversation with every turn, and a turn makes up to
+five completions from it, so without a limit every call's prompt (and its latency
+and cost) grows with the length of the chat. trim_history keeps the system prompt
+and the latest messages that fit in a call's token budget. The calls that only
+need the latest question (the checks, the search query rewrite, the filters and
+the title) get a small window; the final answer gets most of the context.
+
+Tokens are counted with tiktoken when it is installed (pip install tiktoken) and
+its tables can be loaded, otherwise estimated from the length of the text.
+
+Set in the environment: HISTORY_BUDGET_<CALL> (e.g. HISTORY_BUDGET_FINAL=4000)
+to change the budget of one call.
+"""
+
+import math
+import os
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Conversation tokens each call may send, the system prompt included. The call's
+# own instruction is appended after trimming and is not counted.
+DEFAULT_BUDGETS = {
+    "safety": 500,
+    "relevancy": 500,
+    "search_query": 800,
+    "filter": 800,
+    "plan": 1000,
+    "final": 5000,
+    "slug": 500,
+}
+HISTORY_BUDGETS = {
+    call: int(os.getenv(f"HISTORY_BUDGET_{call.upper()}", budget))
+    for call, budget in DEFAULT_BUDGETS.items()
+}
+
+# Every message costs a few tokens for its role and separators on top of its content
+MESSAGE_OVERHEAD = 3
+# English averages about 4 characters per token; estimating 3 errs towards
+# sending less than the budget
+CHARS_PER_TOKEN = 3
+
+
+@lru_cache(maxsize=None)
+def encoding(model="gpt-4"):
+    # None without tiktoken, or if it can't download its tables
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    tokenizer = encoding()
+    if tokenizer is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(tokenizer.encode(text))
+
+
+def truncate(text, tokens):
+    # the first `tokens` tokens of text
+    tokenizer = encoding()
+    if tokenizer is None:
+        return text[: tokens * CHARS_PER_TOKEN]
+    return tokenizer.decode(tokenizer.encode(text)[:tokens])
+
+
+def message_tokens(message):
+    return MESSAGE_OVERHEAD + count_tokens(message.get("content"))
+
+
+def history_tokens(messages):
+    return sum(message_tokens(message) for message in messages)
+
+
+def trim_history(messages, budget):
+    """The leading system messages and the latest messages that fit in budget.
+
+    Older messages are dropped whole. The latest message is always kept; if it
+    doesn't fit on its own its content is cut to what does.
+    """
+    start = 0
+    while start < len(messages) and messages[start]["role"] == "system":
+        start += 1
+    system, conversation = messages[:start], messages[start:]
+
+    used = history_tokens(system)
+    kept = []
+    for message in reversed(conversation):
+        tokens = message_tokens(message)
+        if used + tokens > budget:
+            if not kept:
+                room = max(budget - used - MESSAGE_OVERHEAD, 0)
+                kept.append(
+                    dict(message, content=truncate(message.get("content") or "", room))
+                )
+            break
+        kept.append(message)
+        used += tokens
+
+    return system + kept[::-1]
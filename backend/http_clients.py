@@ -0,0 +1,134 @@
+"""
+Pooled HTTP clients for the services the backend calls: OpenAI and Yale CAS.
+
+Each service gets one client per process, shared by every request, so connections
+and their TLS handshakes are reused across requests instead of opened per call. Each
+has its own connect and read timeouts, so a slow service fails the request that
+called it instead of holding a worker indefinitely. Every request and every new
+connection is counted in metrics.py under the service's name.
+
+Set in the environment (seconds unless noted):
+    OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT  defaults 5 and 60; the read timeout
+        is per chunk, so a long streamed answer is fine
+    OPENAI_POOL_SIZE  connections kept open per process, default 100
+    OPENAI_HTTP2=1  multiplex the OpenAI calls over HTTP/2 (pip install h2)
+    CAS_CONNECT_TIMEOUT, CAS_READ_TIMEOUT, CAS_POOL_SIZE  defaults 3, 10 and 10
+"""
+
+import os
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", 5))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", 60))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", 100))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "").lower() in ("1", "true", "yes")
+# pooled connections idle for longer than this are closed
+OPENAI_KEEPALIVE_EXPIRY = 60
+
+CAS_CONNECT_TIMEOUT = float(os.getenv("CAS_CONNECT_TIMEOUT", 3))
+CAS_READ_TIMEOUT = float(os.getenv("CAS_READ_TIMEOUT", 10))
+CAS_POOL_SIZE = int(os.getenv("CAS_POOL_SIZE", 10))
+
+OPENAI_TIMEOUT = httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+CAS_TIMEOUT = (CAS_CONNECT_TIMEOUT, CAS_READ_TIMEOUT)
+
+
+class MeteredTransport(httpx.HTTPTransport):
+    """An httpx transport that counts its requests and the connections it opens."""
+
+    def __init__(self, dependency, **kwargs):
+        super().__init__(**kwargs)
+        self.dependency = dependency
+
+    def trace(self, event, info):
+        # httpcore reports each step of a request to the "trace" extension
+        if event == "connection.connect_tcp.complete":
+            metrics.count_connections(self.dependency)
+
+    def handle_request(self, request):
+        request.extensions["trace"] = self.trace
+        with metrics.outbound_request(self.dependency):
+            return super().handle_request(request)
+
+
+class AsyncMeteredTransport(httpx.AsyncHTTPTransport):
+    """MeteredTransport for httpx.AsyncClient."""
+
+    def __init__(self, dependency, **kwargs):
+        super().__init__(**kwargs)
+        self.dependency = dependency
+
+    async def trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            metrics.count_connections(self.dependency)
+
+    async def handle_async_request(self, request):
+        request.extensions["trace"] = self.trace
+        with metrics.outbound_request(self.dependency):
+            return await super().handle_async_request(request)
+
+
+def metered_pool_class(pool_class, dependency):
+    # a urllib3 pool class whose connections count every time they connect,
+    # reconnects of a dropped keep-alive connection included
+    class MeteredConnection(pool_class.ConnectionCls):
+        def connect(self):
+            metrics.count_connections(dependency)
+            return super().connect()
+
+    return type(
+        pool_class.__name__, (pool_class,), {"ConnectionCls": MeteredConnection}
+    )
+
+
+class MeteredAdapter(HTTPAdapter):
+    """A requests adapter that counts its requests and connections, with a default timeout."""
+
+    def __init__(self, dependency, timeout, **kwargs):
+        self.dependency = dependency
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: metered_pool_class(pool_class, self.dependency)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def send(self, request, timeout=None, **kwargs):
+        with metrics.outbound_request(self.dependency):
+            return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def openai_limits(pool_size=OPENAI_POOL_SIZE):
+    return httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+
+
+def openai_http_client(pool_size=OPENAI_POOL_SIZE, http2=OPENAI_HTTP2):
+    transport = MeteredTransport("openai", limits=openai_limits(pool_size), http2=http2)
+    return httpx.Client(transport=transport, timeout=OPENAI_TIMEOUT)
+
+
+def openai_async_http_client(pool_size=OPENAI_POOL_SIZE, http2=OPENAI_HTTP2):
+    transport = AsyncMeteredTransport(
+        "openai", limits=openai_limits(pool_size), http2=http2
+    )
+    return httpx.AsyncClient(transport=transport, timeout=OPENAI_TIMEOUT)
+
+
+def cas_session(pool_size=CAS_POOL_SIZE, timeout=CAS_TIMEOUT):
+    session = requests.Session()
+    adapter = MeteredAdapter("cas", timeout, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -0,0 +1,141 @@
+"""
+In-process BM25 over the course text, the lexical half of HybridRetriever.
+
+Course embeddings blur the exact words of a query: a professor's name, a rare
+topic word, a course number. BM25 matches them word for word over the text the
+embeddings are built from (build_course_embeddings.text_to_embed): course code,
+title, professors and description.
+
+The index is built once, in memory, and laid out like a CSR matrix: the postings
+of every term are one slice of `rows` (the courses it occurs in) and `weights`
+(its BM25 weight in each, precomputed, since the corpus doesn't change). A query
+adds up the slices of its terms into one score per course.
+
+`python -m benchmarks.bench_hybrid` measures the build time, memory and latency.
+"""
+
+import re
+from collections import Counter
+
+import numpy as np
+
+TOKEN = re.compile(r"[a-z0-9&]+")
+# too common in course descriptions to tell courses apart
+STOPWORDS = {
+    "a",
+    "about",
+    "an",
+    "and",
+    "are",
+    "as",
+    "at",
+    "be",
+    "by",
+    "class",
+    "classes",
+    "course",
+    "courses",
+    "for",
+    "from",
+    "i",
+    "in",
+    "is",
+    "it",
+    "me",
+    "of",
+    "on",
+    "or",
+    "that",
+    "the",
+    "this",
+    "to",
+    "with",
+}
+
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def course_text(course):
+    # text_to_embed's fields, plus the code without its space ("cpsc323")
+    code = course.get("course_code") or ""
+    return " ".join(
+        [
+            code,
+            code.replace(" ", ""),
+            course.get("title") or "",
+            " ".join(course.get("professors") or []),
+            course.get("description") or "",
+        ]
+    )
+
+
+class BM25Index:
+    """Okapi BM25 scores of a query against every document, by term postings."""
+
+    def __init__(self, texts, k1=1.2, b=0.75):
+        self.vocabulary = {}
+        rows, terms, counts, lengths = [], [], [], []
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                rows.append(row)
+                terms.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                counts.append(count)
+        self.size = len(lengths)
+
+        # postings grouped by term, each term's rows in order
+        terms = np.asarray(terms, dtype=np.int64)
+        order = np.argsort(terms, kind="stable")
+        terms = terms[order]
+        rows = np.asarray(rows, dtype=np.int64)[order]
+        counts = np.asarray(counts, dtype=np.float64)[order]
+        document_frequency = np.bincount(terms, minlength=len(self.vocabulary))
+        self.offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(document_frequency, out=self.offsets[1:])
+
+        lengths = np.asarray(lengths, dtype=np.float64)
+        average_length = lengths.mean() if self.size and lengths.mean() else 1.0
+        idf = np.log(
+            1 + (self.size - document_frequency + 0.5) / (document_frequency + 0.5)
+        )
+        norm = k1 * (1 - b + b * lengths[rows] / average_length)
+        self.rows = rows.astype(np.int32)
+        self.weights = (idf[terms] * counts * (k1 + 1) / (counts + norm)).astype(
+            np.float32
+        )
+
+    @property
+    def nbytes(self):
+        # the postings arrays; the vocabulary dict adds roughly 100 bytes a term
+        return self.offsets.nbytes + self.rows.nbytes + self.weights.nbytes
+
+    def scores(self, query):
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # a term's rows are distinct, so this adds once per row
+            scores[self.rows[start:end]] += self.weights[start:end]
+        return scores
+
+    def search(self, query, limit, mask=None):
+        """Rows of the best `limit` matches of query, best first.
+
+        Only rows with a positive score count as matches, and only those in mask
+        (a boolean array over the rows), if given.
+        """
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0
+        matched = np.flatnonzero(scores > 0)
+        k = min(limit, len(matched))
+        if k <= 0:
+            return []
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return top.tolist()
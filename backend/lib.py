@@ -1,9 +1,26 @@
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+import asyncio
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 import os
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 import json
 from dotenv import load_dotenv
 from pathlib import Path
+from embedding_cache import EmbeddingCache
+from http_clients import OPENAI_TIMEOUT, openai_async_http_client, openai_http_client
+from resilience import CircuitBreaker, bounded_timeout, past_deadline
+from tracing import span
+from metrics import count_cache_lookup, count_retry, count_tokens, openai_call
 
 load_dotenv()
 
@@ -78,31 +95,217 @@ tools = [
     }
 ]
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# One call that answers the safety check, the relevancy check, the search query
+# rewrite and CourseFilter together (QUERY_PLANNER_ENABLED in app.py)
+planner_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "QueryPlan",
+            "description": "Plan how to answer the user's latest message.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "on_topic": {
+                        "type": "boolean",
+                        "description": "Whether the user is asking for help with courses or academics.",
+                    },
+                    "needs_courses": {
+                        "type": "boolean",
+                        "description": "Whether the question would be better answered with access to specific courses at Yale University.",
+                    },
+                    "search_query": {
+                        "type": "string",
+                        "description": "A good search query (in conventional english) to query against the Yale courses database that addresses the user needs.",
+                    },
+                    "filters": tools[0]["function"]["parameters"],
+                },
+                "required": ["on_topic", "needs_courses", "search_query", "filters"],
+            },
+        },
+    }
+]
+
+# OPENAI_BASE_URL points the client at another OpenAI-compatible server,
+# e.g. fake_openai.py for offline load tests. Connections, timeouts and HTTP/2
+# are set up in http_clients.py. The retry decorators below are the only
+# retries, so the client's own are turned off.
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    base_url=os.getenv("OPENAI_BASE_URL") or None,
+    timeout=OPENAI_TIMEOUT,
+    max_retries=0,
+    http_client=openai_http_client(),
+)
+# the same API from an event loop, for the ASGI app in asgi.py
+async_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    base_url=os.getenv("OPENAI_BASE_URL") or None,
+    timeout=OPENAI_TIMEOUT,
+    max_retries=0,
+    http_client=openai_async_http_client(),
+)
+
+# Errors that mean OpenAI is slow, overloaded or down, rather than that the
+# request was wrong: they are retried and they trip the circuit breaker
+OPENAI_OUTAGE_ERRORS = (
+    APIConnectionError,  # includes APITimeoutError
+    RateLimitError,
+    InternalServerError,
+)
+openai_breaker = CircuitBreaker(
+    "openai",
+    failure_threshold=int(os.getenv("OPENAI_BREAKER_FAILURES", 5)),
+    reset_timeout=float(os.getenv("OPENAI_BREAKER_RESET_TIMEOUT", 30)),
+    failure_types=OPENAI_OUTAGE_ERRORS,
+)
+
+# Repeat search queries skip the embeddings API. The SQLite file is shared by
+# every worker on the host; set EMBEDDING_CACHE_PATH="" to keep it in memory only.
+# Embeddings from an OPENAI_BASE_URL server are keyed apart from OpenAI's.
+embedding_cache = EmbeddingCache(
+    os.getenv(
+        "EMBEDDING_CACHE_PATH",
+        str(root_dir / "backend" / "data" / "embedding_cache.sqlite3"),
+    ),
+    memory_size=int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", 1024)),
+    disk_size=int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", 100_000)),
+    endpoint=os.getenv("OPENAI_BASE_URL") or None,
+)
+
+
+def record_usage(record, response, operation, model):
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record["prompt_tokens"] = usage.prompt_tokens
+        record["completion_tokens"] = getattr(usage, "completion_tokens", 0)
+    count_tokens(operation, model, usage)
 
 
-@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
+# Every call raises on failure once its attempts run out (or the request's
+# deadline passes, or the circuit is open), for the caller to handle
+openai_retry = retry(
+    retry=retry_if_exception_type(OPENAI_OUTAGE_ERRORS),
+    wait=wait_random_exponential(multiplier=1, max=40),
+    stop=stop_after_attempt(3) | past_deadline,
+    before_sleep=count_retry,
+    reraise=True,
+)
+
+
+@openai_retry
 def create_embedding(text, model="text-embedding-3-small"):
-    try:
-        response = client.embeddings.create(input=text, model="text-embedding-3-small")
-        return response.data[0].embedding
-    except Exception as e:
-        print("Unable to generate embedding")
-        print(f"Exception: {e}")
-        return e
+    embedding = embedding_cache.get(text, model)
+    count_cache_lookup("embedding", embedding is not None)
+    if embedding is not None:
+        with span("embedding", model=model, cached=True):
+            return embedding
+    with openai_breaker.guard(), span(
+        "embedding", model=model, cached=False
+    ) as record, openai_call("embedding", model):
+        response = client.embeddings.create(
+            input=text, model=model, timeout=bounded_timeout(OPENAI_TIMEOUT)
+        )
+        record_usage(record, response, "embedding", model)
+    embedding = response.data[0].embedding
+    embedding_cache.put(text, model, embedding)
+    return embedding
 
 
-@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
+@openai_retry
 def chat_completion_request(messages, tools=None, tool_choice=None, model="gpt-4"):
-    try:
+    with openai_breaker.guard(), span(
+        "chat_completion", model=model
+    ) as record, openai_call("chat", model):
         response = client.chat.completions.create(
             model=model,
             messages=messages,
             tools=tools,
             tool_choice=tool_choice,
+            timeout=bounded_timeout(OPENAI_TIMEOUT),
+        )
+        record_usage(record, response, "chat", model)
+    return response
+
+
+# Not retried: a retry after the first token would repeat the answer
+def chat_completion_stream(messages, model="gpt-4"):
+    with span("chat_completion_stream", model=model) as record, openai_call(
+        "chat_stream", model
+    ):
+        with openai_breaker.guard():
+            stream = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                timeout=bounded_timeout(OPENAI_TIMEOUT),
+            )
+        chunks = 0
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks += 1
+                yield chunk.choices[0].delta.content
+        record["completion_chunks"] = chunks
+
+
+# The async twins of the calls above, used by asgi.py. They share the embedding
+# cache, the circuit breaker, the spans and the metrics. The embedding cache's
+# SQLite tier blocks (on a busy file, for up to its 30 s timeout), so it is read
+# and written on a thread rather than on the event loop.
+
+
+@openai_retry
+async def create_embedding_async(text, model="text-embedding-3-small"):
+    loop = asyncio.get_running_loop()
+    embedding = await loop.run_in_executor(None, embedding_cache.get, text, model)
+    count_cache_lookup("embedding", embedding is not None)
+    if embedding is not None:
+        with span("embedding", model=model, cached=True):
+            return embedding
+    with openai_breaker.guard(), span(
+        "embedding", model=model, cached=False
+    ) as record, openai_call("embedding", model):
+        response = await async_client.embeddings.create(
+            input=text, model=model, timeout=bounded_timeout(OPENAI_TIMEOUT)
         )
-        return response
-    except Exception as e:
-        print("Unable to generate ChatCompletion response")
-        print(f"Exception: {e}")
-        return e
+        record_usage(record, response, "embedding", model)
+    embedding = response.data[0].embedding
+    await loop.run_in_executor(None, embedding_cache.put, text, model, embedding)
+    return embedding
+
+
+@openai_retry
+async def chat_completion_request_async(
+    messages, tools=None, tool_choice=None, model="gpt-4"
+):
+    with openai_breaker.guard(), span(
+        "chat_completion", model=model
+    ) as record, openai_call("chat", model):
+        response = await async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            timeout=bounded_timeout(OPENAI_TIMEOUT),
+        )
+        record_usage(record, response, "chat", model)
+    return response
+
+
+async def chat_completion_stream_async(messages, model="gpt-4"):
+    with span("chat_completion_stream", model=model) as record, openai_call(
+        "chat_stream", model
+    ):
+        with openai_breaker.guard():
+            stream = await async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                timeout=bounded_timeout(OPENAI_TIMEOUT),
+            )
+        chunks = 0
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks += 1
+                yield chunk.choices[0].delta.content
+        record["completion_chunks"] = chunks
@@ -0,0 +1,204 @@
+"""
+Prometheus metrics for the backend, exposed at /metrics.
+
+Under gunicorn every worker is its own process, so each keeps its own counters.
+With PROMETHEUS_MULTIPROC_DIR set (gunicorn.conf.py sets it) the workers write
+their values to files in that directory and /metrics adds them all up, whichever
+worker answers the scrape. Cache hit ratios are computed at query time, e.g.
+    sum(rate(bluebook_cache_lookups_total{result="hit"}[5m]))
+      / sum(rate(bluebook_cache_lookups_total[5m]))
+and so is the share of outbound requests that reused a pooled connection:
+    1 - sum by (dependency) (rate(bluebook_outbound_connections_total[5m]))
+      / sum by (dependency) (rate(bluebook_outbound_requests_total[5m]))
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from pymongo import monitoring
+
+# OpenAI calls and whole chat turns take seconds, so the default buckets stop short
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+HTTP_REQUESTS = Counter(
+    "bluebook_http_requests_total",
+    "HTTP requests by route, method and status code.",
+    ["route", "method", "status"],
+)
+HTTP_LATENCY = Histogram(
+    "bluebook_http_request_duration_seconds",
+    "Time to respond to an HTTP request (to the headers, for streams).",
+    ["route", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge(
+    "bluebook_http_requests_in_flight",
+    "HTTP requests being handled.",
+    multiprocess_mode="livesum",
+)
+OPENAI_REQUESTS = Counter(
+    "bluebook_openai_requests_total",
+    "OpenAI API calls by operation, model and outcome.",
+    ["operation", "model", "outcome"],
+)
+OPENAI_LATENCY = Histogram(
+    "bluebook_openai_request_duration_seconds",
+    "Duration of OpenAI API calls.",
+    ["operation", "model"],
+    buckets=LATENCY_BUCKETS,
+)
+OPENAI_RETRIES = Counter(
+    "bluebook_openai_retries_total",
+    "OpenAI API calls retried by the tenacity decorators in lib.py.",
+    ["function"],
+)
+OPENAI_TOKENS = Counter(
+    "bluebook_openai_tokens_total",
+    "Tokens used by OpenAI API calls.",
+    ["operation", "model", "kind"],
+)
+MONGO_LATENCY = Histogram(
+    "bluebook_mongo_command_duration_seconds",
+    "Duration of MongoDB commands.",
+    ["command", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+OUTBOUND_REQUESTS = Counter(
+    "bluebook_outbound_requests_total",
+    "HTTP requests sent to other services (OpenAI, CAS), retries included.",
+    ["dependency"],
+)
+OUTBOUND_CONNECTIONS = Counter(
+    "bluebook_outbound_connections_total",
+    "New connections opened to other services; the rest reused a pooled one.",
+    ["dependency"],
+)
+OUTBOUND_IN_FLIGHT = Gauge(
+    "bluebook_outbound_requests_in_flight",
+    "HTTP requests to other services waiting on a response.",
+    ["dependency"],
+    multiprocess_mode="livesum",
+)
+CIRCUIT_OPEN = Gauge(
+    "bluebook_circuit_open",
+    "1 while a dependency's circuit breaker is open (in any worker).",
+    ["dependency"],
+    multiprocess_mode="livemax",
+)
+CIRCUIT_REJECTIONS = Counter(
+    "bluebook_circuit_rejections_total",
+    "Calls failed at once because the dependency's circuit breaker was open.",
+    ["dependency"],
+)
+CHAT_DEGRADED = Counter(
+    "bluebook_chat_degraded_total",
+    "Chat turn stages that failed or ran out of time and were worked around.",
+    ["stage"],
+)
+CHAT_SUMMARIES = Counter(
+    "bluebook_chat_summaries_total",
+    "Background chat summary refreshes by outcome.",
+    ["outcome"],
+)
+FILTER_EXTRACTIONS = Counter(
+    "bluebook_filter_extractions_total",
+    "Chat turns whose filters were read by the rules or asked of CourseFilter.",
+    ["source"],
+)
+COURSE_CODE_LOOKUPS = Counter(
+    "bluebook_course_code_lookups_total",
+    "Chat turns naming course codes, by whether a course was found for them.",
+    ["result"],
+)
+CACHE_LOOKUPS = Counter(
+    "bluebook_cache_lookups_total",
+    "Embedding and answer cache lookups by result.",
+    ["cache", "result"],
+)
+
+
+@contextmanager
+def openai_call(operation, model):
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        OPENAI_REQUESTS.labels(operation, model, outcome).inc()
+        OPENAI_LATENCY.labels(operation, model).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def outbound_request(dependency):
+    OUTBOUND_REQUESTS.labels(dependency).inc()
+    OUTBOUND_IN_FLIGHT.labels(dependency).inc()
+    try:
+        yield
+    finally:
+        OUTBOUND_IN_FLIGHT.labels(dependency).dec()
+
+
+def count_connections(dependency, count=1):
+    if count:
+        OUTBOUND_CONNECTIONS.labels(dependency).inc(count)
+
+
+def count_tokens(operation, model, usage):
+    if usage is None:
+        return
+    OPENAI_TOKENS.labels(operation, model, "prompt").inc(usage.prompt_tokens)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if completion_tokens:
+        OPENAI_TOKENS.labels(operation, model, "completion").inc(completion_tokens)
+
+
+def count_retry(retry_state):
+    # tenacity before_sleep hook: called once per attempt that will be retried
+    OPENAI_RETRIES.labels(retry_state.fn.__name__).inc()
+
+
+def count_course_code_lookup(found):
+    COURSE_CODE_LOOKUPS.labels("found" if found else "missing").inc()
+
+
+def count_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command sent through a MongoClient it is registered with."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, "success").observe(
+            event.duration_micros / 1e6
+        )
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, "error").observe(
+            event.duration_micros / 1e6
+        )
+
+
+def exposition():
+    # returns the /metrics body and content type
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
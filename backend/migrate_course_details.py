@@ -0,0 +1,135 @@
+"""
+Moves the ratings and per-comment sentiment of existing courses out of parsed_courses
+into course_details (see course_details.py). Safe to rerun: a course that has been
+moved no longer matches, and the details are written before the course is slimmed,
+so a run stopped halfway leaves both copies rather than neither.
+
+Args
+- mongo_uri: MongoDB to migrate (default: MONGO_URI)
+- db: Database of parsed_courses and course_details
+- details_dir: Also load the course details .json files the ingest scripts wrote
+- batch_size: Courses per bulk write
+- dry_run: Count the courses that would be moved, without writing
+
+Usage (from the backend directory, with MONGO_URI set):
+    python migrate_course_details.py --dry_run
+    python migrate_course_details.py --details_dir data/course_details
+"""
+
+import argparse
+import os
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+from course_details import (
+    DETAIL_FIELDS,
+    DETAILS_COLLECTION,
+    read_details_file,
+    split_course,
+)
+from embedding_store import course_id
+
+# a course whose document still carries any of its details
+UNSPLIT_QUERY = {"$or": [{field: {"$exists": True}} for field in DETAIL_FIELDS]}
+SUMMARY_FIELDS = ["sentiment_info", "average_rating", "average_workload"]
+
+
+def detail_updates(batch):
+    return [
+        UpdateOne({"_id": course_id(course)}, {"$set": details}, upsert=True)
+        for course, _, details in batch
+    ]
+
+
+def course_updates(batch):
+    updates = []
+    for course, compact, details in batch:
+        # the summary replaces sentiment_info whole, dropping the per-question arrays
+        update = {
+            "$set": {
+                field: compact[field] for field in SUMMARY_FIELDS if field in compact
+            }
+        }
+        if "ratings" in details:
+            update["$unset"] = {"ratings": ""}
+        updates.append(UpdateOne({"_id": course["_id"]}, update))
+    return updates
+
+
+def migrate_courses(courses, details, batch_size=500, dry_run=False):
+    """Moves the details of every unsplit course; returns how many were moved."""
+    moved = 0
+    batch = []
+    cursor = courses.find(
+        UNSPLIT_QUERY,
+        {"season_code": 1, "course_code": 1, "ratings": 1, "sentiment_info": 1},
+    )
+    for course in cursor:
+        compact, course_details = split_course(course)
+        if course_details is None:
+            continue
+        batch.append((course, compact, course_details))
+        if len(batch) == batch_size:
+            moved += write_batch(courses, details, batch, dry_run)
+            batch = []
+    if batch:
+        moved += write_batch(courses, details, batch, dry_run)
+    return moved
+
+
+def write_batch(courses, details, batch, dry_run):
+    if not dry_run:
+        details.bulk_write(detail_updates(batch), ordered=False)
+        courses.bulk_write(course_updates(batch), ordered=False)
+    return len(batch)
+
+
+def load_details_dir(details, details_dir, dry_run=False):
+    """Upserts every course in the details .json files; returns how many."""
+    loaded = 0
+    for filename in sorted(os.listdir(details_dir)):
+        if not filename.endswith(".json"):
+            continue
+        season_details = read_details_file(os.path.join(details_dir, filename))
+        updates = [
+            UpdateOne({"_id": key}, {"$set": value}, upsert=True)
+            for key, value in season_details.items()
+        ]
+        if updates and not dry_run:
+            details.bulk_write(updates, ordered=False)
+        loaded += len(updates)
+    return loaded
+
+
+def main(args):
+    load_dotenv()
+    db = MongoClient(args.mongo_uri or os.getenv("MONGO_URI"))[args.db]
+    details = db[DETAILS_COLLECTION]
+    if args.details_dir:
+        loaded = load_details_dir(details, args.details_dir, args.dry_run)
+        print(f"{loaded} courses loaded from {args.details_dir}")
+    moved = migrate_courses(
+        db["parsed_courses"], details, args.batch_size, args.dry_run
+    )
+    print(f"{moved} courses moved{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mongo_uri", type=str, default=None, help="Defaults to MONGO_URI."
+    )
+    parser.add_argument("--db", type=str, default="course_db")
+    parser.add_argument(
+        "--details_dir",
+        type=str,
+        default=None,
+        help="Folder of course details .json files to load as well.",
+    )
+    parser.add_argument("--batch_size", type=int, default=500)
+    parser.add_argument("--dry_run", action="store_true")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from tracing import span
+
+
+class StageExecutor:
+    """Runs the independent stages of a chat turn concurrently.
+
+    A single pool is shared by every request of the app so a chat turn does
+    not pay for spawning threads. Each stage is a zero-argument callable; the
+    caller joins the stages it needs, in the order it needs them. Each stage
+    runs in a copy of the caller's context and is timed as a span of its trace.
+    """
+
+    def __init__(self, max_workers=16):
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="chat-stage"
+        )
+
+    def run(self, stages):
+        # submit in insertion order so the earliest stages get a thread first
+        return StageRun(
+            {
+                name: self.pool.submit(copy_context().run, timed, name, stage)
+                for name, stage in stages.items()
+            }
+        )
+
+
+def timed(name, stage):
+    with span(name):
+        return stage()
+
+
+class StageRun:
+    """The in-flight stages of one chat turn."""
+
+    def __init__(self, futures):
+        self.futures = futures
+
+    def __contains__(self, name):
+        return name in self.futures
+
+    def result(self, name):
+        # re-raises any exception the stage raised
+        return self.futures[name].result()
+
+    def cancel(self):
+        # stages already talking to OpenAI finish in the background; only the
+        # ones still queued are dropped
+        for future in self.futures.values():
+            future.cancel()
@@ -6,22 +6,27 @@ import os
 import json
 import shutil
 
+from course_details import add_details, details_path, read_details_file, summarize_sentiment, write_details_file
+
 """
 This file runs sentiment classification on CourseTable data as follows:
 
 Args
 - target_data_path: Path to the desired folder containing .json files for courses that must be updated with sentiment analysis resulst from specified years
 - sentiment_data_path: Path to folder containing .json files equipped with sentiment analysis results
+- details_data_path: Path to the folder of course details .json files (see course_details.py)
 - years_to_port: List containing integers representing what years of sentiment info to include in the given .json files for parsed courses
 
 Processing
 - Consider each .json file in 'data_path'
 - For each item (representing a single course) in the .json: 
     - Retrieve the relevant course evaluation files for the year(s) specified
-    - Store result as a new field(s) in the json course_objectect
+    - Store the final sentiment label, count and proportion in the json course_objectect
+    - Store the full sentiment info (per-comment labels and scores) in the course's details
 
 Result
 - Updated .json files with new sentiment field for each course's json course_objectect, written in-place.
+- A .json file of course details per season, named like the parsed course file, in details_data_path.
 
 Notes
 - This file assumes sentiment_classification.py has already been run on the course evaluation data.
@@ -41,6 +46,8 @@ def main(args):
             season_file_path = os.path.join(args.target_data_path, filename)
             with open(season_file_path, 'r') as f:
                 season_course = json.load(f)
+            season_details_path = details_path(args.details_data_path, filename)
+            season_details = read_details_file(season_details_path)
             
             # Consider each course in the relevant year/season
             count = 0
@@ -63,7 +70,9 @@ def main(args):
                         sentiment_file_path = os.path.join(args.sentiment_data_path, season_filename)
                         with open(sentiment_file_path, 'r') as sentiment_file:
                             sentiment_json = json.load(sentiment_file)
-                            course_object["sentiment_info"] = sentiment_json["sentiment_info"]
+                            # only the summary stays on the course; the rest is loaded on demand
+                            course_object["sentiment_info"] = summarize_sentiment(sentiment_json["sentiment_info"])
+                            add_details(season_details, course_object, sentiment_info=sentiment_json["sentiment_info"])
                         print(f"Finished {season_code}-{crn}")
                         reviews_missing = False
                         break
@@ -71,36 +80,14 @@ def main(args):
                         continue
                 if reviews_missing:
                     course_object["sentiment_info"] = {
-                        "YC401": {
-                            "sentiment_labels": [],
-                            "sentiment_scores": [],
-                            "sentiment_counts": {},
-                            "sentiment_distribution": {},
-                            "sentiment_overall": ""
-                        },
-                        "YC403": {
-                            "sentiment_labels": [],
-                            "sentiment_scores": [],
-                            "sentiment_counts": {},
-                            "sentiment_distribution": {},
-                            "sentiment_overall": ""
-                        },
-                        "YC409": {
-                            "sentiment_labels": [],
-                            "sentiment_scores": [],
-                            "sentiment_counts": {},
-                            "sentiment_distribution": {},
-                            "sentiment_overall": ""
-                        },
                         "final_label": "",
                         "final_count": 0,
-                        "final_proportion": 0.0,
-                        "final_counts": {},
-                        "final_distribution": {}
+                        "final_proportion": 0.0
                     }
 
             with open(season_file_path, 'w') as f:
                 json.dump(season_course, f, indent=4)
+            write_details_file(season_details_path, season_details)
 
 
 ############################################################
@@ -122,6 +109,11 @@ if __name__ == "__main__":
                         default="data/course_evals",
                         help="Folder where the .json files with sentiment info are located.") 
 
+    parser.add_argument("--details_data_path", 
+                        type=str, 
+                        default="data/course_details",
+                        help="Folder where the .json files of course details are written.") 
+
     parser.add_argument("--years_to_port", 
                         nargs="*",  # 0 or more values expected => creates a list
                         type=int,
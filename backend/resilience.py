@@ -0,0 +1,153 @@
+"""
+Keeping chat turns fast when OpenAI is slow or failing.
+
+A request may set a deadline; every OpenAI call made on its behalf (from any stage
+thread or task, which copy the request's context) gets at most the time left as
+its timeout, and fails with DeadlineExceeded once there is none. A CircuitBreaker
+per dependency stops calling it after repeated failures, so during an outage calls
+fail at once instead of each waiting out its timeout, and lets a single call
+through every reset_timeout seconds to find out whether it has recovered. A call
+that fails because the request's deadline ran out is our budget, not an outage:
+it raises DeadlineExceeded and is not counted against the dependency.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+
+import metrics
+
+current_deadline = ContextVar("current_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def start_deadline(seconds):
+    # seconds=None leaves the request without a deadline
+    deadline = time.monotonic() + seconds if seconds else None
+    current_deadline.set(deadline)
+    return deadline
+
+
+def remaining():
+    # seconds left before the current request's deadline, None without one
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def bounded_timeout(timeout):
+    """The httpx timeout of a call: timeout, cut down to the time left."""
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded()
+
+    def bound(seconds):
+        return left if seconds is None else min(seconds, left)
+
+    return httpx.Timeout(
+        connect=bound(timeout.connect),
+        read=bound(timeout.read),
+        write=bound(timeout.write),
+        pool=bound(timeout.pool),
+    )
+
+
+def deadline_passed():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def past_deadline(retry_state):
+    # tenacity stop condition: no time left for another attempt
+    return deadline_passed()
+
+
+class CircuitBreaker:
+    """Fails calls to a dependency at once while it keeps failing.
+
+    Closed: calls go through. After failure_threshold consecutive failures the
+    circuit opens and calls raise CircuitOpenError. After reset_timeout seconds
+    one call is let through (half-open): if it succeeds the circuit closes,
+    otherwise it opens again for another reset_timeout. Only exceptions of
+    failure_types count as failures; a bad request is our fault, not an outage.
+    """
+
+    def __init__(
+        self, name, failure_threshold=5, reset_timeout=30, failure_types=(Exception,)
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_types = failure_types
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited >= self.reset_timeout and not self.probing:
+                self.probing = True
+                return
+        metrics.CIRCUIT_REJECTIONS.labels(self.name).inc()
+        raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def record(self, failed):
+        with self.lock:
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.probing or self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+            self.probing = False
+            metrics.CIRCUIT_OPEN.labels(self.name).set(self.opened_at is not None)
+
+    @contextmanager
+    def guard(self):
+        self.before_call()
+        try:
+            yield
+        except self.failure_types as e:
+            if not deadline_passed():
+                self.record(failed=True)
+                raise
+            # a timeout bounded_timeout cut down to the time left: the request
+            # ran out of time, which says nothing about the dependency
+            self.release_probe()
+            raise DeadlineExceeded() from e
+        except BaseException:
+            # not the dependency's fault; a probe that ends this way is retried
+            self.release_probe()
+            raise
+        self.record(failed=False)
+
+    def release_probe(self):
+        with self.lock:
+            self.probing = False
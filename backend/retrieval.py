@@ -0,0 +1,316 @@
+import numpy as np
+
+from courses import COURSE_PROJECTION, Course, projection
+from embedding_store import EmbeddingStore, course_id
+from lexical import BM25Index, course_text
+
+VECTOR_SEARCH_INDEX = "parsed_courses_title_description_index"
+
+# course fields the chat filters can restrict, in the order they are applied
+FILTER_FIELDS = ["season_code", "subject", "areas", "skills"]
+# serves lookup(): every offering of a course code, latest season first
+# (created by create_indexes.py)
+COURSE_CODE_INDEX = [("course_code", 1), ("season_code", -1)]
+# what the in-process indexes read of every course, besides the Course fields
+INDEX_PROJECTION = projection(*FILTER_FIELDS)
+# the k of reciprocal rank fusion (Cormack et al. 2009): a larger k lets courses
+# ranked low by both searches catch up with one ranked high by only one
+RRF_K = 60
+
+
+def latest_offerings(courses, course_codes, limit):
+    # the first of courses (sorted latest season first) for each code, in the
+    # order the codes were asked for
+    latest = {}
+    for course in courses:
+        latest.setdefault(course.course_code, course)
+    return [latest[code] for code in course_codes if code in latest][:limit]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """The ids of all rankings, best first, by the sum of 1 / (k + rank) in each."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    # sorted() is stable: ties keep the order of the first ranking
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class BitmapIndex:
+    """Precomputed per-value bitsets over the rows of the course matrix.
+
+    ``bitmaps[field][value]`` is a boolean array marking the courses whose
+    ``field`` equals ``value`` (or contains it, for list fields like areas), so
+    a filter is a few ORs and ANDs of arrays instead of a scan of the courses.
+    """
+
+    def __init__(self, courses, fields=FILTER_FIELDS):
+        self.size = len(courses)
+        self.bitmaps = {field: {} for field in fields}
+        for row, course in enumerate(courses):
+            for field, bitmaps in self.bitmaps.items():
+                values = course.get(field)
+                if not isinstance(values, list):
+                    values = [values]
+                for value in values:
+                    if value is None:
+                        continue
+                    if value not in bitmaps:
+                        bitmaps[value] = np.zeros(self.size, dtype=bool)
+                    bitmaps[value][row] = True
+
+    def mask(self, filters):
+        # same semantics as {"$and": [{field: {"$in": values}}, ...]}; None means
+        # there is nothing to filter on
+        mask = None
+        for field, bitmaps in self.bitmaps.items():
+            wanted = filters.get(field)
+            if not wanted:
+                continue
+            field_mask = np.zeros(self.size, dtype=bool)
+            for value in wanted:
+                if value in bitmaps:
+                    field_mask |= bitmaps[value]
+            mask = field_mask if mask is None else mask & field_mask
+        return mask
+
+
+class AtlasRetriever:
+    """Retrieves courses with Atlas $vectorSearch on the parsed_courses index."""
+
+    def __init__(self, collection, num_candidates=30, async_collection=None):
+        self.collection = collection
+        self.num_candidates = num_candidates
+        # the same collection through motor, for search_async
+        self.async_collection = async_collection
+
+    def pipeline(self, query_vector, filters, limit):
+        aggregate_pipeline = {
+            "$vectorSearch": {
+                "index": VECTOR_SEARCH_INDEX,
+                "path": "embedding",
+                "queryVector": query_vector,
+                "numCandidates": self.num_candidates,
+                "limit": limit,
+            }
+        }
+
+        mongo_filters = [
+            {field: {"$in": filters[field]}}
+            for field in FILTER_FIELDS
+            if filters.get(field)
+        ]
+        if mongo_filters:
+            aggregate_pipeline["$vectorSearch"]["filter"] = {"$and": mongo_filters}
+
+        # only the fields of a Course leave the server, not the embedding,
+        # ratings and per-comment sentiment of every document
+        return [aggregate_pipeline, {"$project": COURSE_PROJECTION}]
+
+    def search(self, query_vector, filters, limit, query_text=None):
+        # query_text is for HybridRetriever; $vectorSearch only reads the vector
+        return [
+            Course.from_document(document)
+            for document in self.collection.aggregate(
+                self.pipeline(query_vector, filters, limit)
+            )
+        ]
+
+    async def search_async(self, query_vector, filters, limit, query_text=None):
+        cursor = self.async_collection.aggregate(
+            self.pipeline(query_vector, filters, limit)
+        )
+        return [
+            Course.from_document(document) for document in await cursor.to_list(None)
+        ]
+
+    def lookup_query(self, course_codes, season_codes):
+        query = {"course_code": {"$in": course_codes}}
+        if season_codes:
+            query["season_code"] = {"$in": season_codes}
+        return query
+
+    def lookup(self, course_codes, season_codes, limit):
+        """The latest offering (in season_codes, if given) of each course code."""
+        cursor = self.collection.find(
+            self.lookup_query(course_codes, season_codes), COURSE_PROJECTION
+        ).sort("season_code", -1)
+        courses = [Course.from_document(document) for document in cursor]
+        return latest_offerings(courses, course_codes, limit)
+
+    async def lookup_async(self, course_codes, season_codes, limit):
+        cursor = self.async_collection.find(
+            self.lookup_query(course_codes, season_codes), COURSE_PROJECTION
+        ).sort("season_code", -1)
+        courses = [
+            Course.from_document(document) for document in await cursor.to_list(None)
+        ]
+        return latest_offerings(courses, course_codes, limit)
+
+
+class LocalRetriever:
+    """Exact in-process vector search over every course embedding.
+
+    The embeddings live in an EmbeddingStore: built in memory as a contiguous,
+    L2-normalized float32 matrix from the course documents, or memory-mapped
+    from a quantized store on disk. A query is a single matrix-vector product
+    and a partial sort. Filters restrict the rows scored through a BitmapIndex.
+    Returns the same Courses as AtlasRetriever.
+    """
+
+    def __init__(self, courses, store=None):
+        if store is None:
+            courses = [course for course in courses if course.get("embedding")]
+            store = EmbeddingStore.build(
+                [course_id(course) for course in courses],
+                [course["embedding"] for course in courses],
+                dtype="float32",
+            )
+        else:
+            # rows of the store whose course is gone can never be returned
+            by_id = {course_id(course): course for course in courses}
+            courses = [by_id.get(stored_id) for stored_id in store.ids]
+        self.store = store
+        self.present = np.array([course is not None for course in courses], dtype=bool)
+        self.index = BitmapIndex(
+            [course if course is not None else {} for course in courses]
+        )
+        # the filter fields are in the index; a row keeps only its Course
+        self.courses = [
+            Course.from_document(course) if course is not None else None
+            for course in courses
+        ]
+        self.rows_by_code = {}
+        for row, course in enumerate(self.courses):
+            if course is not None:
+                self.rows_by_code.setdefault(course.course_code, []).append(row)
+
+    @classmethod
+    def from_collection(cls, collection):
+        return cls(
+            collection.find(
+                {"embedding": {"$exists": True}},
+                dict(INDEX_PROJECTION, embedding=1),
+            )
+        )
+
+    @classmethod
+    def from_store(cls, collection, directory):
+        return cls(
+            collection.find({}, INDEX_PROJECTION), store=EmbeddingStore.load(directory)
+        )
+
+    def search(self, query_vector, filters, limit, query_text=None):
+        if not self.courses:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        mask = self.index.mask(filters)
+        if mask is None:
+            # every row is scored; the few whose course is gone are masked out
+            # rather than gathering all the others
+            rows = np.arange(len(self.courses))
+            scores = self.store.scores(query)
+            scores[~self.present] = -np.inf
+            candidates = int(self.present.sum())
+        else:
+            # only the rows that pass the filters are scored, so a restrictive
+            # filter is both cheaper and still returns a full top-k
+            rows = np.flatnonzero(mask & self.present)
+            scores = self.store.scores(query, rows)
+            candidates = len(rows)
+
+        k = min(limit, candidates)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [self.courses[rows[i]] for i in top]
+
+    async def search_async(self, query_vector, filters, limit, query_text=None):
+        # a few milliseconds of NumPy with no I/O to wait on
+        return self.search(query_vector, filters, limit)
+
+    def lookup(self, course_codes, season_codes, limit):
+        """The latest offering (in season_codes, if given) of each course code."""
+        courses = [
+            self.courses[row]
+            for code in course_codes
+            for row in self.rows_by_code.get(code, [])
+            if not season_codes or self.courses[row].season_code in season_codes
+        ]
+        courses.sort(key=lambda course: course.season_code, reverse=True)
+        return latest_offerings(courses, course_codes, limit)
+
+    async def lookup_async(self, course_codes, season_codes, limit):
+        return self.lookup(course_codes, season_codes, limit)
+
+
+class HybridRetriever:
+    """Vector search fused with BM25 over the course text.
+
+    Wraps an AtlasRetriever or LocalRetriever. Both searches rank up to
+    `candidates` courses under the same filters, the vector search by the query
+    vector and BM25 (lexical.py) by the words of the query, and the best `limit`
+    by reciprocal rank fusion are returned. The BM25 index is built in process,
+    once, from every course in the collection.
+    """
+
+    def __init__(self, retriever, courses, candidates=20):
+        self.retriever = retriever
+        self.candidates = candidates
+        courses = list(courses)
+        self.index = BitmapIndex(courses)
+        self.lexical = BM25Index([course_text(course) for course in courses])
+        self.courses = [Course.from_document(course) for course in courses]
+
+    @classmethod
+    def from_collection(cls, collection, retriever):
+        return cls(
+            retriever, collection.find({}, projection(*FILTER_FIELDS, "professors"))
+        )
+
+    def lexical_search(self, query_text, filters):
+        if not query_text or not self.courses:
+            return []
+        return self.lexical.search(
+            query_text, self.candidates, self.index.mask(filters)
+        )
+
+    def fuse(self, vector_courses, lexical_rows, limit):
+        lexical_courses = [self.courses[row] for row in lexical_rows]
+        by_id = {}
+        for course in vector_courses + lexical_courses:
+            by_id.setdefault(course.id, course)
+        ranked = reciprocal_rank_fusion(
+            [
+                [course.id for course in vector_courses],
+                [course.id for course in lexical_courses],
+            ]
+        )
+        return [by_id[id_] for id_ in ranked[:limit]]
+
+    def search(self, query_vector, filters, limit, query_text=None):
+        vector_courses = self.retriever.search(
+            query_vector, filters, max(limit, self.candidates)
+        )
+        return self.fuse(
+            vector_courses, self.lexical_search(query_text, filters), limit
+        )
+
+    async def search_async(self, query_vector, filters, limit, query_text=None):
+        vector_courses = await self.retriever.search_async(
+            query_vector, filters, max(limit, self.candidates)
+        )
+        # BM25 is a millisecond of NumPy with no I/O to wait on
+        return self.fuse(
+            vector_courses, self.lexical_search(query_text, filters), limit
+        )
+
+    def lookup(self, course_codes, season_codes, limit):
+        return self.retriever.lookup(course_codes, season_codes, limit)
+
+    async def lookup_async(self, course_codes, season_codes, limit):
+        return await self.retriever.lookup_async(course_codes, season_codes, limit)
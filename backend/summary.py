@@ -0,0 +1,235 @@
+"""
+A running summary of every saved chat, so a long chat's turns don't resend all of it.
+
+After /api/chat/append_message saves a message, ChatSummarizer refreshes the chat's
+summary on a background thread, off the request path. The latest RECENT_MESSAGES
+messages are always left out of the summary; once SUMMARY_BATCH older messages
+are not covered yet, they are folded into it with one completion, and the summary
+is stored in the chat's entry of chat_history with the number of messages it
+covers and a digest of them:
+{"chat_id", "messages", "summary": {"text", "message_count", "digest"}}.
+
+A chat turn whose request names its uid and chat_id reads only the summary, and
+sends it in place of the messages it covers, followed by the rest of the
+transcript. The summary is only used if the transcript the client sent starts
+with exactly the messages it covers (same digest); an edited or reordered
+transcript is sent as it is.
+
+Set in the environment: CHAT_SUMMARY_RECENT_MESSAGES (default 6) and
+CHAT_SUMMARY_BATCH (default 4).
+"""
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from lib import chat_completion_request
+
+RECENT_MESSAGES = int(os.getenv("CHAT_SUMMARY_RECENT_MESSAGES", 6))
+SUMMARY_BATCH = int(os.getenv("CHAT_SUMMARY_BATCH", 4))
+
+SUMMARY_PROMPT = "You keep a running summary of a conversation between a Yale student and Eli, an assistant for Yale courses. Update the summary with the new messages. Keep the student's interests, requirements, constraints and preferences, and the courses that were discussed with their course codes. Write at most 150 words of plain text."
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+
+def find_chat(profile, chat_id):
+    for chat in (profile or {}).get("chat_history", []):
+        if chat.get("chat_id") == chat_id:
+            return chat
+    return None
+
+
+def load_chat(collection, uid, chat_id):
+    # only the one chat is sent back, not the whole profile
+    profile = collection.find_one(
+        {"uid": uid, "chat_history.chat_id": chat_id}, {"chat_history.$": 1}
+    )
+    return find_chat(profile, chat_id)
+
+
+def stored_summary(collection, uid, chat_id):
+    # only the chat's summary is sent back, not its messages
+    pipeline = [
+        {"$match": {"uid": uid, "chat_history.chat_id": chat_id}},
+        {"$limit": 1},
+        {
+            "$project": {
+                "_id": 0,
+                "summary": {
+                    "$arrayElemAt": [
+                        {
+                            "$map": {
+                                "input": {
+                                    "$filter": {
+                                        "input": "$chat_history",
+                                        "as": "chat",
+                                        "cond": {"$eq": ["$$chat.chat_id", chat_id]},
+                                    }
+                                },
+                                "as": "chat",
+                                "in": "$$chat.summary",
+                            }
+                        },
+                        0,
+                    ]
+                },
+            }
+        },
+    ]
+    for document in collection.aggregate(pipeline):
+        return document.get("summary")
+    return None
+
+
+def messages_digest(messages):
+    # stored messages and the client's transcript differ in ids and in the
+    # assistant's role ("ai" or "assistant"), so only roles and contents count
+    roles = {"ai": "assistant"}
+    pairs = [
+        (
+            [
+                roles.get(message.get("role"), message.get("role")),
+                message.get("content"),
+            ]
+            if isinstance(message, dict)
+            else [None, str(message)]
+        )
+        for message in messages
+    ]
+    return hashlib.sha256(json.dumps(pairs).encode()).hexdigest()
+
+
+def with_summary(messages, summary):
+    """messages with the ones the summary covers replaced by the summary.
+
+    Leading system messages are kept in front. messages is the transcript the
+    client sent; unless it starts with the messages the summary covers, it is
+    returned as it is.
+    """
+    if not summary:
+        return messages
+    start = 0
+    while start < len(messages) and messages[start]["role"] == "system":
+        start += 1
+    covered = summary["message_count"]
+    if len(messages) - start <= covered:
+        # not the transcript that was summarized
+        return messages
+    if summary.get("digest") != messages_digest(messages[start : start + covered]):
+        # edited, reordered, or summarized before digests were stored
+        return messages
+    return (
+        messages[:start]
+        + [{"role": "system", "content": SUMMARY_HEADER + summary["text"]}]
+        + messages[start + covered :]
+    )
+
+
+def transcript(messages):
+    lines = []
+    for message in messages:
+        if isinstance(message, dict):
+            role = "Student" if message.get("role") == "user" else "Eli"
+            lines.append(f'{role}: {message.get("content", "")}')
+        else:
+            lines.append(str(message))
+    return "\n".join(lines)
+
+
+def summarize(previous, messages):
+    response = chat_completion_request(
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {
+                "role": "user",
+                "content": f"Summary so far:\n{previous or 'None yet.'}\n\n"
+                f"New messages:\n{transcript(messages)}",
+            },
+        ]
+    )
+    return response.choices[0].message.content.strip()
+
+
+def refresh(collection, uid, chat_id):
+    """Folds the chat's messages that left the recent window into its summary.
+
+    Returns whether a new summary was stored.
+    """
+    chat = load_chat(collection, uid, chat_id)
+    if chat is None:
+        return False
+    messages = chat.get("messages", [])
+    summary = chat.get("summary") or {}
+    covered = summary.get("message_count", 0)
+    pending = messages[covered : len(messages) - RECENT_MESSAGES]
+    if len(pending) < SUMMARY_BATCH:
+        return False
+
+    text = summarize(summary.get("text"), pending)
+    covered += len(pending)
+    digest = messages_digest(messages[:covered])
+    # another worker process may have stored a summary of more messages meanwhile
+    result = collection.update_one(
+        {
+            "uid": uid,
+            "chat_history": {
+                "$elemMatch": {
+                    "chat_id": chat_id,
+                    "summary.message_count": {"$not": {"$gte": covered}},
+                }
+            },
+        },
+        {
+            "$set": {
+                "chat_history.$.summary": {
+                    "text": text,
+                    "message_count": covered,
+                    "digest": digest,
+                }
+            }
+        },
+    )
+    return result.modified_count > 0
+
+
+class ChatSummarizer:
+    """Refreshes chat summaries on a small pool of background threads.
+
+    Refreshes of one chat are coalesced: while one runs, scheduling the same chat
+    again only makes it run once more when it is done, so a burst of appends
+    queues at most one more refresh and refreshes of a chat never overlap.
+    """
+
+    def __init__(self, max_workers=2):
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="chat-summary"
+        )
+        self.lock = threading.Lock()
+        self.running = set()
+        self.rerun = set()
+
+    def schedule(self, collection, uid, chat_id):
+        key = (uid, chat_id)
+        with self.lock:
+            if key in self.running:
+                self.rerun.add(key)
+                return None
+            self.running.add(key)
+        return self.pool.submit(self.run, collection, key)
+
+    def run(self, collection, key):
+        while True:
+            try:
+                updated = refresh(collection, *key)
+                metrics.CHAT_SUMMARIES.labels("updated" if updated else "skipped").inc()
+            except Exception as e:
+                print(f"Summary of chat {key[1]} failed: {e}")
+                metrics.CHAT_SUMMARIES.labels("failed").inc()
+            with self.lock:
+                if key not in self.rerun:
+                    self.running.discard(key)
+                    return
+                self.rerun.discard(key)
@@ -0,0 +1,155 @@
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from answer_cache import AnswerCache, SeasonGenerations, filter_key, invalidate_seasons
+
+ANSWER = {
+    "response": "Try ECON 110",
+    "courses": [{"season_code": "202403", "course_code": "ECON 110"}],
+}
+NO_FILTERS = filter_key(None, None, None, None)
+
+
+@pytest.fixture
+def cache():
+    return AnswerCache(threshold=0.9, ttl=60, capacity=2)
+
+
+def test_filter_key_ignores_order():
+    assert filter_key(["202403", "202401"], ["ECON"], None, []) == filter_key(
+        ["202401", "202403"], ["ECON"], [], None
+    )
+
+
+def test_similar_query_hits(cache):
+    cache.put([1.0, 0.0, 0.0], NO_FILTERS, ANSWER)
+    # cosine similarity ~0.995, and the vectors need not be unit length
+    assert cache.get([2.0, 0.2, 0.0], NO_FILTERS) == ANSWER
+    assert cache.stats()["hits"] == 1
+
+
+def test_dissimilar_query_misses(cache):
+    cache.put([1.0, 0.0, 0.0], NO_FILTERS, ANSWER)
+    assert cache.get([1.0, 1.0, 0.0], NO_FILTERS) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_different_filters_miss(cache):
+    cache.put([1.0, 0.0, 0.0], NO_FILTERS, ANSWER)
+    assert cache.get([1.0, 0.0, 0.0], filter_key(["202403"], None, None, None)) is None
+
+
+def test_entries_expire(cache):
+    cache.put([1.0, 0.0, 0.0], NO_FILTERS, ANSWER)
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get([1.0, 0.0, 0.0], NO_FILTERS) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_capacity_evicts_least_recently_used(cache):
+    cache.put([1.0, 0.0, 0.0], NO_FILTERS, {"response": "a", "courses": []})
+    cache.put([0.0, 1.0, 0.0], NO_FILTERS, {"response": "b", "courses": []})
+    cache.get([1.0, 0.0, 0.0], NO_FILTERS)
+    cache.put([0.0, 0.0, 1.0], NO_FILTERS, {"response": "c", "courses": []})
+    assert cache.get([0.0, 1.0, 0.0], NO_FILTERS) is None
+    assert cache.get([1.0, 0.0, 0.0], NO_FILTERS)["response"] == "a"
+
+
+def test_lookups_reuse_the_matrix_of_their_filters(cache):
+    fall = filter_key(["202403"], None, None, None)
+    cache.put([1.0, 0.0, 0.0], NO_FILTERS, ANSWER)
+    cache.put([0.0, 1.0, 0.0], fall, ANSWER)
+    assert cache.get([1.0, 0.0, 0.0], NO_FILTERS) == ANSWER
+    matrix = cache.buckets[NO_FILTERS]["matrix"]
+    assert matrix.shape == (1, 3)
+    assert cache.get([0.0, 1.0, 0.0], NO_FILTERS) is None
+    assert cache.buckets[NO_FILTERS]["matrix"] is matrix
+    # another answer, evicting the least recently used, touches only the matrix
+    # of the fall filters
+    cache.put([0.0, 0.0, 1.0], fall, ANSWER)
+    assert cache.get([0.0, 1.0, 0.0], fall) is None
+    assert cache.get([1.0, 0.0, 0.0], NO_FILTERS) == ANSWER
+    assert cache.buckets[NO_FILTERS]["matrix"] is matrix
+
+
+class FakeGenerations:
+    def __init__(self):
+        self.generations = {}
+
+    def current(self):
+        return self.generations
+
+    def bump(self, season_code):
+        self.generations = dict(self.generations)
+        self.generations[season_code] = self.generations.get(season_code, 0) + 1
+
+
+def test_reimporting_a_season_invalidates_its_answers():
+    generations = FakeGenerations()
+    cache = AnswerCache(threshold=0.9, generations=generations)
+    fall = filter_key(["202403"], None, None, None)
+    spring = filter_key(["202401"], None, None, None)
+    # the answer was drawn from fall courses, though no season was asked for
+    cache.put([1.0, 0.0, 0.0], NO_FILTERS, ANSWER)
+    cache.put([1.0, 0.0, 0.0], fall, {"response": "fall", "courses": []})
+    cache.put([1.0, 0.0, 0.0], spring, {"response": "spring", "courses": []})
+
+    generations.bump("202403")
+    assert cache.get([1.0, 0.0, 0.0], NO_FILTERS) is None
+    assert cache.get([1.0, 0.0, 0.0], fall) is None
+    assert cache.get([1.0, 0.0, 0.0], spring)["response"] == "spring"
+    assert cache.stats()["entries"] == 1
+
+
+def test_answer_is_cached_with_the_generations_read_before_the_search():
+    generations = FakeGenerations()
+    cache = AnswerCache(threshold=0.9, generations=generations)
+    fall = filter_key(["202403"], None, None, None)
+    before_search = cache.current_generations()
+    # re-imported while the turn was running
+    generations.bump("202403")
+    cache.put([1.0, 0.0, 0.0], fall, ANSWER, generations=before_search)
+    assert cache.get([1.0, 0.0, 0.0], fall) is None
+
+
+def test_season_generations_are_read_off_the_caller_thread():
+    collection = MagicMock()
+    collection.find.return_value = [{"_id": "202403", "generation": 2}]
+    generations = SeasonGenerations(collection, refresh_interval=60)
+    # the first read only starts the refresh
+    assert generations.current() == {}
+    for _ in range(100):
+        if generations.current():
+            break
+        time.sleep(0.01)
+    assert generations.current() == {"202403": 2}
+    assert collection.find.call_count == 1
+
+
+def test_season_generations_keep_the_last_counts_when_a_read_fails():
+    collection = MagicMock()
+    collection.find.return_value = [{"_id": "202403", "generation": 2}]
+    generations = SeasonGenerations(collection)
+    generations.refresh()
+    collection.find.side_effect = Exception("server selection timeout")
+    generations.refresh()
+    assert generations.generations == {"202403": 2}
+
+
+def test_invalidate_seasons_bumps_each_season_once():
+    collection = MagicMock()
+    invalidate_seasons(collection, ["202403", "202401", "202403"])
+    (updates,), _ = collection.bulk_write.call_args
+    assert [update._filter for update in updates] == [
+        {"_id": "202401"},
+        {"_id": "202403"},
+    ]
+    assert updates[0]._doc == {"$inc": {"generation": 1}}
+    assert updates[0]._upsert
+
+    collection.reset_mock()
+    invalidate_seasons(collection, [])
+    collection.bulk_write.assert_not_called()
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from starlette.testclient import TestClient
+
+from app import (
+    DEGRADED_ANSWER,
+    DATABASE_RELEVANCY_CHECK_PROMPT,
+    SAFETY_CHECK_PROMPT,
+    SEARCH_QUERY_PROMPT,
+)
+from asgi import create_asgi_app
+from retrieval import LocalRetriever
+
+COURSES = [
+    {
+        "areas": ["Hu"],
+        "course_code": "CPSC 150",
+        "description": "Introduction to the basic ideas of computer science.",
+        "season_code": "202303",
+        "subject": "CPSC",
+        "skills": [],
+        "sentiment_info": {"final_label": "NEGATIVE", "final_proportion": 0.94},
+        "title": "Computer Science and the Modern Intellectual Agenda",
+        "embedding": [1.0, 0.0],
+    },
+]
+
+
+def completion(content=None, arguments=None):
+    tool_calls = None
+    if arguments is not None:
+        tool_calls = [SimpleNamespace(function=SimpleNamespace(arguments=arguments))]
+    message = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def fake_completions(safety="yes", relevancy="yes", delay=0):
+    async def chat_completion_request_async(messages, tools=None, **kwargs):
+        await asyncio.sleep(delay)
+        if tools:
+            return completion(arguments='{"subject": "CPSC"}')
+        prompt = messages[-1]["content"]
+        if prompt == SAFETY_CHECK_PROMPT:
+            return completion(safety)
+        if prompt == DATABASE_RELEVANCY_CHECK_PROMPT:
+            return completion(relevancy)
+        if prompt == SEARCH_QUERY_PROMPT:
+            return completion("computer science")
+        return completion("Try CPSC 150")
+
+    return chat_completion_request_async
+
+
+async def fake_embedding(text, model="text-embedding-3-small"):
+    return [1.0, 0.0]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # create_app sets these module globals; put them back for the other tests
+    monkeypatch.setattr("app.SAFETY_CHECK_ENABLED", True)
+    monkeypatch.setattr("app.DATABASE_RELEVANCY_CHECK_ENABLED", True)
+    monkeypatch.setattr("app.QUERY_PLANNER_ENABLED", False)
+    monkeypatch.setattr("app.RULE_FILTERS_ENABLED", False)
+    asgi_app = create_asgi_app(
+        {
+            "TESTING": True,
+            "SAFETY_CHECK_ENABLED": True,
+            "DATABASE_RELEVANCY_CHECK_ENABLED": True,
+            "ANSWER_CACHE_ENABLED": False,
+            "RULE_FILTERS_ENABLED": False,
+        }
+    )
+    asgi_app.state.flask_app.config["retriever"] = LocalRetriever(COURSES)
+    with patch("asgi.create_embedding_async", fake_embedding), TestClient(
+        asgi_app
+    ) as client:
+        yield client
+
+
+def chat_request(content="Tell me about cs courses"):
+    return {"message": [{"id": 123, "role": "user", "content": content}]}
+
+
+def test_chat(client):
+    with patch("asgi.chat_completion_request_async", fake_completions()):
+        response = client.post("/api/chat", json=chat_request())
+    assert response.status_code == 200
+    data = response.json()
+    assert data["response"] == "Try CPSC 150"
+    assert data["courses"][0]["course_code"] == "CPSC 150"
+    assert data["courses"][0]["sentiment_label"] == "NEGATIVE"
+    stages = [
+        entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")
+    ]
+    for stage in [
+        "safety",
+        "relevancy",
+        "search_query",
+        "filter",
+        "aggregate",
+        "final",
+    ]:
+        assert stage in stages
+
+
+def test_chat_stages_run_concurrently(client):
+    with patch("asgi.chat_completion_request_async", fake_completions(delay=0.2)):
+        start = time.perf_counter()
+        response = client.post("/api/chat", json=chat_request())
+        elapsed = time.perf_counter() - start
+    assert response.status_code == 200
+    # the four stages overlap, then the final completion: two delays, not five
+    assert elapsed < 0.7
+
+
+def test_course_code_lookup(client):
+    with patch("asgi.chat_completion_request_async", fake_completions()):
+        response = client.post("/api/chat", json=chat_request("Is cpsc150 good?"))
+    data = response.json()
+    assert data["courses"][0]["course_code"] == "CPSC 150"
+    stages = [
+        entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")
+    ]
+    assert "lookup" in stages and "final" in stages
+    # checked like any other message, but not searched for
+    assert "safety" in stages and "relevancy" in stages
+    assert "search_query" not in stages and "aggregate" not in stages
+
+
+def test_safety_violation(client):
+    with patch("asgi.chat_completion_request_async", fake_completions(safety="no")):
+        response = client.post("/api/chat", json=chat_request("Tell me a joke"))
+    assert "I am sorry" in response.json()["response"]
+    assert response.json()["courses"] == []
+
+
+def test_cancelled_stages_finish_before_the_response(client):
+    async def completions(messages, tools=None, **kwargs):
+        if messages[-1]["content"] == SAFETY_CHECK_PROMPT:
+            return completion("no")
+        await asyncio.sleep(1)
+        raise Exception("API error simulated")
+
+    with patch("asgi.chat_completion_request_async", completions):
+        response = client.post("/api/chat", json=chat_request("Tell me a joke"))
+    assert "I am sorry" in response.json()["response"]
+    # the cancelled stages were awaited, so their spans made it into the trace
+    stages = [
+        entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")
+    ]
+    assert "relevancy" in stages and "filter" in stages
+
+
+def test_chat_degraded(client):
+    async def failing(messages, tools=None, **kwargs):
+        raise Exception("API error simulated")
+
+    with patch("asgi.chat_completion_request_async", failing):
+        response = client.post("/api/chat", json=chat_request())
+    data = response.json()
+    assert data["degraded"] is True
+    assert data["courses"][0]["course_code"] == "CPSC 150"
+    assert data["response"].startswith(DEGRADED_ANSWER)
+
+
+def test_no_user_message(client):
+    assert client.post("/api/chat", json={}).json() == {"error": "No message provided"}
+    response = client.post("/api/chat/stream", json={})
+    assert response.json() == {"error": "No message provided"}
+
+
+def test_chat_stream(client):
+    async def stream(messages, model="gpt-4"):
+        for token in ["Try ", "CPSC 150"]:
+            yield token
+
+    with patch("asgi.chat_completion_request_async", fake_completions()), patch(
+        "asgi.chat_completion_stream_async", stream
+    ):
+        response = client.post("/api/chat/stream", json=chat_request())
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [
+        (lines[0][len("event: ") :], json.loads(lines[1][len("data: ") :]))
+        for lines in (
+            block.split("\n") for block in response.text.split("\n\n") if block
+        )
+        if lines[0].startswith("event: ")
+    ]
+    assert events[0][0] == "courses"
+    assert events[0][1][0]["course_code"] == "CPSC 150"
+    assert events[1:] == [
+        ("token", {"content": "Try "}),
+        ("token", {"content": "CPSC 150"}),
+        ("done", {"response": "Try CPSC 150"}),
+    ]
+
+
+def test_other_routes_are_served_by_flask(client):
+    assert client.post("/api/chat/create_chat", json={}).json() == {
+        "error": "No uid provided"
+    }
+    assert client.get("/metrics").status_code == 200
+    # CORS preflight of an async route
+    response = client.options(
+        "/api/chat",
+        headers={
+            "Origin": "http://localhost:3000",
+            "Access-Control-Request-Method": "POST",
+        },
+    )
+    assert response.headers["Access-Control-Allow-Origin"] == "http://localhost:3000"
+    response = client.post(
+        "/api/chat", json={}, headers={"Origin": "http://localhost:3000"}
+    )
+    assert response.headers["Access-Control-Allow-Origin"] == "http://localhost:3000"
@@ -0,0 +1,184 @@
+import json
+from argparse import Namespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from build_course_embeddings import (
+    embed_texts,
+    fake_embed,
+    load_checkpoint,
+    main,
+    text_hash,
+    text_to_embed,
+)
+
+
+def make_courses(n):
+    return [
+        {
+            "season_code": "202403",
+            "course_code": f"CPSC {i}",
+            "title": f"Course {i}",
+            "professors": ["Ada Lovelace", "Alan Turing"] if i % 2 else [],
+            "description": f"Description {i}",
+        }
+        for i in range(n)
+    ]
+
+
+class CountingEmbed:
+    def __init__(self, fail_on=None):
+        self.batches = []
+        self.fail_on = fail_on
+
+    def __call__(self, texts, model):
+        self.batches.append(list(texts))
+        if self.fail_on and self.fail_on in texts:
+            raise Exception("API error simulated")
+        return fake_embed(texts, model, dimensions=4)
+
+
+def test_text_to_embed():
+    courses = make_courses(2)
+    assert text_to_embed(courses[0]) == "CPSC 0 Course 0. Description 0"
+    assert (
+        text_to_embed(courses[1])
+        == "CPSC 1 Course 1. Ada Lovelace, Alan Turing. Description 1"
+    )
+
+
+def test_fake_embed_is_deterministic():
+    first, second, other = fake_embed(["a", "a", "b"], dimensions=8)
+    assert first == second
+    assert first != other
+    assert sum(x * x for x in first) == pytest.approx(1.0)
+
+
+def test_embed_texts_batches():
+    texts = [f"text {i}" for i in range(10)]
+    embed = CountingEmbed()
+    embeddings = embed_texts(texts, embed=embed, batch_size=3, workers=2)
+    assert sorted(len(batch) for batch in embed.batches) == [1, 3, 3, 3]
+    assert embeddings[text_hash("text 7")] == fake_embed(["text 7"], dimensions=4)[0]
+
+
+def test_embed_texts_resumes_from_checkpoint(tmp_path):
+    checkpoint_path = str(tmp_path / "checkpoint.jsonl")
+    texts = [f"text {i}" for i in range(10)]
+
+    # the first run crashes on one batch; the others are checkpointed
+    with pytest.raises(RuntimeError):
+        embed_texts(
+            texts,
+            embed=CountingEmbed(fail_on="text 9"),
+            batch_size=3,
+            checkpoint_path=checkpoint_path,
+        )
+    assert len(load_checkpoint(checkpoint_path)) == 9
+
+    # the rerun only embeds what is missing
+    embed = CountingEmbed()
+    embeddings = embed_texts(
+        texts, embed=embed, batch_size=3, checkpoint_path=checkpoint_path
+    )
+    assert embed.batches == [["text 9"]]
+    assert len(embeddings) == 10
+
+
+def test_checkpoint_ignores_partial_line(tmp_path):
+    checkpoint_path = tmp_path / "checkpoint.jsonl"
+    checkpoint_path.write_text(
+        json.dumps({"hash": "a", "embedding": [1.0]}) + '\n{"hash": "b", "embe'
+    )
+    assert load_checkpoint(str(checkpoint_path)) == {"a": [1.0]}
+    embed_texts(["c"], embed=CountingEmbed(), checkpoint_path=str(checkpoint_path))
+    assert set(load_checkpoint(str(checkpoint_path))) == {"a", text_hash("c")}
+
+
+def make_args(input_path, **kwargs):
+    args = dict(
+        input_path=str(input_path),
+        output_path=None,
+        checkpoint_path=None,
+        model="text-embedding-3-small",
+        batch_size=2,
+        workers=2,
+        mongo=False,
+        fake=True,
+    )
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+def test_main_writes_courses_with_embeddings(tmp_path):
+    input_path = tmp_path / "202403.json"
+    input_path.write_text(json.dumps(make_courses(5)))
+    main(make_args(input_path))
+    courses = json.loads((tmp_path / "202403_with_embeddings.json").read_text())
+    assert len(courses) == 5
+    assert all(len(course["embedding"]) == 1536 for course in courses)
+    assert courses[0]["embedding_hash"] == text_hash(text_to_embed(courses[0]))
+    assert courses[0]["embedding_model"] == "text-embedding-3-small"
+
+
+def test_main_only_embeds_changed_courses(tmp_path):
+    input_path = tmp_path / "202403.json"
+    input_path.write_text(json.dumps(make_courses(5)))
+    main(make_args(input_path))
+
+    # the refreshed catalog changes one description and adds one course
+    courses = make_courses(6)
+    courses[2]["description"] = "A new description"
+    input_path.write_text(json.dumps(courses))
+    embed = CountingEmbed()
+    # a fresh checkpoint, so only the stored hashes can prevent re-embedding
+    with patch("build_course_embeddings.fake_embed", embed):
+        main(make_args(input_path, checkpoint_path=str(tmp_path / "new.jsonl")))
+
+    assert sorted(sum(embed.batches, [])) == [
+        "CPSC 2 Course 2. A new description",
+        "CPSC 5 Course 5. Ada Lovelace, Alan Turing. Description 5",
+    ]
+    courses = json.loads((tmp_path / "202403_with_embeddings.json").read_text())
+    assert len(courses) == 6
+    assert courses[2]["embedding_hash"] == text_hash(text_to_embed(courses[2]))
+
+
+def test_main_mongo_writes_only_changed_courses(tmp_path):
+    courses = make_courses(3)
+    input_path = tmp_path / "202403.json"
+    input_path.write_text(json.dumps(courses))
+    collection = MagicMock()
+    collection.find.return_value = [
+        {
+            "season_code": "202403",
+            "course_code": "CPSC 0",
+            "embedding_hash": text_hash(text_to_embed(courses[0])),
+        },
+        {
+            "season_code": "202403",
+            "course_code": "CPSC 1",
+            "embedding_hash": text_hash("an older description"),
+        },
+    ]
+    mock_client = MagicMock()
+    mock_client.__getitem__.return_value.__getitem__.return_value = collection
+    with patch("build_course_embeddings.MongoClient", return_value=mock_client):
+        main(make_args(input_path, mongo=True))
+
+    # vectors are never read back from the collection
+    assert collection.find.call_args[0][1] == {
+        "season_code": 1,
+        "course_code": 1,
+        "embedding_hash": 1,
+    }
+    (updates,), _ = collection.bulk_write.call_args_list[0]
+    assert [update._filter["course_code"] for update in updates] == [
+        "CPSC 1",
+        "CPSC 2",
+    ]
+    assert len(updates[0]._doc["$set"]["embedding"]) == 1536
+    # then the season they belong to is invalidated in the answer caches
+    (bumps,), _ = collection.bulk_write.call_args_list[1]
+    assert [bump._filter for bump in bumps] == [{"_id": "202403"}]
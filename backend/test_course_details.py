@@ -0,0 +1,123 @@
+import json
+from unittest.mock import MagicMock
+
+from course_details import load_details, rating_means, split_course
+from migrate_course_details import load_details_dir, migrate_courses
+
+SENTIMENT_INFO = {
+    "YC401": {
+        "sentiment_labels": ["POSITIVE", "NEGATIVE"],
+        "sentiment_scores": [0.9, 0.8],
+    },
+    "YC403": {"sentiment_labels": [], "sentiment_scores": []},
+    "YC409": {"sentiment_labels": ["POSITIVE"], "sentiment_scores": [0.7]},
+    "final_label": "POSITIVE",
+    "final_count": 2,
+    "final_proportion": 0.67,
+    "final_counts": {"POSITIVE": 2, "NEGATIVE": 1},
+    "final_distribution": {"POSITIVE": 0.67, "NEGATIVE": 0.33},
+}
+RATINGS = [
+    {
+        "question_id": "YC402",
+        "options": ["1", "2", "3", "4", "5"],
+        "data": [0, 0, 1, 2, 1],
+    },
+    {
+        "question_id": "YC404",
+        "options": ["1", "2", "3", "4", "5"],
+        "data": [1, 1, 0, 0, 0],
+    },
+]
+
+
+def course(**fields):
+    return dict(
+        {"_id": "abc", "season_code": "202403", "course_code": "CPSC 323"}, **fields
+    )
+
+
+def test_rating_means():
+    assert rating_means(RATINGS) == {"average_rating": 4.0, "average_workload": 1.5}
+    # unanswered or missing questions have no mean
+    assert rating_means([dict(RATINGS[0], data=[0, 0, 0, 0, 0])]) == {
+        "average_rating": None,
+        "average_workload": None,
+    }
+
+
+def test_split_course_keeps_summaries():
+    compact, details = split_course(
+        course(sentiment_info=SENTIMENT_INFO, ratings=RATINGS, title="Systems")
+    )
+    assert compact == course(
+        title="Systems",
+        sentiment_info={
+            "final_label": "POSITIVE",
+            "final_count": 2,
+            "final_proportion": 0.67,
+        },
+        average_rating=4.0,
+        average_workload=1.5,
+    )
+    assert details == {"ratings": RATINGS, "sentiment_info": SENTIMENT_INFO}
+    # a course already split has nothing left to move
+    assert split_course(compact) == (compact, None)
+
+
+def test_load_details_by_course_id():
+    collection = MagicMock()
+    collection.find_one.return_value = {"ratings": RATINGS}
+    assert load_details(collection, "202403", "CPSC 323") == {"ratings": RATINGS}
+    collection.find_one.assert_called_once_with({"_id": "202403 CPSC 323"}, {"_id": 0})
+
+
+def test_migration_writes_details_before_slimming_courses():
+    courses = MagicMock()
+    courses.find.return_value = iter(
+        [
+            course(sentiment_info=SENTIMENT_INFO, ratings=RATINGS),
+            course(_id="def", course_code="CPSC 223", sentiment_info=SENTIMENT_INFO),
+        ]
+    )
+    details = MagicMock()
+    writes = []
+    details.bulk_write.side_effect = lambda updates, **kwargs: writes.append("details")
+    courses.bulk_write.side_effect = lambda updates, **kwargs: writes.append("courses")
+
+    assert migrate_courses(courses, details, batch_size=1) == 2
+    assert writes == ["details", "courses", "details", "courses"]
+
+    ((detail_update,),), _ = details.bulk_write.call_args_list[0]
+    assert detail_update._filter == {"_id": "202403 CPSC 323"}
+    assert detail_update._doc == {
+        "$set": {"ratings": RATINGS, "sentiment_info": SENTIMENT_INFO}
+    }
+    ((course_update,),), _ = courses.bulk_write.call_args_list[0]
+    assert course_update._filter == {"_id": "abc"}
+    assert course_update._doc["$unset"] == {"ratings": ""}
+    assert course_update._doc["$set"]["average_rating"] == 4.0
+    assert "YC401" not in course_update._doc["$set"]["sentiment_info"]
+    # no ratings to remove from a course that never had any
+    ((course_update,),), _ = courses.bulk_write.call_args_list[1]
+    assert "$unset" not in course_update._doc
+
+
+def test_migration_dry_run_writes_nothing():
+    courses = MagicMock()
+    courses.find.return_value = iter([course(ratings=RATINGS)])
+    details = MagicMock()
+    assert migrate_courses(courses, details, dry_run=True) == 1
+    courses.bulk_write.assert_not_called()
+    details.bulk_write.assert_not_called()
+
+
+def test_load_details_dir(tmp_path):
+    (tmp_path / "202403.json").write_text(
+        json.dumps({"202403 CPSC 323": {"ratings": RATINGS}})
+    )
+    (tmp_path / "notes.txt").write_text("not details")
+    details = MagicMock()
+    assert load_details_dir(details, tmp_path) == 1
+    (updates,), _ = details.bulk_write.call_args
+    assert updates[0]._filter == {"_id": "202403 CPSC 323"}
@@ -0,0 +1,152 @@
+import asyncio
+import multiprocessing
+import threading
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+import lib
+from embedding_cache import EmbeddingCache, normalize_text
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(tmp_path / "embeddings.sqlite3", memory_size=2)
+
+
+def test_normalize_text():
+    assert normalize_text("  Easy   QR\nClasses ") == "easy qr classes"
+
+
+def test_miss_then_memory_hit(cache):
+    assert cache.get("easy QR classes", "model") is None
+    cache.put("easy QR classes", "model", [0.5, 0.25])
+    # keys are normalized, so spacing and case do not matter
+    assert cache.get("Easy  QR classes", "model") == [0.5, 0.25]
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_model_is_part_of_key(cache):
+    cache.put("intro cs", "small", [1.0])
+    assert cache.get("intro cs", "large") is None
+
+
+def test_disk_hit_from_new_process_cache(tmp_path):
+    path = tmp_path / "embeddings.sqlite3"
+    EmbeddingCache(path).put("intro cs fall 2024", "model", [0.5, -1.5])
+
+    # a second worker with an empty memory tier reads the shared file
+    cache = EmbeddingCache(path)
+    assert cache.get("intro cs fall 2024", "model") == [0.5, -1.5]
+    assert cache.stats()["disk_hits"] == 1
+    # and the entry is now in its memory tier
+    assert cache.get("intro cs fall 2024", "model") == [0.5, -1.5]
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_memory_tier_is_lru(cache):
+    cache.path = None  # memory only
+    cache.put("a", "model", [1.0])
+    cache.put("b", "model", [2.0])
+    cache.get("a", "model")
+    cache.put("c", "model", [3.0])
+    assert cache.get("b", "model") is None
+    assert cache.get("a", "model") == [1.0]
+    assert cache.get("c", "model") == [3.0]
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache = EmbeddingCache(tmp_path / "embeddings.sqlite3", disk_size=10)
+    cache.TRIM_EVERY = 1
+    for i in range(25):
+        cache.put(f"query {i}", "model", [float(i)])
+    count = cache.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+    assert count[0] == 10
+    # the most recently written entries survive
+    assert EmbeddingCache(cache.path).get("query 24", "model") == [24.0]
+
+
+def put_from_worker(path, i):
+    EmbeddingCache(path).put(f"query {i}", "model", [float(i)])
+
+
+def test_shared_between_processes(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    processes = [
+        multiprocessing.Process(target=put_from_worker, args=(path, i))
+        for i in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    cache = EmbeddingCache(path)
+    assert [cache.get(f"query {i}", "model") for i in range(4)] == [
+        [0.0],
+        [1.0],
+        [2.0],
+        [3.0],
+    ]
+
+
+def test_endpoints_are_cached_apart(tmp_path):
+    path = tmp_path / "embeddings.sqlite3"
+    EmbeddingCache(path, endpoint="http://localhost:8001/v1").put(
+        "intro cs", "model", [0.5]
+    )
+    # OpenAI's own embeddings, and another server's, miss the fake server's
+    assert EmbeddingCache(path).get("intro cs", "model") is None
+    assert (
+        EmbeddingCache(path, endpoint="http://other/v1").get("intro cs", "model")
+        is None
+    )
+    assert EmbeddingCache(path, endpoint="http://localhost:8001/v1").get(
+        "intro cs", "model"
+    ) == [0.5]
+
+
+def test_create_embedding_skips_api_on_repeat(cache):
+    mock_client = MagicMock()
+    mock_client.embeddings.create.return_value = MagicMock(
+        data=[MagicMock(embedding=[0.5, 0.25])],
+        usage=SimpleNamespace(prompt_tokens=3, total_tokens=3),
+    )
+    with patch("lib.client", mock_client), patch("lib.embedding_cache", cache):
+        assert lib.create_embedding("easy QR classes") == [0.5, 0.25]
+        assert lib.create_embedding("easy qr classes") == [0.5, 0.25]
+    assert mock_client.embeddings.create.call_count == 1
+
+
+def test_create_embedding_async_reads_the_cache_off_the_event_loop(cache):
+    threads = []
+    get, put = cache.get, cache.put
+
+    def record(method):
+        def wrapper(*args):
+            threads.append(threading.get_ident())
+            return method(*args)
+
+        return wrapper
+
+    cache.get, cache.put = record(get), record(put)
+    mock_client = MagicMock()
+    mock_client.embeddings.create = AsyncMock(
+        return_value=MagicMock(
+            data=[MagicMock(embedding=[0.5, 0.25])],
+            usage=SimpleNamespace(prompt_tokens=3, total_tokens=3),
+        )
+    )
+
+    async def embed():
+        return (
+            await lib.create_embedding_async("easy QR classes"),
+            threading.get_ident(),
+        )
+
+    with patch("lib.async_client", mock_client), patch("lib.embedding_cache", cache):
+        embedding, loop_thread = asyncio.run(embed())
+    assert embedding == [0.5, 0.25]
+    # one get and one put, neither on the event loop's thread
+    assert len(threads) == 2 and loop_thread not in threads
@@ -0,0 +1,59 @@
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pytest
+
+from embedding_store import EmbeddingStore
+from retrieval import INDEX_PROJECTION, LocalRetriever
+
+rng = np.random.default_rng(0)
+EMBEDDINGS = rng.standard_normal((50, 16)).astype(np.float32)
+IDS = [f"202403 CPSC {i}" for i in range(50)]
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16", "float32"])
+def test_scores_match_float32(dtype):
+    exact = EmbeddingStore.build(IDS, EMBEDDINGS, dtype="float32")
+    store = EmbeddingStore.build(IDS, EMBEDDINGS, dtype=dtype)
+    assert store.vectors.dtype == np.dtype(dtype)
+    query = exact.vectors[3]
+    np.testing.assert_allclose(store.scores(query), exact.scores(query), atol=0.02)
+    rows = np.array([3, 7, 9])
+    np.testing.assert_allclose(
+        store.scores(query, rows, chunk_size=2), exact.scores(query)[rows], atol=0.02
+    )
+
+
+def test_save_and_load_memory_maps(tmp_path):
+    EmbeddingStore.build(IDS, EMBEDDINGS, dtype="int8").save(tmp_path)
+    store = EmbeddingStore.load(tmp_path)
+    assert isinstance(store.vectors, np.memmap)
+    assert store.vectors.shape == (50, 16)
+    assert store.vectors.nbytes == 50 * 16
+    assert store.ids == IDS
+    assert (
+        int(np.argmax(store.scores(EMBEDDINGS[7] / np.linalg.norm(EMBEDDINGS[7])))) == 7
+    )
+
+
+def test_local_retriever_from_store(tmp_path):
+    EmbeddingStore.build(IDS[:3], EMBEDDINGS[:3], dtype="int8").save(tmp_path)
+    collection = MagicMock()
+    # CPSC 1 is gone from the catalog, CPSC 9 was never stored
+    collection.find.return_value = [
+        {"season_code": "202403", "course_code": "CPSC 2", "subject": "CPSC"},
+        {"season_code": "202403", "course_code": "CPSC 0", "subject": "CPSC"},
+        {"season_code": "202403", "course_code": "CPSC 9", "subject": "CPSC"},
+    ]
+    retriever = LocalRetriever.from_store(collection, tmp_path)
+    collection.find.assert_called_once_with({}, INDEX_PROJECTION)
+
+    # unfiltered, the stale row is scored with the rest and masked out
+    with patch.object(
+        retriever.store, "scores", wraps=retriever.store.scores
+    ) as scores:
+        results = retriever.search(EMBEDDINGS[1], {}, 5)
+    assert scores.call_args[0][1:] == ()
+    assert sorted(course.course_code for course in results) == ["CPSC 0", "CPSC 2"]
+    results = retriever.search(EMBEDDINGS[2], {"subject": ["CPSC"]}, 1)
+    assert [course.course_code for course in results] == ["CPSC 2"]
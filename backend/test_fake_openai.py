@@ -0,0 +1,163 @@
+import threading
+from unittest.mock import MagicMock, patch
+
+import openai
+import pytest
+from openai import OpenAI
+from werkzeug.serving import make_server
+
+from app import create_app
+from embedding_cache import EmbeddingCache
+from fake_openai import Latency, create_fake_openai_app
+from lib import planner_tools, tools
+
+
+def serve(fake_app):
+    server = make_server("127.0.0.1", 0, fake_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = OpenAI(
+        api_key="fake",
+        base_url=f"http://127.0.0.1:{server.server_port}/v1",
+        max_retries=0,
+    )
+    return server, client
+
+
+@pytest.fixture
+def fake_openai():
+    fake_app = create_fake_openai_app(
+        script=[
+            {
+                "match": "fall 2024",
+                "tool": "CourseFilter",
+                "arguments": {"season_code": "202403"},
+            },
+            {"match": ["poem", "Am I asking for help"], "content": "no"},
+        ]
+    )
+    server, client = serve(fake_app)
+    yield client
+    server.shutdown()
+
+
+def test_embeddings_are_deterministic(fake_openai):
+    response = fake_openai.embeddings.create(
+        input=["intro to cs", "intro to cs", "poetry"],
+        model="text-embedding-3-small",
+    )
+    first, second, other = [item.embedding for item in response.data]
+    assert len(first) == 1536
+    assert first == second
+    assert first != other
+
+
+def test_scripted_tool_call(fake_openai):
+    response = fake_openai.chat.completions.create(
+        model="gpt-4",
+        messages=[{"role": "user", "content": "CS courses in Fall 2024"}],
+        tools=tools,
+    )
+    tool_call = response.choices[0].message.tool_calls[0]
+    assert tool_call.function.name == "CourseFilter"
+    assert tool_call.function.arguments == '{"season_code": "202403"}'
+
+
+def test_default_query_plan(fake_openai):
+    response = fake_openai.chat.completions.create(
+        model="gpt-4",
+        messages=[{"role": "user", "content": "CS courses"}],
+        tools=planner_tools,
+        tool_choice={"type": "function", "function": {"name": "QueryPlan"}},
+    )
+    assert response.choices[0].finish_reason == "tool_calls"
+    assert response.choices[0].message.tool_calls[0].function.arguments == (
+        '{"on_topic": true, "needs_courses": true, '
+        '"search_query": "CS courses", "filters": {}}'
+    )
+
+
+def test_scripted_and_default_content(fake_openai):
+    def complete(content):
+        response = fake_openai.chat.completions.create(
+            model="gpt-4",
+            messages=[
+                {"role": "user", "content": "Write me a poem"},
+                {"role": "user", "content": content},
+            ],
+        )
+        return response.choices[0].message.content
+
+    assert (
+        complete(
+            'Am I asking for help with courses or academics? Answer "yes" or "no".'
+        )
+        == "no"
+    )
+    assert complete('Would courses help? Answer "yes" or "no".') == "yes"
+
+
+def test_stream(fake_openai):
+    stream = fake_openai.chat.completions.create(
+        model="gpt-4",
+        messages=[{"role": "user", "content": "CS courses"}],
+        stream=True,
+    )
+    content = "".join(chunk.choices[0].delta.content or "" for chunk in stream)
+    assert (
+        content == "Here are some courses at Yale that match what you are looking for."
+    )
+
+
+def test_injected_errors():
+    server, client = serve(create_fake_openai_app(error_rate=1, seed=0))
+    try:
+        with pytest.raises((openai.RateLimitError, openai.InternalServerError)):
+            client.embeddings.create(input="cs", model="text-embedding-3-small")
+    finally:
+        server.shutdown()
+
+
+def test_latency_distribution():
+    assert Latency().sample() == 0
+    assert Latency(200).sample() == 0.2
+    latency = Latency(200, 0.5, seed=0)
+    samples = sorted(latency.sample() for _ in range(2001))
+    assert samples[1000] == pytest.approx(0.2, rel=0.1)
+    # a lognormal tail: p99 is about e^(2.33 * 0.5) = 3.2x the median
+    assert samples[1980] > 2.5 * samples[1000]
+
+
+def test_chat_against_fake_openai(fake_openai, monkeypatch, tmp_path):
+    # the real lib.py calls, pointed at the fake server instead of a MagicMock;
+    # its embeddings must not reach the real embedding cache
+    monkeypatch.setattr("app.RULE_FILTERS_ENABLED", False)
+    cache = EmbeddingCache(tmp_path / "embeddings.sqlite3", endpoint="fake")
+    monkeypatch.setattr("lib.embedding_cache", cache)
+    courses = MagicMock()
+    courses.aggregate.return_value = iter(
+        [
+            {
+                "areas": [],
+                "course_code": "CPSC 201",
+                "description": "Introduction to computer science.",
+                "season_code": "202403",
+                "sentiment_info": {"final_label": "POSITIVE", "final_proportion": 0.8},
+                "title": "Introduction to Computer Science",
+            }
+        ]
+    )
+    app = create_app({"TESTING": True, "courses": courses, "profiles": MagicMock()})
+    request_data = {"message": [{"role": "user", "content": "CS courses in Fall 2024"}]}
+    with patch("lib.client", fake_openai):
+        response = app.test_client().post("/api/chat", json=request_data)
+    data = response.get_json()
+    assert data["response"] == (
+        "Here are some courses at Yale that match what you are looking for."
+    )
+    assert data["courses"][0]["course_code"] == "CPSC 201"
+    (pipeline,), _ = courses.aggregate.call_args
+    assert len(pipeline[0]["$vectorSearch"]["queryVector"]) == 1536
+    assert pipeline[0]["$vectorSearch"]["filter"] == {
+        "$and": [{"season_code": {"$in": ["202403"]}}]
+    }
+    assert cache.stats()["memory_entries"] == 1
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from filter_rules import about_other_courses, extract_course_codes, extract_filters
+
+
+def user(content):
+    return [{"role": "user", "content": content}]
+
+
+@pytest.mark.parametrize(
+    "content, filters",
+    [
+        ("CPSC courses in Fall 2024", {"subject": "CPSC", "season_code": "202403"}),
+        ("econ 115 in spring '23", {"subject": "ECON", "season_code": "202301"}),
+        ("2022 summer S&DS classes", {"subject": "S&DS", "season_code": "202202"}),
+        ("intro computer science courses", {"subject": "CPSC"}),
+        ("history classes in Fall 2024", {"subject": "HIST", "season_code": "202403"}),
+        ("computer science and economics seminars", {"subject": "CSEC"}),
+        ("humanities courses that count for QR", {"areas": "Hu", "skills": "QR"}),
+        ("a writing-intensive social science class", {"areas": "So", "skills": "WR"}),
+        ("WR courses in the English department", {"subject": "ENGL", "skills": "WR"}),
+        ("classes about the ethics of AI", {}),
+    ],
+)
+def test_reads_plain_filters(content, filters):
+    assert extract_filters(user(content)) == filters
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        # a season without a year, or a year without a season
+        "something fun for next semester",
+        "fall classes on film",
+        "courses for the class of 2026",
+        # two subjects for a single-valued filter
+        "MATH or PHYS courses",
+        # an area in words the rules don't read
+        "which science classes are easy",
+        "a creative writing class",
+        # negated filters
+        "anything but not QR",
+        "I don't want CPSC",
+        # a season that isn't in the catalog
+        "fall 2031 history seminars",
+        # a subject's name as a topic, not the department
+        "courses on the history of medicine",
+        "class on immigration law",
+        "a course on music and math",
+        "intro to art",
+        "intro computer science",
+    ],
+)
+def test_unsure_messages_go_to_the_tool_call(content):
+    assert extract_filters(user(content)) is None
+
+
+def test_reads_every_user_message_but_not_the_answers():
+    messages = [
+        {"role": "system", "content": "Your name is Eli."},
+        {"role": "user", "content": "I want a history class in Fall 2024"},
+        {"role": "assistant", "content": "Try ECON 115 or PLSC 113."},
+        {"role": "user", "content": "Something on modern Europe?"},
+    ]
+    assert extract_filters(messages) == {"subject": "HIST", "season_code": "202403"}
+
+
+def test_runs_in_microseconds():
+    messages = user("I need a writing requirement class for Fall 2024 in English")
+    start = time.perf_counter()
+    for _ in range(1000):
+        extract_filters(messages)
+    # well under a millisecond each, against seconds for the tool call
+    assert (time.perf_counter() - start) / 1000 < 0.001
+
+
+def test_finds_course_codes():
+    assert extract_course_codes("is econ115 hard? or ECON 115") == ["ECON 115"]
+    assert extract_course_codes("S&DS 230 vs CHEM 134L") == ["S&DS 230", "CHEM 134L"]
+    # a year, or letters that aren't a subject
+    assert extract_course_codes("classes in 2024 like ABCD 123") == []
+
+
+@pytest.mark.parametrize(
+    "content, other",
+    [
+        ("Is CPSC 323 hard?", False),
+        ("CPSC 323 vs CPSC 223", False),
+        ("I would like to know more about ECON 115", False),
+        ("What should I take after CPSC 201?", True),
+        ("courses like ECON 115", True),
+        ("something easier than MATH 120", True),
+    ],
+)
+def test_tells_courses_asked_about_from_reference_points(content, other):
+    assert about_other_courses(content) is other
@@ -0,0 +1,93 @@
+import pytest
+
+import history
+from app import HISTORY_BUDGETS, SYSTEM_PROMPT, create_app, start_chat_turn
+from history import count_tokens, history_tokens, trim_history
+
+
+def conversation(turns, words=50):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "word " * words})
+        messages.append({"role": "ai", "content": f"answer {i} " + "word " * words})
+    messages.append({"role": "user", "content": "Any easy QR classes?"})
+    return messages
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # the same counts whether or not tiktoken is installed
+    monkeypatch.setattr(history, "encoding", lambda model="gpt-4": None)
+
+
+def test_short_history_is_kept():
+    messages = [
+        {"role": "system", "content": "be brief"},
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "hello"},
+        {"role": "user", "content": "courses?"},
+    ]
+    assert trim_history(messages, 1000) == messages
+
+
+def test_keeps_system_prompt_and_latest_turns():
+    messages = [{"role": "system", "content": "be brief"}] + conversation(20)
+    trimmed = trim_history(messages, 300)
+    assert history_tokens(trimmed) <= 300
+    assert trimmed[0] == messages[0]
+    # the latest messages, without gaps
+    assert trimmed[1:] == messages[-(len(trimmed) - 1) :]
+    assert len(trimmed) < len(messages)
+
+
+def test_long_latest_message_is_cut_to_fit():
+    messages = [
+        {"role": "system", "content": "be brief"},
+        {"role": "user", "content": "word " * 1000},
+    ]
+    trimmed = trim_history(messages, 100)
+    assert history_tokens(trimmed) <= 100
+    assert trimmed[-1]["role"] == "user"
+    assert trimmed[-1]["content"].startswith("word word")
+    # the request's own messages are left alone
+    assert messages[-1]["content"] == "word " * 1000
+
+
+def test_every_call_stays_within_its_budget():
+    turn = start_chat_turn({"message": conversation(40)})
+    instruction = {
+        "safety": 1,
+        "relevancy": 1,
+        "search_query": 1,
+        "plan": 1,
+        "filter": 0,
+        "final": 0,
+    }
+    for call, appended in instruction.items():
+        prompt = turn[call]
+        history = prompt[: len(prompt) - appended]
+        assert history_tokens(history) <= HISTORY_BUDGETS[call], call
+        assert history[-1]["content"] == "Any easy QR classes?", call
+
+    # everything but the checks keeps the system prompt
+    assert turn["final"][0] == {"role": "system", "content": SYSTEM_PROMPT}
+    assert turn["filter"][0] == {"role": "system", "content": SYSTEM_PROMPT}
+    # the rewrite and the filters see less of the conversation than the answer
+    assert len(turn["search_query"]) - 1 < len(turn["final"])
+    assert len(turn["filter"]) < len(turn["final"])
+    # the conversation itself is untouched, for the answer cache
+    assert len(turn["messages"]) == 82
+
+
+def test_budgets_are_configurable(monkeypatch):
+    monkeypatch.setattr("app.HISTORY_BUDGETS", dict(HISTORY_BUDGETS))
+    create_app({"TESTING": True, "HISTORY_BUDGETS": {"final": 50}})
+    turn = start_chat_turn({"message": conversation(5)})
+    assert history_tokens(turn["final"]) <= 50
+    assert len(turn["final"]) == 2
+
+
+def test_count_tokens_estimate():
+    assert count_tokens("") == 0
+    assert count_tokens(None) == 0
+    assert count_tokens("abcdef") == 2
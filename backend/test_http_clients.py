@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+import requests
+from prometheus_client import REGISTRY
+
+import http_clients
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(1)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def counts(dependency):
+    return (
+        sample("bluebook_outbound_requests_total", dependency=dependency),
+        sample("bluebook_outbound_connections_total", dependency=dependency),
+    )
+
+
+def test_cas_session_reuses_its_connection(server):
+    session = http_clients.cas_session()
+    requests_before, connections_before = counts("cas")
+    for _ in range(3):
+        assert session.get(f"{server}/serviceValidate").text == "ok"
+    assert counts("cas") == (requests_before + 3, connections_before + 1)
+
+
+def test_cas_session_times_out(server):
+    session = http_clients.cas_session(timeout=(1, 0.1))
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.get(f"{server}/slow")
+    assert sample("bluebook_outbound_requests_in_flight", dependency="cas") == 0
+
+
+def test_openai_client_reuses_its_connection(server):
+    client = http_clients.openai_http_client(pool_size=2)
+    requests_before, connections_before = counts("openai")
+    for _ in range(3):
+        assert client.get(f"{server}/v1/models").text == "ok"
+    assert counts("openai") == (requests_before + 3, connections_before + 1)
+
+
+def test_openai_async_client(server):
+    async def get_all():
+        async with http_clients.openai_async_http_client() as client:
+            for _ in range(3):
+                await client.get(f"{server}/v1/models")
+
+    requests_before, connections_before = counts("openai")
+    asyncio.run(get_all())
+    assert counts("openai") == (requests_before + 3, connections_before + 1)
+
+
+def test_openai_client_times_out(server):
+    client = http_clients.openai_http_client()
+    with pytest.raises(httpx.ReadTimeout):
+        client.get(f"{server}/slow", timeout=httpx.Timeout(0.1))
@@ -0,0 +1,53 @@
+import numpy as np
+
+from lexical import BM25Index, course_text, tokenize
+
+COURSES = [
+    {
+        "course_code": "CPSC 323",
+        "title": "Introduction to Systems Programming",
+        "professors": ["Stanley Eisenstat"],
+        "description": "Machine architecture and the C programming language.",
+    },
+    {
+        "course_code": "CPSC 223",
+        "title": "Data Structures and Programming Techniques",
+        "professors": ["James Aspnes"],
+        "description": "Topics include programming in C, data structures and algorithms.",
+    },
+    {
+        "course_code": "HIST 135",
+        "title": "Sweetness and Power",
+        "professors": [],
+        "description": "The history of sugar, from the Caribbean to the modern diet.",
+    },
+]
+
+
+def test_tokenize_drops_stopwords():
+    assert tokenize("Classes on the S&DS side of AI") == ["s&ds", "side", "ai"]
+
+
+def test_rare_words_outrank_common_ones():
+    index = BM25Index([course_text(course) for course in COURSES])
+    # "programming" is in both CPSC courses, "aspnes" only in one
+    assert index.search("programming with Aspnes", 3) == [1, 0]
+    assert index.search("sugar", 3) == [2]
+    assert index.search("quantum chromodynamics", 3) == []
+
+
+def test_course_numbers_match_with_or_without_a_space():
+    index = BM25Index([course_text(course) for course in COURSES])
+    assert index.search("cpsc323", 3) == [0]
+    assert index.search("CPSC 323", 3)[0] == 0
+
+
+def test_mask_restricts_the_rows():
+    index = BM25Index([course_text(course) for course in COURSES])
+    assert index.search("programming", 3, mask=np.array([False, True, True])) == [1]
+    assert index.nbytes > 0
+
+
+def test_empty_index():
+    index = BM25Index([])
+    assert index.search("anything", 5) == []
@@ -0,0 +1,105 @@
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from prometheus_client import REGISTRY, CollectorRegistry, multiprocess
+from tenacity import retry, stop_after_attempt, wait_none
+
+import lib
+import metrics
+from app import create_app
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics_endpoint_counts_requests():
+    client = create_app({"TESTING": True}).test_client()
+    labels = dict(route="/api/chat", method="POST", status="200")
+    before = sample("bluebook_http_requests_total", **labels)
+    client.post("/api/chat", json={})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    body = response.get_data(as_text=True)
+    assert "bluebook_http_request_duration_seconds_bucket" in body
+    assert "bluebook_http_requests_in_flight" in body
+    assert sample("bluebook_http_requests_total", **labels) == before + 1
+
+
+def test_openai_calls_and_tokens():
+    mock_client = MagicMock()
+    mock_client.chat.completions.create.return_value = MagicMock(
+        usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20)
+    )
+    calls = dict(operation="chat", model="gpt-4", outcome="success")
+    prompt = dict(operation="chat", model="gpt-4", kind="prompt")
+    completion = dict(operation="chat", model="gpt-4", kind="completion")
+    before = [
+        sample("bluebook_openai_requests_total", **calls),
+        sample("bluebook_openai_tokens_total", **prompt),
+        sample("bluebook_openai_tokens_total", **completion),
+    ]
+    with patch("lib.client", mock_client):
+        lib.chat_completion_request(messages=[{"role": "user", "content": "hi"}])
+    assert sample("bluebook_openai_requests_total", **calls) == before[0] + 1
+    assert sample("bluebook_openai_tokens_total", **prompt) == before[1] + 100
+    assert sample("bluebook_openai_tokens_total", **completion) == before[2] + 20
+
+
+def test_retries_are_counted():
+    attempts = []
+
+    @retry(
+        wait=wait_none(), stop=stop_after_attempt(3), before_sleep=metrics.count_retry
+    )
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Exception("API error simulated")
+
+    before = sample("bluebook_openai_retries_total", function="flaky")
+    flaky()
+    assert sample("bluebook_openai_retries_total", function="flaky") == before + 2
+
+
+def test_mongo_command_latency():
+    listener = metrics.MongoCommandMetrics()
+    before = sample(
+        "bluebook_mongo_command_duration_seconds_count",
+        command="aggregate",
+        outcome="success",
+    )
+    listener.succeeded(SimpleNamespace(command_name="aggregate", duration_micros=1500))
+    assert (
+        sample(
+            "bluebook_mongo_command_duration_seconds_count",
+            command="aggregate",
+            outcome="success",
+        )
+        == before + 1
+    )
+
+
+def test_multiple_processes_are_added_up(tmp_path):
+    # stands in for two gunicorn workers sharing PROMETHEUS_MULTIPROC_DIR
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    script = "import metrics; metrics.count_cache_lookup('answer', True)"
+    for _ in range(2):
+        subprocess.run(
+            [sys.executable, "-c", script],
+            env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+        )
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=str(tmp_path))
+    assert (
+        registry.get_sample_value(
+            "bluebook_cache_lookups_total", {"cache": "answer", "result": "hit"}
+        )
+        == 2
+    )
@@ -0,0 +1,141 @@
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import httpx
+import pytest
+from openai import APIConnectionError, BadRequestError
+from tenacity import wait_none
+
+import lib
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    bounded_timeout,
+    current_deadline,
+    start_deadline,
+)
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def fail(breaker, error=ConnectionError):
+    with pytest.raises(error):
+        with breaker.guard():
+            raise error()
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+    fail(breaker)
+    with breaker.guard():
+        pass
+    fail(breaker)
+    assert breaker.state == "closed"
+    fail(breaker)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        with breaker.guard():
+            pass
+
+
+def test_breaker_probes_after_reset_timeout():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    fail(breaker)
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+    # a failed probe opens the circuit for another reset_timeout
+    fail(breaker)
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    with breaker.guard():
+        pass
+    assert breaker.state == "closed"
+
+
+def test_breaker_ignores_other_errors():
+    breaker = CircuitBreaker("test", failure_threshold=1, failure_types=(OSError,))
+    fail(breaker, ValueError)
+    assert breaker.state == "closed"
+
+
+def test_breaker_ignores_failures_past_the_deadline():
+    breaker = CircuitBreaker("test", failure_threshold=1, failure_types=(OSError,))
+    current_deadline.set(time.monotonic() - 1)
+    try:
+        # the timeout our own deadline set, not an outage
+        with pytest.raises(DeadlineExceeded):
+            with breaker.guard():
+                raise TimeoutError()
+    finally:
+        current_deadline.set(None)
+    assert breaker.state == "closed"
+    fail(breaker, TimeoutError)
+    assert breaker.state == "open"
+
+
+def test_bounded_timeout():
+    timeout = httpx.Timeout(60, connect=5)
+    current_deadline.set(None)
+    assert bounded_timeout(timeout) is timeout
+    start_deadline(10)
+    bounded = bounded_timeout(timeout)
+    assert 9 < bounded.read <= 10
+    assert bounded.connect == 5
+    current_deadline.set(time.monotonic() - 1)
+    with pytest.raises(DeadlineExceeded):
+        bounded_timeout(timeout)
+    current_deadline.set(None)
+
+
+@pytest.fixture
+def mock_client():
+    breaker = CircuitBreaker(
+        "openai", failure_threshold=2, failure_types=lib.OPENAI_OUTAGE_ERRORS
+    )
+    with patch("lib.client") as client, patch(
+        "lib.openai_breaker", breaker
+    ), patch.object(lib.chat_completion_request.retry, "wait", wait_none()):
+        yield client
+
+
+def test_outage_errors_are_retried(mock_client):
+    response = MagicMock(usage=SimpleNamespace(prompt_tokens=1, completion_tokens=1))
+    mock_client.chat.completions.create.side_effect = [
+        APIConnectionError(request=REQUEST),
+        response,
+    ]
+    assert lib.chat_completion_request(messages=[]) is response
+    assert mock_client.chat.completions.create.call_count == 2
+
+
+def test_errors_are_raised(mock_client):
+    error = BadRequestError(
+        "bad", response=httpx.Response(400, request=REQUEST), body=None
+    )
+    mock_client.chat.completions.create.side_effect = error
+    with pytest.raises(BadRequestError):
+        lib.chat_completion_request(messages=[])
+    # our own mistake is not retried
+    assert mock_client.chat.completions.create.call_count == 1
+
+
+def test_circuit_opens_during_an_outage(mock_client):
+    mock_client.chat.completions.create.side_effect = APIConnectionError(
+        request=REQUEST
+    )
+    # three attempts: two failures open the circuit, the third is not sent
+    with pytest.raises(CircuitOpenError):
+        lib.chat_completion_request(messages=[])
+    assert mock_client.chat.completions.create.call_count == 2
+
+
+def test_no_call_past_the_deadline(mock_client):
+    current_deadline.set(time.monotonic() - 1)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            lib.chat_completion_request(messages=[])
+    finally:
+        current_deadline.set(None)
+    mock_client.chat.completions.create.assert_not_called()
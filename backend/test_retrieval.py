@@ -0,0 +1,284 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from courses import COURSE_PROJECTION, Course
+from retrieval import (
+    INDEX_PROJECTION,
+    AtlasRetriever,
+    BitmapIndex,
+    HybridRetriever,
+    LocalRetriever,
+    reciprocal_rank_fusion,
+)
+
+COURSES = [
+    {
+        "course_code": "CPSC 323",
+        "season_code": "202403",
+        "subject": "CPSC",
+        "areas": [],
+        "skills": ["QR"],
+        "embedding": [1.0, 0.0, 0.0],
+    },
+    {
+        "course_code": "CPSC 223",
+        "season_code": "202401",
+        "subject": "CPSC",
+        "areas": [],
+        "skills": ["QR"],
+        "embedding": [0.9, 0.1, 0.0],
+    },
+    {
+        "course_code": "ENGL 114",
+        "season_code": "202403",
+        "subject": "ENGL",
+        "areas": ["Hu"],
+        "skills": ["WR"],
+        "embedding": [0.0, 1.0, 0.0],
+    },
+    {
+        "course_code": "ECON 110",
+        "season_code": "202403",
+        "subject": "ECON",
+        "areas": ["So"],
+        "skills": ["QR"],
+        "embedding": [0.5, 0.0, 0.5],
+    },
+    # courses that were never embedded cannot be retrieved
+    {"course_code": "HIST 101", "season_code": "202403", "subject": "HIST"},
+]
+
+
+@pytest.fixture
+def retriever():
+    return LocalRetriever(COURSES)
+
+
+def codes(courses):
+    return [course.course_code for course in courses]
+
+
+def test_local_search_ranks_by_cosine_similarity(retriever):
+    results = retriever.search([2.0, 0.0, 0.0], {}, 3)
+    assert codes(results) == ["CPSC 323", "CPSC 223", "ECON 110"]
+    assert isinstance(results[0], Course)
+    assert results[0].season_code == "202403"
+
+
+def test_local_search_applies_filters(retriever):
+    results = retriever.search(
+        [1.0, 0.0, 0.0], {"season_code": ["202403"], "skills": ["QR"]}, 5
+    )
+    assert codes(results) == ["CPSC 323", "ECON 110"]
+
+
+def test_local_search_list_fields_match_any(retriever):
+    results = retriever.search([1.0, 0.0, 0.0], {"areas": ["Hu", "So"]}, 5)
+    assert codes(results) == ["ECON 110", "ENGL 114"]
+
+
+def test_bitmap_index():
+    index = BitmapIndex(COURSES)
+    assert index.bitmaps["subject"]["CPSC"].tolist() == [1, 1, 0, 0, 0]
+    assert index.bitmaps["skills"]["QR"].tolist() == [1, 1, 0, 1, 0]
+    assert index.mask({}) is None
+    mask = index.mask({"season_code": ["202403"], "areas": ["Hu", "So"]})
+    assert mask.tolist() == [0, 0, 1, 1, 0]
+
+
+def test_restrictive_filter_returns_full_top_k():
+    # 100 unfiltered courses are closer to the query than every ECON course, so
+    # filtering after a small candidate pool would come back short
+    courses = [
+        {"course_code": f"CPSC {i}", "subject": "CPSC", "embedding": [1.0, 0.0]}
+        for i in range(100)
+    ] + [
+        {"course_code": f"ECON {i}", "subject": "ECON", "embedding": [i, 10.0]}
+        for i in range(1, 6)
+    ]
+    results = LocalRetriever(courses).search([1.0, 0.0], {"subject": ["ECON"]}, 5)
+    assert codes(results) == ["ECON 5", "ECON 4", "ECON 3", "ECON 2", "ECON 1"]
+
+
+def test_local_search_no_match(retriever):
+    assert retriever.search([1.0, 0.0, 0.0], {"subject": ["MATH"]}, 5) == []
+
+
+def test_local_search_empty_catalog():
+    assert LocalRetriever([]).search([1.0, 0.0, 0.0], {}, 5) == []
+
+
+def test_local_from_collection():
+    collection = MagicMock()
+    collection.find.return_value = iter(COURSES)
+    retriever = LocalRetriever.from_collection(collection)
+    collection.find.assert_called_once_with(
+        {"embedding": {"$exists": True}}, dict(INDEX_PROJECTION, embedding=1)
+    )
+    assert len(retriever.courses) == 4
+
+
+def test_atlas_search_pipeline():
+    collection = MagicMock()
+    collection.aggregate.return_value = iter([{"course_code": "CPSC 323"}])
+    results = AtlasRetriever(collection).search(
+        [1.0, 0.0], {"season_code": ["202403"], "subject": None, "skills": ["QR"]}, 5
+    )
+    assert codes(results) == ["CPSC 323"]
+    collection.aggregate.assert_called_once_with(
+        [
+            {
+                "$vectorSearch": {
+                    "index": "parsed_courses_title_description_index",
+                    "path": "embedding",
+                    "queryVector": [1.0, 0.0],
+                    "numCandidates": 30,
+                    "limit": 5,
+                    "filter": {
+                        "$and": [
+                            {"season_code": {"$in": ["202403"]}},
+                            {"skills": {"$in": ["QR"]}},
+                        ]
+                    },
+                }
+            },
+            {"$project": COURSE_PROJECTION},
+        ]
+    )
+
+
+def test_atlas_search_without_filters():
+    collection = MagicMock()
+    collection.aggregate.return_value = iter([])
+    AtlasRetriever(collection).search([1.0, 0.0], {}, 5)
+    assert "filter" not in collection.aggregate.call_args[0][0][0]["$vectorSearch"]
+
+
+def test_atlas_search_async_runs_the_same_pipeline():
+    collection = MagicMock()
+    async_collection = MagicMock()
+    async_collection.aggregate.return_value.to_list = AsyncMock(
+        return_value=[{"course_code": "CPSC 323"}]
+    )
+    retriever = AtlasRetriever(collection, async_collection=async_collection)
+    filters = {"subject": ["CPSC"]}
+    results = asyncio.run(retriever.search_async([1.0, 0.0], filters, 5))
+    assert codes(results) == ["CPSC 323"]
+    assert async_collection.aggregate.call_args[0][0] == retriever.pipeline(
+        [1.0, 0.0], filters, 5
+    )
+    collection.aggregate.assert_not_called()
+
+
+def test_local_lookup_returns_latest_offering_of_each_code():
+    offerings = COURSES + [
+        dict(COURSES[0], season_code="202303", embedding=[1.0, 0.0, 0.0]),
+    ]
+    retriever = LocalRetriever(offerings)
+    results = retriever.lookup(["ECON 110", "CPSC 323", "MATH 999"], None, 5)
+    assert codes(results) == ["ECON 110", "CPSC 323"]
+    assert results[1].season_code == "202403"
+    older = retriever.lookup(["CPSC 323"], ["202303"], 5)
+    assert [course.season_code for course in older] == ["202303"]
+    assert codes(retriever.lookup(["CPSC 323", "ECON 110"], None, 1)) == ["CPSC 323"]
+
+
+def test_atlas_lookup_is_an_indexed_find():
+    collection = MagicMock()
+    collection.find.return_value.sort.return_value = iter(
+        [
+            {"course_code": "CPSC 323", "season_code": "202403"},
+            {"course_code": "CPSC 323", "season_code": "202303"},
+        ]
+    )
+    results = AtlasRetriever(collection).lookup(["CPSC 323"], ["202403", "202303"], 5)
+    assert results == [Course("202403", "CPSC 323")]
+    collection.find.assert_called_once_with(
+        {
+            "course_code": {"$in": ["CPSC 323"]},
+            "season_code": {"$in": ["202403", "202303"]},
+        },
+        COURSE_PROJECTION,
+    )
+    collection.find.return_value.sort.assert_called_once_with("season_code", -1)
+
+
+def test_reciprocal_rank_fusion():
+    # b is second in both rankings, a and c first in one and absent from the other
+    assert reciprocal_rank_fusion([["a", "b"], ["c", "b"]]) == ["b", "a", "c"]
+    assert reciprocal_rank_fusion([["a"], []]) == ["a"]
+
+
+def with_text(course, title, professors=()):
+    return dict(course, title=title, description="", professors=list(professors))
+
+
+def test_hybrid_finds_what_the_embedding_misses():
+    courses = [
+        with_text(COURSES[0], "Systems Programming", ["Stanley Eisenstat"]),
+        with_text(COURSES[1], "Data Structures", ["Ozan Erat"]),
+        with_text(COURSES[2], "Writing Seminars", ["Andrew Ehrgood"]),
+        with_text(COURSES[3], "Introductory Microeconomics", ["Tony Smith"]),
+    ]
+    retriever = HybridRetriever(LocalRetriever(courses), courses)
+    # the vector points at ECON 110 and ranks ENGL 114 last; the words name the
+    # ENGL 114 professor, which puts it first by both rankings together
+    results = retriever.search(
+        [0.5, 0.0, 0.5], {}, 2, query_text="classes with Ehrgood"
+    )
+    assert codes(results) == ["ENGL 114", "ECON 110"]
+    # a course both searches rank first stays first
+    results = retriever.search([1.0, 0.0, 0.0], {}, 1, query_text="systems programming")
+    assert codes(results) == ["CPSC 323"]
+    # the filters hold for the lexical matches too
+    results = retriever.search(
+        [1.0, 0.0, 0.0], {"subject": ["CPSC"]}, 5, query_text="Ehrgood"
+    )
+    assert codes(results) == ["CPSC 323", "CPSC 223"]
+
+
+def test_hybrid_over_atlas_asks_for_candidates_and_fuses():
+    collection = MagicMock()
+    collection.aggregate.return_value = iter([COURSES[3]])
+    courses = [with_text(course, "Topics") for course in COURSES[:4]]
+    courses[0]["professors"] = ["Lin Zhong"]
+    collection.find.return_value = iter(courses)
+    retriever = HybridRetriever.from_collection(collection, AtlasRetriever(collection))
+    (_, fields), _ = collection.find.call_args
+    assert fields["professors"] == 1 and "embedding" not in fields
+
+    results = retriever.search([1.0, 0.0], {}, 5, query_text="Zhong")
+    assert codes(results) == ["ECON 110", "CPSC 323"]
+    (pipeline,), _ = collection.aggregate.call_args
+    assert pipeline[0]["$vectorSearch"]["limit"] == retriever.candidates
+    # without the query's words it is the vector search alone
+    collection.aggregate.return_value = iter([COURSES[3]])
+    assert codes(retriever.search([1.0, 0.0], {}, 5)) == ["ECON 110"]
+
+
+def test_course_from_document_keeps_what_the_response_sends():
+    document = dict(
+        COURSES[2],
+        title="Writing Seminars",
+        description="Writing seminars on selected topics.",
+        ratings=[{"question_id": "YC401", "counts": [1, 2, 3]}],
+        sentiment_info={
+            "final_label": "POSITIVE",
+            "final_proportion": 0.9,
+            "YC401": {"sentiment_labels": ["POSITIVE"], "sentiment_scores": [0.9]},
+        },
+    )
+    course = Course.from_document(document)
+    assert course.id == "202403 ENGL 114"
+    assert course.to_dict() == {
+        "season_code": "202403",
+        "course_code": "ENGL 114",
+        "title": "Writing Seminars",
+        "description": "Writing seminars on selected topics.",
+        "areas": ["Hu"],
+        "sentiment_label": "POSITIVE",
+        "sentiment_score": 0.9,
+    }
+    assert not hasattr(course, "__dict__")
@@ -0,0 +1,179 @@
+import threading
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import summary
+from app import create_app, start_chat_turn
+from summary import (
+    ChatSummarizer,
+    messages_digest,
+    refresh,
+    stored_summary,
+    with_summary,
+)
+
+
+def completion(content):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+    )
+
+
+def messages(count):
+    roles = ["user", "ai"]
+    return [{"role": roles[i % 2], "content": f"message {i}"} for i in range(count)]
+
+
+def profiles_with_chat(chat):
+    collection = MagicMock()
+    collection.find_one.return_value = {"uid": "user123", "chat_history": [chat]}
+    collection.update_one.return_value = MagicMock(modified_count=1)
+    return collection
+
+
+def summary_of(count, text="likes CS"):
+    return {
+        "text": text,
+        "message_count": count,
+        "digest": messages_digest(messages(count)),
+    }
+
+
+def test_with_summary_replaces_covered_messages():
+    conversation = [{"role": "system", "content": "be brief"}] + messages(10)
+    summarized = with_summary(conversation, summary_of(6))
+    assert summarized[0] == conversation[0]
+    assert summarized[1]["role"] == "system"
+    assert summarized[1]["content"].endswith("likes CS")
+    assert summarized[2:] == conversation[7:]
+    # a transcript shorter than the summary is not the one it summarized
+    assert with_summary(messages(4), summary_of(6)) == messages(4)
+    assert with_summary(conversation, None) == conversation
+
+
+def test_with_summary_checks_the_covered_messages():
+    # the client's copy has ids and "assistant" where the stored one has "ai"
+    client_copy = [
+        {**message, "id": i, "role": message["role"].replace("ai", "assistant")}
+        for i, message in enumerate(messages(10))
+    ]
+    assert len(with_summary(client_copy, summary_of(6))) == 5
+    # an edited or reordered transcript, or a summary without a digest
+    edited = messages(10)
+    edited[2] = {"role": "user", "content": "something else"}
+    assert with_summary(edited, summary_of(6)) == edited
+    reordered = messages(10)
+    reordered[0], reordered[2] = reordered[2], reordered[0]
+    assert with_summary(reordered, summary_of(6)) == reordered
+    undigested = {"text": "likes CS", "message_count": 6}
+    assert with_summary(messages(10), undigested) == messages(10)
+
+
+def test_stored_summary_reads_only_the_summary():
+    collection = MagicMock()
+    collection.aggregate.return_value = iter([{"summary": summary_of(6)}])
+    assert stored_summary(collection, "user123", "chat123") == summary_of(6)
+    (pipeline,), _ = collection.aggregate.call_args
+    assert pipeline[0] == {
+        "$match": {"uid": "user123", "chat_history.chat_id": "chat123"}
+    }
+    assert list(pipeline[-1]["$project"]) == ["_id", "summary"]
+    collection.find_one.assert_not_called()
+    # a chat that is gone
+    collection.aggregate.return_value = iter([])
+    assert stored_summary(collection, "user123", "chat123") is None
+
+
+def test_chat_turn_sends_summary_and_latest_messages():
+    data = {"message": messages(11)}
+    turn = start_chat_turn(data, summary_of(8, "wants QR"))
+    assert [m["content"] for m in turn["final"][2:]] == [
+        "message 8",
+        "message 9",
+        "message 10",
+    ]
+    assert "wants QR" in turn["final"][1]["content"]
+    assert "wants QR" in turn["filter"][1]["content"]
+    # the whole conversation is still there for the answer cache
+    assert len(turn["messages"]) == 12
+
+
+@patch("summary.chat_completion_request")
+def test_refresh_waits_for_a_batch(mock_completion):
+    chat = {"chat_id": "chat123", "messages": messages(summary.RECENT_MESSAGES + 1)}
+    collection = profiles_with_chat(chat)
+    assert refresh(collection, "user123", "chat123") is False
+    mock_completion.assert_not_called()
+    collection.update_one.assert_not_called()
+
+
+@patch("summary.chat_completion_request")
+def test_refresh_folds_old_messages_into_summary(mock_completion):
+    mock_completion.return_value = completion("Wants an easy QR class.")
+    chat = {
+        "chat_id": "chat123",
+        "messages": messages(14),
+        "summary": {"text": "Is a junior.", "message_count": 2},
+    }
+    collection = profiles_with_chat(chat)
+    assert refresh(collection, "user123", "chat123") is True
+
+    prompt = mock_completion.call_args.kwargs["messages"][-1]["content"]
+    assert "Is a junior." in prompt
+    # only the messages between the old summary and the recent window
+    assert "message 2" in prompt and "message 7" in prompt
+    assert "message 1\n" not in prompt and "message 8" not in prompt
+
+    query, update = collection.update_one.call_args.args
+    assert query["chat_history"]["$elemMatch"]["chat_id"] == "chat123"
+    assert update == {
+        "$set": {
+            "chat_history.$.summary": {
+                "text": "Wants an easy QR class.",
+                "message_count": 8,
+                "digest": messages_digest(messages(8)),
+            }
+        }
+    }
+
+
+def test_refreshes_of_a_chat_are_coalesced(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_refresh(collection, uid, chat_id):
+        calls.append(chat_id)
+        started.set()
+        release.wait(5)
+        return True
+
+    monkeypatch.setattr(summary, "refresh", slow_refresh)
+    summarizer = ChatSummarizer(max_workers=2)
+    summarizer.schedule(None, "user123", "chat123")
+    started.wait(5)
+    # appended while the first refresh runs: one more refresh, not three
+    for _ in range(3):
+        assert summarizer.schedule(None, "user123", "chat123") is None
+    release.set()
+    summarizer.pool.shutdown(wait=True)
+    assert calls == ["chat123", "chat123"]
+
+
+@patch("summary.chat_completion_request")
+def test_append_message_refreshes_summary_in_background(mock_completion):
+    mock_completion.return_value = completion("Likes history.")
+    app = create_app({"TESTING": True})
+    chat = {"chat_id": "chat123", "messages": messages(12)}
+    app.config["profiles"] = profiles_with_chat(chat)
+
+    response = app.test_client().post(
+        "/api/chat/append_message",
+        json={"uid": "user123", "chat_id": "chat123", "message": "Hello!"},
+    )
+    assert response.get_json() == {"status": "success"}
+    app.config["chat_summarizer"].pool.shutdown(wait=True)
+
+    mock_completion.assert_called_once()
+    _, update = app.config["profiles"].update_one.call_args.args
+    assert update["$set"]["chat_history.$.summary"]["text"] == "Likes history."
@@ -0,0 +1,76 @@
+import json
+import time
+from unittest.mock import patch
+
+from pipeline import StageExecutor
+from tracing import annotate, current_trace, span, start_trace
+
+
+def test_span_records_duration_and_attributes():
+    trace = start_trace()
+    with span("chat_completion", model="gpt-4") as record:
+        time.sleep(0.01)
+        record["prompt_tokens"] = 12
+    (recorded,) = trace.spans
+    assert recorded["name"] == "chat_completion"
+    assert recorded["model"] == "gpt-4"
+    assert recorded["prompt_tokens"] == 12
+    assert recorded["duration_ms"] >= 10
+
+
+def test_span_outside_of_a_request():
+    current_trace.set(None)
+    with span("embedding") as record:
+        record["cached"] = True
+    assert "duration_ms" not in record
+
+
+def test_span_recorded_when_block_raises():
+    trace = start_trace()
+    try:
+        with span("cas_validate"):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert [recorded["name"] for recorded in trace.spans] == ["cas_validate"]
+
+
+def test_server_timing():
+    trace = start_trace()
+    with span("safety"):
+        pass
+    with span("final"):
+        pass
+    entries = trace.server_timing().split(", ")
+    assert [entry.split(";")[0] for entry in entries] == ["safety", "final", "total"]
+    assert all(";dur=" in entry for entry in entries)
+
+
+def test_log_line():
+    trace = start_trace()
+    with span("aggregate"):
+        pass
+    annotate(filters={"subject": ["CPSC"]})
+    with patch("tracing.logger") as logger:
+        trace.log(method="POST", path="/api/chat", status=200)
+    record = json.loads(logger.info.call_args[0][0])
+    assert record["path"] == "/api/chat"
+    assert record["filters"] == {"subject": ["CPSC"]}
+    assert [span["name"] for span in record["spans"]] == ["aggregate"]
+
+
+def test_stage_spans_join_the_callers_trace():
+    trace = start_trace()
+
+    def embed():
+        with span("embedding"):
+            return [0.0]
+
+    run = StageExecutor(max_workers=2).run({"search_query": embed, "filter": dict})
+    assert run.result("search_query") == [0.0]
+    run.result("filter")
+    assert sorted(recorded["name"] for recorded in trace.spans) == [
+        "embedding",
+        "filter",
+        "search_query",
+    ]
@@ -0,0 +1,86 @@
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# One JSON line per request, on stdout where Elastic Beanstalk collects it
+logger = logging.getLogger("bluebook.requests")
+if not logger.handlers:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+current_trace = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """The spans and notes of one request.
+
+    Spans may be recorded from several threads at once (the stages of a chat
+    turn), so they are appended under a lock.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.fields = {}
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.start) * 1000, 2)
+
+    def server_timing(self):
+        # https://www.w3.org/TR/server-timing/: "name;dur=ms" entries in start order
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start_ms"])
+        entries = [f"{span['name']};dur={span['duration_ms']}" for span in spans]
+        entries.append(f"total;dur={self.elapsed_ms()}")
+        return ", ".join(entries)
+
+    def log(self, **fields):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start_ms"])
+        record = dict(fields, duration_ms=self.elapsed_ms(), spans=spans)
+        record.update(self.fields)
+        logger.info(json.dumps(record, default=str))
+
+
+def start_trace():
+    trace = Trace()
+    current_trace.set(trace)
+    return trace
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the block as a span of the current request's trace.
+
+    Yields a dict the block can add attributes to (token counts, cache hits).
+    Outside of a request nothing is recorded.
+    """
+    record = dict(name=name, **attributes)
+    trace = current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        if trace is not None:
+            record["start_ms"] = round((start - trace.start) * 1000, 2)
+            record["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            trace.add(record)
+
+
+def annotate(**fields):
+    # adds fields to the request's log line, e.g. the filters a turn searched with
+    trace = current_trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
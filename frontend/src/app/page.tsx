@@ -39,6 +39,9 @@ export default function Chat() {
   ]);
   const [chatVisible, setChatVisible] = useState(false);
   const [isAuthenticated, setIsAuthenticated] = useState(false);
+  // the CAS user, and the saved chat this conversation is appended to
+  const [uid, setUid] = useState<string | null>(null);
+  const [chatId, setChatId] = useState<string | null>(null);
 
   const [selectedSeason, setSelectedSeason] = useState<MultiValue<OptionType>>([]);
   const [selectedAreas, setSelectedAreas] = useState<MultiValue<OptionType>>([]);
@@ -155,7 +158,15 @@ export default function Chat() {
     setIsTyping(true);
     console.log(selectedSeason, selectedAreas, selectedSubjects);
     console.log(messages)
-    const response = await fetch("http://127.0.0.1:8000/api/chat", {
+
+    // Saved chats are summarized on the server; naming the chat lets the turn
+    // send its summary instead of the whole transcript
+    const savedChatId = await ensureChat();
+    const userMessageSaved = savedChatId
+      ? saveMessage(savedChatId, newUserMessage)
+      : Promise.resolve();
+
+    const response = await fetch("http://127.0.0.1:8000/api/chat/stream", {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
@@ -164,57 +175,150 @@ export default function Chat() {
         message: [...messages, newUserMessage],
         season_codes: selectedSeason.map(season => season.value),
         subject: selectedSubjects.map(subject => subject.value),
-        areas: selectedAreas.map(area => area.value)
+        areas: selectedAreas.map(area => area.value),
+        ...(savedChatId ? { uid: uid, chat_id: savedChatId } : {}),
       }),
     });
     
     console.log(response)
-    setIsTyping(false);
-    if (response.ok) {
-      const data = await response.json();
-      simulateTypingEffect(data.response, "ai", `ai-${Date.now()}`);
+    if (response.ok && response.body) {
+      const answer = await readChatStream(response.body, `ai-${Date.now()}`);
+      await userMessageSaved;
+      if (savedChatId && answer) {
+        await saveMessage(savedChatId, { content: answer, role: "ai" });
+      }
     } else {
       console.error("Failed to send message");
     }
+    setIsTyping(false);
   };
-  
 
-  const simulateTypingEffect = (
-    message: string,
-    role: string,
+  // The saved chat of this conversation, created with the messages shown so far
+  // on the first message after logging in. Null when not logged in or if the
+  // chat couldn't be created; the conversation then just isn't saved.
+  const ensureChat = async () => {
+    if (!uid) return null;
+    if (chatId) return chatId;
+    try {
+      const profile = await fetch("http://127.0.0.1:8000/api/user/profile", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({ uid }),
+      });
+      if (profile.status === 404) {
+        await fetch("http://127.0.0.1:8000/api/user/create", {
+          method: "POST",
+          headers: {
+            "Content-Type": "application/json",
+          },
+          body: JSON.stringify({ uid }),
+        });
+      }
+      const response = await fetch("http://127.0.0.1:8000/api/chat/create_chat", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({ uid }),
+      });
+      const data = await response.json();
+      if (!response.ok || !data.chat_id) {
+        console.error("Failed to create chat", data);
+        return null;
+      }
+      // the saved transcript must match the one sent with each turn
+      for (const message of messages) {
+        await saveMessage(data.chat_id, message);
+      }
+      setChatId(data.chat_id);
+      return data.chat_id as string;
+    } catch (error) {
+      console.error("Failed to create chat:", error);
+      return null;
+    }
+  };
+
+  const saveMessage = async (
+    savedChatId: string,
+    message: { content: string; role: string }
+  ) => {
+    try {
+      await fetch("http://127.0.0.1:8000/api/chat/append_message", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({
+          uid,
+          chat_id: savedChatId,
+          message: { role: message.role, content: message.content },
+        }),
+      });
+    } catch (error) {
+      console.error("Failed to save message:", error);
+    }
+  };
+
+  // Reads the server-sent events of /api/chat/stream and shows the answer as
+  // its tokens arrive. Returns the whole answer, or null if the stream failed.
+  const readChatStream = async (
+    body: ReadableStream<Uint8Array>,
     messageId: string
   ) => {
-    let index = 0;
-    const typingSpeedMs = 20;
-
-    const typeCharacter = () => {
-      if (index < message.length) {
-        const updatedMessage = {
-          id: messageId,
-          content: message.substring(0, index + 1),
-          role: role,
-        };
-        setMessages((currentMessages) => {
-          // is message being typed already in array
-          const existingIndex = currentMessages.findIndex(
-            (msg) => msg.id === messageId
-          );
-          let newMessages = [...currentMessages];
-          if (existingIndex >= 0) {
-            // update existing message
-            newMessages[existingIndex] = updatedMessage;
-          } else {
-            // add new message if it doesn't exist
-            newMessages.push(updatedMessage);
-          }
-          return newMessages;
-        });
-        index++;
-        setTimeout(typeCharacter, typingSpeedMs);
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let content = "";
+    let failed = false;
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      const events = buffer.split("\n\n");
+      buffer = events.pop() || "";
+      for (const rawEvent of events) {
+        let event = "";
+        let data = "";
+        for (const line of rawEvent.split("\n")) {
+          if (line.startsWith("event: ")) event = line.slice(7);
+          if (line.startsWith("data: ")) data = line.slice(6);
+        }
+        if (event === "token") {
+          content += JSON.parse(data).content;
+          setIsTyping(false);
+          updateMessage({ id: messageId, content: content, role: "ai" });
+        } else if (event === "courses") {
+          console.log(JSON.parse(data));
+        } else if (event === "error") {
+          failed = true;
+          console.error("Failed to send message", JSON.parse(data));
+        }
       }
-    };
+    }
+    return failed ? null : content;
+  };
 
-    typeCharacter();
+  const updateMessage = (updatedMessage: {
+    id: string;
+    content: string;
+    role: string;
+  }) => {
+    setMessages((currentMessages) => {
+      const existingIndex = currentMessages.findIndex(
+        (msg) => msg.id === updatedMessage.id
+      );
+      let newMessages = [...currentMessages];
+      if (existingIndex >= 0) {
+        newMessages[existingIndex] = updatedMessage;
+      } else {
+        newMessages.push(updatedMessage);
+      }
+      return newMessages;
+    });
   };
 
   const toggleChatVisibility = () => {
@@ -245,6 +349,7 @@ export default function Chat() {
       if (response.ok) {
         const data = await response.json();
         setIsAuthenticated(data.isAuthenticated); // Update the state based on the response
+        setUid(data.isAuthenticated ? data.user : null);
         clearTicketFromUrl();
       } else {
         console.error(